@@ -0,0 +1,268 @@
+"""Awaitable storage API for code running on the event loop.
+
+Every call is shipped to a thread so a slow disk or a ``database is locked``
+wait never stalls other updates. Writes go through a single writer thread,
+which serialises them and avoids SQLite lock contention between writers;
+reads use a small pool and run concurrently thanks to WAL. The synchronous
+functions in :mod:`src.storage` stay the source of truth for ops scripts.
+"""
+from __future__ import annotations
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import functools
+from typing import Any, Callable, Iterable, List, TypeVar
+
+from . import storage
+from .config import STORAGE_READ_WORKERS
+from .storage import (
+    PaymentJob,
+    Reminder,
+    ReminderState,
+    SubscriptionInfo,
+    SubscriptionSource,
+    TrafficClient,
+    UserProfile,
+)
+
+
+T = TypeVar("T")
+
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage-writer")
+_readers = ThreadPoolExecutor(
+    max_workers=max(1, STORAGE_READ_WORKERS),
+    thread_name_prefix="storage-reader",
+)
+
+
+async def _run(executor: ThreadPoolExecutor, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+
+async def _write(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    return await _run(_writer, fn, *args, **kwargs)
+
+
+async def _read(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    return await _run(_readers, fn, *args, **kwargs)
+
+
+def shutdown() -> None:
+    """Drain pending writes and stop the storage threads."""
+    _writer.shutdown(wait=True)
+    _readers.shutdown(wait=False)
+
+
+async def init_db() -> None:
+    await _write(storage.init_db)
+
+
+async def upsert_user(user_id: int, lang: str) -> None:
+    await _write(storage.upsert_user, user_id, lang)
+
+
+async def touch_users(last_seen: dict[int, int]) -> None:
+    await _write(storage.touch_users, dict(last_seen))
+
+
+async def get_user_lang(user_id: int) -> str:
+    return await _read(storage.get_user_lang, user_id)
+
+
+async def set_subscription(user_id: int, expires_at_iso: str, plan_code: str = "manual") -> None:
+    await _write(storage.set_subscription, user_id, expires_at_iso, plan_code=plan_code)
+
+
+async def mark_reminded(user_id: int, kind: str) -> None:
+    await _write(storage.mark_reminded, user_id, kind)
+
+
+async def mark_reminded_many(items: Iterable[tuple[int, str]]) -> None:
+    await _write(storage.mark_reminded_many, list(items))
+
+
+async def set_status_expired(user_id: int) -> None:
+    await _write(storage.set_status_expired, user_id)
+
+
+async def set_status_expired_many(user_ids: Iterable[int]) -> None:
+    await _write(storage.set_status_expired_many, list(user_ids))
+
+
+async def set_user_key(
+    user_id: int,
+    vless_uri: str,
+    sub_url: str,
+    client_id: str = "",
+    email: str = "",
+    sub_id: str = "",
+) -> None:
+    await _write(storage.set_user_key, user_id, vless_uri, sub_url, client_id, email, sub_id)
+
+
+async def get_user_key(user_id: int) -> tuple[str, str]:
+    return await _read(storage.get_user_key, user_id)
+
+
+async def get_user_client(user_id: int) -> tuple[str, str, str] | None:
+    return await _read(storage.get_user_client, user_id)
+
+
+async def get_subscription_source(sub_id: str) -> SubscriptionSource | None:
+    return await _read(storage.get_subscription_source, sub_id)
+
+
+async def get_subscription(user_id: int) -> SubscriptionInfo | None:
+    return await _read(storage.get_subscription, user_id)
+
+
+async def get_profile(user_id: int) -> UserProfile:
+    return await _read(storage.get_profile, user_id)
+
+
+async def get_panel(user_id: int) -> str | None:
+    return await _read(storage.get_panel, user_id)
+
+
+async def assign_panel(user_id: int, panel: str) -> str:
+    return await _write(storage.assign_panel, user_id, panel)
+
+
+async def set_panel(user_id: int, panel: str) -> None:
+    await _write(storage.set_panel, user_id, panel)
+
+
+async def count_panel_users() -> dict[str, int]:
+    return await _read(storage.count_panel_users)
+
+
+async def get_media_file_id(bot_id: int, asset_key: str, file_hash: str) -> str:
+    return await _read(storage.get_media_file_id, bot_id, asset_key, file_hash)
+
+
+async def set_media_file_id(bot_id: int, asset_key: str, file_hash: str, file_id: str) -> None:
+    await _write(storage.set_media_file_id, bot_id, asset_key, file_hash, file_id)
+
+
+async def delete_media_file_id(bot_id: int, asset_key: str) -> None:
+    await _write(storage.delete_media_file_id, bot_id, asset_key)
+
+
+async def list_due_reminders(now: datetime) -> List[Reminder]:
+    return await _read(storage.list_due_reminders, now)
+
+
+async def list_reminder_states() -> List[ReminderState]:
+    return await _read(storage.list_reminder_states)
+
+
+async def get_reminder_states(user_ids: Iterable[int]) -> List[ReminderState]:
+    return await _read(storage.get_reminder_states, list(user_ids))
+
+
+async def enqueue_payment_job(
+    idempotency_key: str,
+    source: str,
+    user_id: int,
+    plan_code: str,
+    payload: str,
+) -> tuple[int, bool]:
+    return await _write(storage.enqueue_payment_job, idempotency_key, source, user_id, plan_code, payload)
+
+
+async def claim_payment_jobs(limit: int, now_ts: int, lease_seconds: int) -> List[PaymentJob]:
+    return await _write(storage.claim_payment_jobs, limit, now_ts, lease_seconds)
+
+
+async def set_payment_job_stage(job_id: int, stage: str) -> None:
+    await _write(storage.set_payment_job_stage, job_id, stage)
+
+
+async def set_payment_job_target(job_id: int, target_expires_ts: int) -> int:
+    return await _write(storage.set_payment_job_target, job_id, target_expires_ts)
+
+
+async def complete_payment_job(job_id: int) -> None:
+    await _write(storage.complete_payment_job, job_id)
+
+
+async def retry_payment_job(job_id: int, error: str, next_run_ts: int) -> None:
+    await _write(storage.retry_payment_job, job_id, error, next_run_ts)
+
+
+async def dead_letter_payment_job(job_id: int, error: str) -> None:
+    await _write(storage.dead_letter_payment_job, job_id, error)
+
+
+async def requeue_payment_job(job_id: int) -> bool:
+    return await _write(storage.requeue_payment_job, job_id)
+
+
+async def recent_payment_job_keys(limit: int) -> List[tuple[str, int]]:
+    return await _read(storage.recent_payment_job_keys, limit)
+
+
+async def count_payment_jobs() -> dict[str, int]:
+    return await _read(storage.count_payment_jobs)
+
+
+async def list_dead_payment_jobs(limit: int = 20) -> List[PaymentJob]:
+    return await _read(storage.list_dead_payment_jobs, limit)
+
+
+async def last_change_id() -> int:
+    return await _read(storage.last_change_id)
+
+
+async def read_changes(after_id: int, limit: int = 1000) -> List[tuple[int, str, int, int]]:
+    return await _read(storage.read_changes, after_id, limit)
+
+
+async def prune_changes(before_ts: int) -> int:
+    return await _write(storage.prune_changes, before_ts)
+
+
+async def acquire_lease(name: str, holder: str, ttl: float) -> bool:
+    return await _write(storage.acquire_lease, name, holder, ttl)
+
+
+async def release_lease(name: str, holder: str) -> None:
+    await _write(storage.release_lease, name, holder)
+
+
+async def get_lease_holder(name: str) -> str | None:
+    return await _read(storage.get_lease_holder, name)
+
+
+async def restore_archived(user_id: int) -> bool:
+    return await _write(storage.restore_archived, user_id)
+
+
+async def record_traffic(panel: str, readings: Iterable[tuple[str, int, int, int]], now_ts: int) -> int:
+    return await _write(storage.record_traffic, panel, list(readings), now_ts)
+
+
+async def mark_online(panel: str, emails: Iterable[str], now_ts: int) -> None:
+    await _write(storage.mark_online, panel, list(emails), now_ts)
+
+
+async def rollup_traffic(now_ts: int, minutes_for: int, hours_for: int, days_for: int) -> int:
+    return await _write(storage.rollup_traffic, now_ts, minutes_for, hours_for, days_for)
+
+
+async def get_traffic_used(user_id: int, since_ts: int) -> tuple[int, int]:
+    return await _read(storage.get_traffic_used, user_id, since_ts)
+
+
+async def top_traffic(since_ts: int, limit: int = 10) -> List[tuple[int, int]]:
+    return await _read(storage.top_traffic, since_ts, limit)
+
+
+async def traffic_summary(since_ts: int, online_since_ts: int) -> dict[str, int]:
+    return await _read(storage.traffic_summary, since_ts, online_since_ts)
+
+
+async def list_traffic_clients(user_ids: Iterable[int]) -> List[TrafficClient]:
+    return await _read(storage.list_traffic_clients, list(user_ids))
@@ -0,0 +1,241 @@
+"""Run the bot as several worker processes::
+
+    python -m src.cluster
+
+The parent process serves the public webhook app: payment webhooks as in
+``src.webhook`` plus Telegram's update webhook (``BOT_WEBHOOK_URL`` is
+required, since ``getUpdates`` can only have one consumer). Each update is
+forwarded to one of ``BOT_WORKERS`` child processes chosen by the user it
+came from, so one user's updates are always handled in order by the same
+worker. Workers run the usual dispatcher; their caches stay coherent
+through the change feed and reminders run on whichever process holds the
+``reminders`` lease. A worker that dies is restarted, and the updates it
+had not finished are delivered again by Telegram.
+"""
+from __future__ import annotations
+
+import asyncio
+import hmac
+import json
+import logging
+import multiprocessing
+import os
+from typing import Any, Optional
+from urllib.parse import urlparse
+
+import aiohttp
+from aiohttp import web
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+
+from . import async_storage, main as bot_main, webhook
+from .config import (
+    BOT_TOKEN,
+    BOT_UPDATE_WORKERS,
+    BOT_WEBHOOK_URL,
+    BOT_WORKER_BASE_PORT,
+    BOT_WORKERS,
+    NOTIFY_CONCURRENCY,
+)
+from .panels import registry as panel_registry
+
+
+WORKER_HOST = "127.0.0.1"
+WORKER_UPDATE_PATH = "/update"
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# Workers reply once an update is handled, so this covers the wait for a
+# free slot plus the handlers themselves. Past it Telegram gets a 503 and
+# the redelivery joins the delivery still running on the worker.
+FORWARD_TIMEOUT_SECONDS = 60
+
+
+def update_user_id(update: dict[str, Any]) -> int:
+    """Id of the user (or chat) an update comes from; 0 if it has none."""
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        sender = value.get("from") or value.get("user") or value.get("chat") or {}
+        if isinstance(sender, dict) and isinstance(sender.get("id"), int):
+            return sender["id"]
+    return 0
+
+
+def worker_for(user_id: int, workers: int) -> int:
+    return user_id % workers
+
+
+def _worker_port(index: int) -> int:
+    return BOT_WORKER_BASE_PORT + index
+
+
+class UpdateRouter:
+    """Forwards Telegram updates to the worker that owns their user.
+
+    Telegram only gets a 200 once the worker has handled the update. A
+    worker that is restarting, dies mid-update or does not answer within
+    ``FORWARD_TIMEOUT_SECONDS`` gets Telegram a 503, and the update is
+    redelivered later. One user's redeliveries reach the same worker, which
+    skips update ids it already took (see
+    :class:`~src.webhook.BotUpdateHandler`); only an update a dying worker
+    had not finished is handled again, by its replacement.
+    """
+
+    def __init__(self, secret: str, workers: int) -> None:
+        self.secret = secret
+        self.workers = workers
+        self.forwarded = [0] * workers
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def start(self, app: web.Application) -> None:
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=max(1, BOT_UPDATE_WORKERS)),
+            timeout=aiohttp.ClientTimeout(total=FORWARD_TIMEOUT_SECONDS),
+        )
+
+    async def close(self, app: web.Application) -> None:
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            return web.json_response({"ok": False, "error": "unauthorized"}, status=401)
+        raw = await request.read()
+        try:
+            update = json.loads(raw)
+        except ValueError:
+            return web.json_response({"ok": False, "error": "invalid update"}, status=400)
+        if not isinstance(update, dict):
+            return web.json_response({"ok": False, "error": "invalid update"}, status=400)
+        index = worker_for(update_user_id(update), self.workers)
+        url = f"http://{WORKER_HOST}:{_worker_port(index)}{WORKER_UPDATE_PATH}"
+        try:
+            async with self._session.post(
+                url,
+                data=raw,
+                headers={SECRET_HEADER: self.secret, "Content-Type": "application/json"},
+            ) as response:
+                status = response.status
+                body = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            logging.warning("Worker %s unreachable: %s", index, exc)
+            return web.json_response({"ok": False, "error": "worker unavailable"}, status=503)
+        if status == 200:
+            self.forwarded[index] += 1
+        return web.Response(status=status, body=body, content_type="application/json")
+
+
+async def run_worker(index: int) -> None:
+    bot = Bot(BOT_TOKEN)
+    dp = bot_main.build_dispatcher()
+    await async_storage.init_db()
+    tasks = bot_main.start_background(bot)
+    app = web.Application()
+    webhook.add_bot_updates(
+        app, dp, bot, WORKER_UPDATE_PATH, bot_main.bot_webhook_secret(), BOT_UPDATE_WORKERS
+    )
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WORKER_HOST, _worker_port(index)).start()
+        logging.info("Worker %s (pid %s) listening on port %s", index, os.getpid(), _worker_port(index))
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await bot_main.stop_background(tasks)
+        await bot.session.close()
+        await panel_registry.close()
+        async_storage.shutdown()
+
+
+def _worker_main(index: int) -> None:
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(run_worker(index))
+    except KeyboardInterrupt:
+        pass
+
+
+class Supervisor:
+    def __init__(self, workers: int) -> None:
+        self.workers = workers
+        self._context = multiprocessing.get_context("spawn")
+        self._processes: list[Optional[multiprocessing.Process]] = [None] * workers
+        self.restarts = 0
+
+    def _spawn(self, index: int) -> None:
+        process = self._context.Process(target=_worker_main, args=(index,), name=f"bot-worker-{index}", daemon=True)
+        process.start()
+        self._processes[index] = process
+
+    def start(self) -> None:
+        for index in range(self.workers):
+            self._spawn(index)
+
+    async def watch(self, interval: float = 2.0) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            for index, process in enumerate(self._processes):
+                if process is not None and not process.is_alive():
+                    logging.warning("Worker %s exited with code %s, restarting", index, process.exitcode)
+                    self.restarts += 1
+                    self._spawn(index)
+
+    def stop(self, timeout: float = 10.0) -> None:
+        for process in self._processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self._processes:
+            if process is not None:
+                process.join(timeout)
+
+
+async def run(workers: int) -> None:
+    if not BOT_TOKEN:
+        raise RuntimeError("BOT_TOKEN is missing")
+    if not BOT_WEBHOOK_URL:
+        raise RuntimeError("Multi-worker mode receives updates by webhook; set BOT_WEBHOOK_URL")
+    # Migrate once before any worker opens the database.
+    await async_storage.init_db()
+    supervisor = Supervisor(workers)
+    supervisor.start()
+    bot = Bot(BOT_TOKEN, session=AiohttpSession(limit=NOTIFY_CONCURRENCY))
+    secret = bot_main.bot_webhook_secret()
+    router = UpdateRouter(secret, workers)
+    app = await webhook.init_app(bot)
+    app.router.add_post(urlparse(BOT_WEBHOOK_URL).path or "/", router.handle)
+    app.on_startup.append(router.start)
+    app.on_cleanup.append(router.close)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    watch_task = asyncio.create_task(supervisor.watch())
+    try:
+        await web.TCPSite(runner, webhook.WEBHOOK_BIND, webhook.WEBHOOK_PORT).start()
+        await bot.set_webhook(
+            BOT_WEBHOOK_URL,
+            secret_token=secret,
+            allowed_updates=bot_main.build_dispatcher().resolve_used_update_types(),
+            max_connections=min(100, max(1, BOT_UPDATE_WORKERS * workers)),
+        )
+        logging.info("Receiving updates via webhook at %s for %s workers", BOT_WEBHOOK_URL, workers)
+        await asyncio.Event().wait()
+    finally:
+        watch_task.cancel()
+        await asyncio.gather(watch_task, return_exceptions=True)
+        await runner.cleanup()
+        await bot.session.close()
+        await panel_registry.close()
+        supervisor.stop()
+        async_storage.shutdown()
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(run(BOT_WORKERS or os.cpu_count() or 1))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
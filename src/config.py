@@ -11,6 +11,11 @@ def _get_env(name: str, default: str = "") -> str:
 
 
 BOT_TOKEN = _get_env("BOT_TOKEN")
+BOT_WEBHOOK_URL = _get_env("BOT_WEBHOOK_URL", "")
+BOT_WEBHOOK_SECRET = _get_env("BOT_WEBHOOK_SECRET", "")
+BOT_UPDATE_WORKERS = int(_get_env("BOT_UPDATE_WORKERS", "32") or "32")
+BOT_WORKERS = int(_get_env("BOT_WORKERS", "0") or "0")
+BOT_WORKER_BASE_PORT = int(_get_env("BOT_WORKER_BASE_PORT", "8181") or "8181")
 BRAND_NAME = _get_env("BRAND_NAME", "Lagom VPN Pro")
 BOT_USERNAME = _get_env("BOT_USERNAME", "@lagvpnbot")
 SUPPORT_BOT = _get_env("SUPPORT_BOT", "@GetniusSupport_bot")
@@ -68,8 +73,17 @@ XUI_LIMIT_IP = int(_get_env("XUI_LIMIT_IP", "0") or "0")
 XUI_PUBLIC_HOST = _get_env("XUI_PUBLIC_HOST", "")
 XUI_PUBLIC_PORT = _get_env("XUI_PUBLIC_PORT", "")
 XUI_SUB_BASE_URL = _get_env("XUI_SUB_BASE_URL", "")
+XUI_PANELS_FILE = _get_env("XUI_PANELS_FILE", "")
 XUI_SSL_VERIFY = _get_env("XUI_SSL_VERIFY", "true").lower() not in ("0", "false", "no")
 XUI_TIMEOUT_SECONDS = float(_get_env("XUI_TIMEOUT_SECONDS", "10") or "10")
+XUI_INBOUND_CACHE_SECONDS = float(_get_env("XUI_INBOUND_CACHE_SECONDS", "60") or "60")
+XUI_COALESCE_SECONDS = float(_get_env("XUI_COALESCE_SECONDS", "1") or "1")
+XUI_CONCURRENCY = int(_get_env("XUI_CONCURRENCY", "4") or "4")
+XUI_RETRIES = int(_get_env("XUI_RETRIES", "3") or "3")
+XUI_BACKOFF_BASE_SECONDS = float(_get_env("XUI_BACKOFF_BASE_SECONDS", "0.5") or "0.5")
+XUI_BACKOFF_MAX_SECONDS = float(_get_env("XUI_BACKOFF_MAX_SECONDS", "8") or "8")
+XUI_BREAKER_THRESHOLD = int(_get_env("XUI_BREAKER_THRESHOLD", "5") or "5")
+XUI_BREAKER_RESET_SECONDS = float(_get_env("XUI_BREAKER_RESET_SECONDS", "30") or "30")
 
 _admin_raw = _get_env("ADMIN_IDS", "")
 ADMIN_IDS = {
@@ -79,6 +93,31 @@ ADMIN_IDS = {
 }
 
 REMINDER_INTERVAL_MINUTES = int(_get_env("REMINDER_INTERVAL_MINUTES", "60") or "60")
+REMINDER_RESYNC_HOURS = float(_get_env("REMINDER_RESYNC_HOURS", "24") or "24")
+REMINDER_SEND_RATE = float(_get_env("REMINDER_SEND_RATE", "25") or "25")
+REMINDER_SEND_CONCURRENCY = int(_get_env("REMINDER_SEND_CONCURRENCY", "10") or "10")
+REMINDER_BATCH_SIZE = int(_get_env("REMINDER_BATCH_SIZE", "200") or "200")
+PROFILE_CACHE_SIZE = int(_get_env("PROFILE_CACHE_SIZE", "10000") or "10000")
+PROFILE_CACHE_TTL_SECONDS = float(_get_env("PROFILE_CACHE_TTL_SECONDS", "300") or "300")
+SUB_CACHE_SIZE = int(_get_env("SUB_CACHE_SIZE", "20000") or "20000")
+SUB_CACHE_SECONDS = float(_get_env("SUB_CACHE_SECONDS", "3600") or "3600")
+SUB_UPDATE_INTERVAL_HOURS = int(_get_env("SUB_UPDATE_INTERVAL_HOURS", "12") or "12")
+LAST_SEEN_FLUSH_SECONDS = float(_get_env("LAST_SEEN_FLUSH_SECONDS", "60") or "60")
+NOTIFY_SEND_RATE = float(_get_env("NOTIFY_SEND_RATE", "25") or "25")
+NOTIFY_CONCURRENCY = int(_get_env("NOTIFY_CONCURRENCY", "8") or "8")
+NOTIFY_QUEUE_SIZE = int(_get_env("NOTIFY_QUEUE_SIZE", "1000") or "1000")
+PAYMENT_WORKERS = int(_get_env("PAYMENT_WORKERS", "4") or "4")
+PAYMENT_MAX_ATTEMPTS = int(_get_env("PAYMENT_MAX_ATTEMPTS", "8") or "8")
+PAYMENT_RETRY_BASE_SECONDS = float(_get_env("PAYMENT_RETRY_BASE_SECONDS", "10") or "10")
+PAYMENT_RETRY_MAX_SECONDS = float(_get_env("PAYMENT_RETRY_MAX_SECONDS", "900") or "900")
+PAYMENT_JOB_LEASE_SECONDS = int(_get_env("PAYMENT_JOB_LEASE_SECONDS", "300") or "300")
+PAYMENT_LEDGER_CACHE_SIZE = int(_get_env("PAYMENT_LEDGER_CACHE_SIZE", "50000") or "50000")
+STORAGE_READ_WORKERS = int(_get_env("STORAGE_READ_WORKERS", "4") or "4")
+CHANGE_FEED_POLL_SECONDS = float(_get_env("CHANGE_FEED_POLL_SECONDS", "1") or "1")
+CHANGE_LOG_RETENTION_SECONDS = int(_get_env("CHANGE_LOG_RETENTION_SECONDS", "3600") or "3600")
+LEADER_LEASE_SECONDS = float(_get_env("LEADER_LEASE_SECONDS", "30") or "30")
+TRAFFIC_POLL_SECONDS = float(_get_env("TRAFFIC_POLL_SECONDS", "60") or "60")
+TRAFFIC_RETENTION_DAYS = int(_get_env("TRAFFIC_RETENTION_DAYS", "400") or "400")
 
 SUPPORT_BOT_TOKEN = _get_env("SUPPORT_BOT_TOKEN", "")
 _support_chat_raw = _get_env("SUPPORT_ADMIN_CHAT_ID", "")
@@ -0,0 +1,142 @@
+"""Coordination between bot processes that share one database.
+
+:class:`ChangeFeed` tails ``change_log`` and replays writes committed by
+other processes to this process's storage listeners, so the profile cache
+and the reminder scheduler see them within a poll interval instead of a TTL
+or resync. :class:`LeaderLease` keeps a task running on exactly one process
+at a time.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import socket
+import time
+from typing import Awaitable, Callable, Optional
+
+from . import storage
+from .async_storage import acquire_lease, last_change_id, prune_changes, read_changes, release_lease
+from .config import CHANGE_FEED_POLL_SECONDS, CHANGE_LOG_RETENTION_SECONDS, LEADER_LEASE_SECONDS
+
+
+RemoteHook = Callable[[str, list[int]], None]
+
+
+class ChangeFeed:
+    def __init__(
+        self,
+        poll_seconds: float = CHANGE_FEED_POLL_SECONDS,
+        retention_seconds: int = CHANGE_LOG_RETENTION_SECONDS,
+        batch_size: int = 1000,
+    ) -> None:
+        self.poll_seconds = poll_seconds
+        self.retention_seconds = retention_seconds
+        self.batch_size = max(1, batch_size)
+        self.applied = 0
+        self._last_id: Optional[int] = None
+        self._hooks: list[RemoteHook] = []
+
+    def subscribe(self, hook: RemoteHook) -> None:
+        """Call ``hook(kind, user_ids)`` for changes made by other processes only."""
+        self._hooks.append(hook)
+
+    async def poll(self) -> int:
+        """Apply the changes logged since the last poll; returns how many were read."""
+        if self._last_id is None:
+            # Nothing is cached yet, so older changes are irrelevant.
+            self._last_id = await last_change_id()
+            return 0
+        rows = await read_changes(self._last_id, self.batch_size)
+        if not rows:
+            return 0
+        self._last_id = rows[-1][0]
+        pid = os.getpid()
+        by_kind: dict[str, list[int]] = {}
+        for _, kind, user_id, origin in rows:
+            if origin != pid:
+                by_kind.setdefault(kind, []).append(user_id)
+        for kind, user_ids in by_kind.items():
+            storage.dispatch_changes(kind, user_ids)
+            for hook in self._hooks:
+                try:
+                    hook(kind, user_ids)
+                except Exception:
+                    logging.exception("Change feed hook failed")
+            self.applied += len(user_ids)
+        return len(rows)
+
+    async def run(self) -> None:
+        next_prune = 0.0
+        while True:
+            try:
+                read = await self.poll()
+            except Exception:
+                logging.exception("Change feed poll failed")
+                read = 0
+            if time.monotonic() >= next_prune:
+                next_prune = time.monotonic() + self.retention_seconds / 10
+                try:
+                    await prune_changes(int(time.time()) - self.retention_seconds)
+                except Exception:
+                    logging.exception("Failed to prune the change log")
+            if read < self.batch_size:
+                await asyncio.sleep(self.poll_seconds)
+
+
+class LeaderLease:
+    """Run ``task()`` only while this process holds the lease ``name``.
+
+    The lease is renewed every third of its TTL. If renewal fails, the task
+    is cancelled before another process can take the lease over; if the
+    holder dies, the lease expires and a standby picks it up.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        task: Callable[[], Awaitable[None]],
+        ttl: float = LEADER_LEASE_SECONDS,
+    ) -> None:
+        self.name = name
+        self.ttl = max(ttl, 3.0)
+        self.holder = f"{socket.gethostname()}:{os.getpid()}"
+        self._task_factory = task
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._task is not None
+
+    async def _stop(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def run(self) -> None:
+        try:
+            while True:
+                try:
+                    held = await acquire_lease(self.name, self.holder, self.ttl)
+                except Exception:
+                    logging.exception("Failed to renew lease %s", self.name)
+                    held = False
+                if held and self._task is not None and self._task.done():
+                    if not self._task.cancelled() and self._task.exception():
+                        logging.error("Leader task %s crashed, restarting", self.name, exc_info=self._task.exception())
+                    self._task = None
+                if held and self._task is None:
+                    logging.info("Acquired lease %s as %s", self.name, self.holder)
+                    self._task = asyncio.create_task(self._task_factory())
+                elif not held and self._task is not None:
+                    logging.warning("Lost lease %s, stopping its task", self.name)
+                    await self._stop()
+                await asyncio.sleep(self.ttl / 3)
+        finally:
+            if self._task is not None:
+                await self._stop()
+                try:
+                    await release_lease(self.name, self.holder)
+                except Exception:
+                    logging.exception("Failed to release lease %s", self.name)
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import asyncio
 from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
 import uuid
@@ -8,177 +9,299 @@ from typing import Optional
 import logging
 
 from .config import (
-    XUI_BASE_URL,
-    XUI_USERNAME,
-    XUI_PASSWORD,
-    XUI_API_PATH,
-    XUI_INBOUND_IDS,
-    XUI_INBOUND_ID,
     XUI_FLOW,
     XUI_TOTAL_GB,
     XUI_LIMIT_IP,
-    XUI_PUBLIC_HOST,
-    XUI_PUBLIC_PORT,
-    XUI_SUB_BASE_URL,
-    XUI_SSL_VERIFY,
+    XUI_CONCURRENCY,
 )
 from .data import PLAN_DAYS
-from .storage import set_subscription, set_user_key
+from .async_storage import (
+    get_subscription,
+    get_user_client,
+    restore_archived,
+    set_subscription,
+    set_user_key,
+)
+from .panels import Panel, registry
+from .storage import SubscriptionInfo
 from .xui_api import XuiApi, XuiInbound, XuiKey, build_sub_url, build_vless_uri
 
 
-_xui_client: Optional[XuiApi] = None
-
-
-def _parse_inbound_id(value: str) -> Optional[int]:
-    return int(value) if value.strip().isdigit() else None
-
-
-def _parse_inbound_ids() -> list[int]:
-    ids: list[int] = []
-    raw = XUI_INBOUND_IDS.strip()
-    if raw:
-        for part in raw.split(","):
-            value = part.strip()
-            if value.isdigit():
-                ids.append(int(value))
-    if not ids:
-        inbound_id = _parse_inbound_id(XUI_INBOUND_ID)
-        if inbound_id is not None:
-            ids.append(inbound_id)
-    seen: set[int] = set()
-    result: list[int] = []
-    for inbound_id in ids:
-        if inbound_id in seen:
-            continue
-        seen.add(inbound_id)
-        result.append(inbound_id)
-    return result
-
-
-def _public_port() -> Optional[int]:
-    if not XUI_PUBLIC_PORT:
+async def ensure_xui(panel: Optional[Panel] = None) -> Optional[XuiApi]:
+    """Client for ``panel``, or for the primary panel; ``None`` if none is configured."""
+    panel = panel or registry.primary
+    if not panel:
         return None
-    if XUI_PUBLIC_PORT.strip().isdigit():
-        return int(XUI_PUBLIC_PORT.strip())
-    return None
+    return registry.client(panel)
 
 
-def _public_host() -> str:
-    if XUI_PUBLIC_HOST:
-        return XUI_PUBLIC_HOST
-    if XUI_BASE_URL.startswith("http"):
-        return XUI_BASE_URL.split("://", 1)[1].split(":", 1)[0]
-    return ""
+def client_settings(
+    user_id: int,
+    client_id: str,
+    email: str,
+    sub_id: str,
+    expiry_ms: int,
+    flow: str = "",
+) -> dict:
+    """Client payload for the panel, shared by single issues and bulk migrations."""
+    settings = {
+        "id": client_id,
+        "email": email,
+        "limitIp": XUI_LIMIT_IP,
+        "totalGB": XUI_TOTAL_GB,
+        "expiryTime": expiry_ms,
+        "enable": True,
+        "flow": flow or None,
+        "tgId": str(user_id),
+        "subId": sub_id,
+    }
+    return {k: v for k, v in settings.items() if v is not None}
 
 
-async def ensure_xui() -> Optional[XuiApi]:
-    global _xui_client
-    if _xui_client:
-        return _xui_client
-    if not (XUI_BASE_URL and XUI_USERNAME and XUI_PASSWORD):
-        return None
-    _xui_client = XuiApi(
-        XUI_BASE_URL,
-        XUI_USERNAME,
-        XUI_PASSWORD,
-        api_path=XUI_API_PATH or "/panel/api",
-        verify_ssl=XUI_SSL_VERIFY,
+def build_key(
+    panel: Panel,
+    inbound: XuiInbound,
+    client_id: str,
+    email: str,
+    sub_id: str,
+    flow: str = "",
+) -> XuiKey:
+    vless_uri = build_vless_uri(
+        inbound,
+        client_id,
+        email,
+        host=panel.host,
+        flow=flow,
+        public_port=panel.public_port,
     )
-    return _xui_client
+    sub_url = build_sub_url(panel.sub_base, sub_id)
+    return XuiKey(vless_uri=vless_uri, sub_url=sub_url, client_id=client_id, email=email, sub_id=sub_id)
+
+
+def _renewal_base(existing: Optional[dict], subscription: Optional[SubscriptionInfo]) -> datetime:
+    """Start of the new paid period: renewals stack on time the user still has."""
+    now = datetime.now(timezone.utc)
+    candidates = [now]
+    if subscription and subscription.expires_at:
+        stored = datetime.fromisoformat(subscription.expires_at)
+        candidates.append(stored if stored.tzinfo else stored.replace(tzinfo=timezone.utc))
+    # 0 means unlimited and negative values count from first use; neither
+    # is a date to extend from.
+    expiry_ms = int((existing or {}).get("expiryTime") or 0)
+    if expiry_ms > 0:
+        candidates.append(datetime.fromtimestamp(expiry_ms / 1000, tz=timezone.utc))
+    return max(candidates)
+
+
+def _find_existing_client(inbound: XuiInbound, user_id: int) -> Optional[dict]:
+    return inbound.find_client(email=f"tg_{user_id}", tg_id=str(user_id))
+
+
+@dataclass
+class InboundResult:
+    inbound_id: int
+    client_id: str
+    created: bool
+    previous: Optional[dict] = None
+    error: str = ""
+
+    @property
+    def ok(self) -> bool:
+        return not self.error
+
+
+async def _gather_limited(coros: list, limit: int) -> list:
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*(run(coro) for coro in coros))
+
+
+async def _fetch_inbounds(
+    xui: XuiApi,
+    inbound_ids: list[int],
+    fresh: bool = False,
+) -> list[tuple[int, XuiInbound]]:
+    async def fetch(inbound_id: int) -> Optional[XuiInbound]:
+        try:
+            return await xui.get_inbound(inbound_id, fresh=fresh)
+        except Exception:
+            logging.exception("Failed to fetch inbound %s", inbound_id)
+            return None
+
+    inbounds = await _gather_limited([fetch(i) for i in inbound_ids], XUI_CONCURRENCY)
+    rows: list[tuple[int, XuiInbound]] = []
+    for inbound_id, inbound in zip(inbound_ids, inbounds):
+        if inbound:
+            rows.append((inbound_id, inbound))
+        else:
+            logging.warning("Inbound %s not found", inbound_id)
+    return rows
+
+
+async def _upsert_client(
+    xui: XuiApi,
+    inbound_id: int,
+    inbound: XuiInbound,
+    user_id: int,
+    settings: dict,
+) -> InboundResult:
+    existing = _find_existing_client(inbound, user_id)
+    client_id = existing.get("id") if existing else settings["id"]
+    payload = dict(settings)
+    payload["id"] = client_id
+    result = InboundResult(inbound_id, client_id, created=not existing, previous=existing)
+    try:
+        if existing:
+            response = await xui.update_client(existing.get("id") or client_id, inbound_id, payload)
+        else:
+            response = await xui.add_client(inbound_id, payload)
+        if not response.get("success"):
+            result.error = f"XUI error: {response}"
+    except Exception as exc:
+        result.error = f"{type(exc).__name__}: {exc}"
+    return result
+
 
+async def _rollback(xui: XuiApi, results: list[InboundResult]) -> list[str]:
+    """Undo the inbounds that succeeded; returns the ones that could not be undone."""
 
-def _find_existing_client(clients: list[dict], user_id: int) -> Optional[dict]:
-    target_email = f"tg_{user_id}"
-    for client in clients:
-        if client.get("email") == target_email:
-            return client
-        if str(client.get("tgId", "")) == str(user_id):
-            return client
-    return None
+    async def undo(result: InboundResult) -> Optional[str]:
+        try:
+            if result.created:
+                response = await xui.delete_client(result.inbound_id, result.client_id)
+            else:
+                response = await xui.update_client(result.client_id, result.inbound_id, result.previous or {})
+            if response.get("success"):
+                return None
+            return f"{result.inbound_id}: {response}"
+        except Exception as exc:
+            return f"{result.inbound_id}: {exc}"
 
+    done = [result for result in results if result.ok]
+    failures = await _gather_limited([undo(result) for result in done], XUI_CONCURRENCY)
+    return [failure for failure in failures if failure]
 
-async def list_inbounds() -> list[dict]:
-    xui = await ensure_xui()
+
+async def list_inbounds(panel: Optional[Panel] = None) -> list[dict]:
+    xui = await ensure_xui(panel)
     if not xui:
         return []
     return await xui.list_inbounds()
 
 
-async def issue_access(user_id: int, plan_code: str) -> XuiKey:
+async def _target_panel(user_id: int) -> tuple[Panel, XuiApi]:
+    if not registry.panels:
+        raise RuntimeError("XUI is not configured")
+    if await restore_archived(user_id):
+        logging.info("Restored archived subscription of user %s", user_id)
+    panel = await registry.resolve(user_id)
+    if not panel.inbound_ids:
+        raise RuntimeError(f"No inbound ids configured for panel {panel.name}")
+    return panel, registry.client(panel)
+
+
+def _plan_days(plan_code: str) -> int:
     days = PLAN_DAYS.get(plan_code)
     if not days:
         raise RuntimeError("Invalid plan code")
+    return days
 
-    inbound_ids = _parse_inbound_ids()
-    if not inbound_ids:
-        raise RuntimeError("XUI_INBOUND_ID/XUI_INBOUND_IDS is missing")
 
-    xui = await ensure_xui()
-    if not xui:
-        raise RuntimeError("XUI is not configured")
+async def _expiry_after(xui: XuiApi, panel: Panel, user_id: int, days: int, fresh: bool) -> datetime:
+    existing = None
+    for _, inbound in await _fetch_inbounds(xui, list(panel.inbound_ids), fresh=fresh):
+        existing = _find_existing_client(inbound, user_id)
+        if existing:
+            break
+    return _renewal_base(existing, await get_subscription(user_id)) + timedelta(days=days)
 
-    inbound_rows: list[tuple[int, XuiInbound]] = []
-    for inbound_id in inbound_ids:
-        inbound = await xui.get_inbound(inbound_id)
-        if inbound:
-            inbound_rows.append((inbound_id, inbound))
-        else:
-            logging.warning("Inbound %s not found", inbound_id)
+
+async def renewal_expiry(user_id: int, plan_code: str) -> datetime:
+    """When the user's access ends after paying for ``plan_code`` now.
+
+    Derived from the current state, so it must be computed once per
+    payment: after the payment is issued it already includes its days.
+    """
+    days = _plan_days(plan_code)
+    panel, xui = await _target_panel(user_id)
+    # Fresh, so a client added outside the bot still counts its time.
+    return await _expiry_after(xui, panel, user_id, days, fresh=True)
+
+
+async def issue_access(user_id: int, plan_code: str, expires: Optional[datetime] = None) -> XuiKey:
+    """Provision the user's clients and key so access ends at ``expires``.
+
+    Without ``expires`` the date is derived like :func:`renewal_expiry`.
+    Callers that may run again for the same payment (the payment queue)
+    must fix the date first and pass it, or each run adds the days again.
+    """
+    days = _plan_days(plan_code)
+    panel, xui = await _target_panel(user_id)
+    if expires is None:
+        expires = await _expiry_after(xui, panel, user_id, days, fresh=False)
+
+    try:
+        return await _issue(xui, panel, user_id, plan_code, expires, fresh=False)
+    except RuntimeError:
+        if xui.inbound_ttl <= 0 or xui.breaker.state != "closed":
+            raise
+        # The cached snapshot may miss clients created outside the bot.
+        logging.warning("Retrying issue for %s with fresh inbound data", user_id)
+        return await _issue(xui, panel, user_id, plan_code, expires, fresh=True)
+
+
+async def _issue(
+    xui: XuiApi,
+    panel: Panel,
+    user_id: int,
+    plan_code: str,
+    expires: datetime,
+    fresh: bool,
+) -> XuiKey:
+    inbound_rows = await _fetch_inbounds(xui, list(panel.inbound_ids), fresh=fresh)
     if not inbound_rows:
         raise RuntimeError("No valid inbounds found")
 
     existing = None
     for _, inbound in inbound_rows:
-        existing = _find_existing_client(inbound.clients, user_id)
+        existing = _find_existing_client(inbound, user_id)
         if existing:
             break
-    expires = datetime.now(timezone.utc) + timedelta(days=days)
     expiry_ms = int(expires.timestamp() * 1000)
 
-    primary_client_id = existing.get("id") if existing else str(uuid.uuid4())
-    email = existing.get("email") if existing else f"tg_{user_id}"
-    sub_id = existing.get("subId") if existing else uuid.uuid4().hex[:16]
+    if existing:
+        primary_client_id, email, sub_id = existing.get("id"), existing.get("email"), existing.get("subId")
+    else:
+        # A stored (e.g. just restored) key whose client was removed from
+        # the panel keeps its ids, so the user's old links work again.
+        primary_client_id, email, sub_id = await get_user_client(user_id) or ("", "", "")
+        primary_client_id = primary_client_id or str(uuid.uuid4())
+        email = email or f"tg_{user_id}"
+        sub_id = sub_id or uuid.uuid4().hex[:16]
     flow = XUI_FLOW or (existing.get("flow") if existing else "")
-    settings = {
-        "id": primary_client_id,
-        "email": email,
-        "limitIp": XUI_LIMIT_IP,
-        "totalGB": XUI_TOTAL_GB,
-        "expiryTime": expiry_ms,
-        "enable": True,
-        "flow": flow or None,
-        "tgId": str(user_id),
-        "subId": sub_id,
-    }
-    settings = {k: v for k, v in settings.items() if v is not None}
-
-    for inbound_id, inbound in inbound_rows:
-        existing_inbound = _find_existing_client(inbound.clients, user_id)
-        client_id = existing_inbound.get("id") if existing_inbound else primary_client_id
-        payload = dict(settings)
-        payload["id"] = client_id
-        if existing_inbound:
-            update_id = existing_inbound.get("id") or client_id
-            result = await xui.update_client(update_id, inbound_id, payload)
-        else:
-            result = await xui.add_client(inbound_id, payload)
-        if not result.get("success"):
-            raise RuntimeError(f"XUI error: {result}")
+    settings = client_settings(user_id, primary_client_id, email, sub_id, expiry_ms, flow)
 
-    host = _public_host()
-    port = _public_port()
-    primary_inbound = inbound_rows[0][1]
-    vless_uri = build_vless_uri(
-        primary_inbound,
-        primary_client_id,
-        email,
-        host=host,
-        flow=flow,
-        public_port=port,
+    results = await _gather_limited(
+        [
+            _upsert_client(xui, inbound_id, inbound, user_id, settings)
+            for inbound_id, inbound in inbound_rows
+        ],
+        XUI_CONCURRENCY,
     )
-    sub_base = XUI_SUB_BASE_URL or XUI_BASE_URL
-    sub_url = build_sub_url(sub_base, sub_id)
-    set_user_key(user_id, vless_uri, sub_url, primary_client_id, email, sub_id)
-    set_subscription(user_id, expires.isoformat(timespec="seconds"), plan_code=plan_code)
-    return XuiKey(vless_uri=vless_uri, sub_url=sub_url, client_id=primary_client_id, email=email, sub_id=sub_id)
+    errors = [f"{r.inbound_id}: {r.error}" for r in results if not r.ok]
+    if errors:
+        not_undone = await _rollback(xui, results)
+        message = "; ".join(errors)
+        if not_undone:
+            logging.error("Rollback incomplete for user %s: %s", user_id, not_undone)
+            message += f" (rollback failed: {'; '.join(not_undone)})"
+        raise RuntimeError(f"XUI error on inbound(s) {message}")
+
+    key = build_key(panel, inbound_rows[0][1], primary_client_id, email, sub_id, flow)
+    await set_user_key(user_id, key.vless_uri, key.sub_url, key.client_id, key.email, key.sub_id)
+    await set_subscription(user_id, expires.isoformat(timespec="seconds"), plan_code=plan_code)
+    return key
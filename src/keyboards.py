@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+from functools import lru_cache
+
 from aiogram.types import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
@@ -11,6 +13,13 @@ from .config import CHANNEL, CHECK_URL, RENEW_URL, SUPPORT_BOT
 from .data import DEVICES_EN, DEVICES_RU, PLANS
 
 
+# Keyboards only depend on their arguments and aiogram types are frozen, so
+# each (lang, params) combination is built once and shared. Keyboards keyed
+# by a per-user URL get a bounded cache.
+_per_lang = lru_cache(maxsize=None)
+_per_url = lru_cache(maxsize=4096)
+
+
 def _tg_url(handle: str) -> str:
     value = (handle or "").strip()
     if not value:
@@ -29,6 +38,7 @@ def _check_button(lang: str) -> list[InlineKeyboardButton]:
     return [InlineKeyboardButton(text=text, url=CHECK_URL)]
 
 
+@_per_lang
 def main_menu_kb(lang: str) -> ReplyKeyboardMarkup:
     if lang == "en":
         buttons = [
@@ -48,6 +58,7 @@ def main_menu_kb(lang: str) -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
 
 
+@_per_lang
 def device_kb(lang: str) -> InlineKeyboardMarkup:
     rows = []
     devices = DEVICES_EN if lang == "en" else DEVICES_RU
@@ -62,6 +73,7 @@ def device_kb(lang: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
+@_per_lang
 def other_devices_kb(lang: str) -> InlineKeyboardMarkup:
     text = "Other devices" if lang == "en" else "Другие устройства"
     return InlineKeyboardMarkup(
@@ -69,6 +81,7 @@ def other_devices_kb(lang: str) -> InlineKeyboardMarkup:
     )
 
 
+@_per_lang
 def help_device_kb(lang: str) -> InlineKeyboardMarkup:
     rows = []
     devices = DEVICES_EN if lang == "en" else DEVICES_RU
@@ -88,6 +101,7 @@ def help_device_kb(lang: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
+@_per_url
 def android_actions_kb(lang: str, one_click_url: str) -> InlineKeyboardMarkup:
     check_button = _check_button(lang)
     if lang == "en":
@@ -111,6 +125,7 @@ def android_actions_kb(lang: str, one_click_url: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
+@_per_url
 def ios_actions_kb(lang: str, one_click_url: str) -> InlineKeyboardMarkup:
     check_button = _check_button(lang)
     if lang == "en":
@@ -132,6 +147,7 @@ def ios_actions_kb(lang: str, one_click_url: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
+@_per_url
 def desktop_actions_kb(lang: str, one_click_url: str) -> InlineKeyboardMarkup:
     check_button = _check_button(lang)
     if lang == "en":
@@ -153,6 +169,7 @@ def desktop_actions_kb(lang: str, one_click_url: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
+@_per_url
 def macos_actions_kb(
     lang: str,
     one_click_url: str,
@@ -190,6 +207,7 @@ def macos_actions_kb(
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
+@_per_lang
 def android_tv_actions_kb(lang: str) -> InlineKeyboardMarkup:
     if lang == "en":
         rows = [
@@ -206,6 +224,7 @@ def android_tv_actions_kb(lang: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
+@_per_url
 def apple_tv_actions_kb(lang: str, singbox_url: str) -> InlineKeyboardMarkup:
     if lang == "en":
         rows = []
@@ -230,6 +249,7 @@ def apple_tv_actions_kb(lang: str, singbox_url: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
+@_per_url
 def v2ray_actions_kb(lang: str, v2ray_url: str) -> InlineKeyboardMarkup:
     check_button = _check_button(lang)
     if lang == "en":
@@ -249,6 +269,7 @@ def v2ray_actions_kb(lang: str, v2ray_url: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
+@_per_lang
 def plans_kb(lang: str, include_menu: bool = False) -> InlineKeyboardMarkup:
     rows = []
     for plan in PLANS:
@@ -265,6 +286,7 @@ def plans_kb(lang: str, include_menu: bool = False) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
+@_per_lang
 def faq_kb(lang: str) -> InlineKeyboardMarkup:
     if lang == "en":
         rows = [
@@ -287,6 +309,7 @@ def faq_kb(lang: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
+@_per_lang
 def renew_kb(lang: str) -> InlineKeyboardMarkup:
     text = "Renew" if lang == "en" else "Продлить"
     if RENEW_URL:
@@ -298,6 +321,7 @@ def renew_kb(lang: str) -> InlineKeyboardMarkup:
     )
 
 
+@_per_lang
 def support_kb(lang: str) -> InlineKeyboardMarkup | None:
     url = _tg_url(SUPPORT_BOT)
     if not url:
@@ -308,6 +332,7 @@ def support_kb(lang: str) -> InlineKeyboardMarkup | None:
     )
 
 
+@_per_lang
 def channel_kb(lang: str) -> InlineKeyboardMarkup | None:
     url = _tg_url(CHANNEL)
     if not url:
@@ -318,6 +343,7 @@ def channel_kb(lang: str) -> InlineKeyboardMarkup | None:
     )
 
 
+@_per_url
 def profile_actions_kb(
     lang: str,
     sub_url: str,
@@ -1,9 +1,14 @@
 import asyncio
 from datetime import datetime, timedelta, timezone
+import functools
+import hashlib
 import logging
 from html import escape as html_escape
-from typing import Dict, Optional
-from urllib.parse import quote
+import time
+from typing import Optional
+from urllib.parse import quote, urlparse
+
+from aiohttp import web
 
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.exceptions import TelegramBadRequest
@@ -12,7 +17,10 @@ from aiogram.types import Message, CallbackQuery, InputMediaPhoto
 
 from .config import (
     BOT_TOKEN,
+    BOT_UPDATE_WORKERS,
     BOT_USERNAME,
+    BOT_WEBHOOK_SECRET,
+    BOT_WEBHOOK_URL,
     BRAND_NAME,
     DEEPLINK_REDIRECT_URL,
     ONE_CLICK_URL,
@@ -32,6 +40,11 @@ from .config import (
     SUBSCRIPTION_URL,
     ADMIN_IDS,
     REMINDER_INTERVAL_MINUTES,
+    REMINDER_RESYNC_HOURS,
+    REMINDER_SEND_RATE,
+    REMINDER_SEND_CONCURRENCY,
+    REMINDER_BATCH_SIZE,
+    TRAFFIC_POLL_SECONDS,
     XUI_LIMIT_IP,
 )
 from .keyboards import (
@@ -55,23 +68,34 @@ from .keyboards import (
 )
 from .texts import t
 from .data import DEVICES_RU, DEVICES_EN, PLAN_DAYS, PLANS
-from .media import asset_file
-from .storage import (
+from .media import media_registry
+from . import async_storage, webhook
+from .async_storage import (
+    count_panel_users,
+    count_payment_jobs,
+    get_traffic_used,
     init_db,
-    list_due_reminders,
-    mark_reminded,
-    set_status_expired,
+    list_dead_payment_jobs,
+    list_traffic_clients,
+    mark_reminded_many,
+    requeue_payment_job,
+    set_status_expired_many,
     set_subscription,
-    upsert_user,
-    get_user_key as get_user_key_from_db,
-    get_subscription,
-    get_user_lang,
+    top_traffic,
+    traffic_summary,
 )
+from .coordination import ChangeFeed, LeaderLease
 from .issue import issue_access, list_inbounds
+from .panels import LEGACY_PANEL, registry as panel_registry
+from .profile_cache import profiles
+from .reminders import ReminderScheduler
+from .sender import SendJob, SendScheduler
+from .storage import Reminder
+from .subscriptions import documents as sub_documents
+from .traffic import TrafficPoller
 
 
 router = Router()
-user_lang: Dict[int, str] = {}
 logging.basicConfig(level=logging.INFO)
 
 
@@ -170,19 +194,21 @@ def happ_ios_alt_suffix(lang: str) -> str:
     return f" (Happ для других регионов {HAPP_IOS_ALT_URL})"
 
 
-def get_lang(user_id: int) -> str:
-    if user_id not in user_lang:
-        user_lang[user_id] = get_user_lang(user_id)
-    return user_lang.get(user_id, "ru")
+async def get_lang(user_id: int) -> str:
+    return await profiles.get_lang(user_id)
+
+
+async def set_lang(user_id: int, lang: str) -> None:
+    await profiles.set_lang(user_id, lang)
 
 
-def set_lang(user_id: int, lang: str) -> None:
-    user_lang[user_id] = lang
-    upsert_user(user_id, lang)
+async def get_stored_key(user_id: int) -> tuple[str, str]:
+    profile = await profiles.get(user_id)
+    return profile.vless_uri, profile.sub_url
 
 
-def get_user_key(user_id: int) -> tuple[str, str]:
-    stored_key, stored_sub = get_user_key_from_db(user_id)
+async def get_user_key(user_id: int) -> tuple[str, str]:
+    stored_key, stored_sub = await get_stored_key(user_id)
     key = stored_key or DEFAULT_KEY
     sub = stored_sub or SUBSCRIPTION_URL
     return key, sub
@@ -222,15 +248,45 @@ def format_limit(lang: str) -> str:
     return str(XUI_LIMIT_IP)
 
 
+def format_bytes(value: int) -> str:
+    return f"{value / 1e9:.1f} GB"
+
+
+def format_traffic(lang: str, used: int) -> str:
+    period = "за 30 дней" if lang != "en" else "in 30 days"
+    return f"{format_bytes(used)} {period}"
+
+
+async def answer_asset(
+    message: Message,
+    key: str,
+    caption: Optional[str] = None,
+    reply_markup=None,
+) -> bool:
+    bot_id = message.bot.id
+    asset = await media_registry.resolve(bot_id, key)
+    if not asset:
+        return False
+    try:
+        sent = await message.answer_photo(asset.media, caption=caption, reply_markup=reply_markup)
+    except TelegramBadRequest:
+        if not asset.cached:
+            raise
+        # The stored file_id is no longer valid for this bot; upload again.
+        await media_registry.forget(bot_id, asset)
+        asset = await media_registry.resolve(bot_id, key)
+        sent = await message.answer_photo(asset.media, caption=caption, reply_markup=reply_markup)
+    await media_registry.remember(bot_id, asset, sent)
+    return True
+
+
 async def send_asset(
     message: Message,
     key: str,
     caption: Optional[str] = None,
     reply_markup=None,
 ) -> None:
-    asset = asset_file(key)
-    if asset:
-        await message.answer_photo(asset, caption=caption, reply_markup=reply_markup)
+    if await answer_asset(message, key, caption, reply_markup=reply_markup):
         return
     if caption:
         await message.answer(caption, reply_markup=reply_markup)
@@ -242,19 +298,31 @@ async def edit_asset_message(
     caption: str,
     reply_markup=None,
 ) -> None:
-    asset = asset_file(key)
+    bot_id = message.bot.id
     try:
         if message.photo:
+            asset = await media_registry.resolve(bot_id, key)
             if asset:
-                await message.edit_media(
-                    InputMediaPhoto(media=asset, caption=caption),
-                    reply_markup=reply_markup,
-                )
+                try:
+                    edited = await message.edit_media(
+                        InputMediaPhoto(media=asset.media, caption=caption),
+                        reply_markup=reply_markup,
+                    )
+                except TelegramBadRequest as exc:
+                    if not asset.cached or "message is not modified" in str(exc):
+                        raise
+                    # The stored file_id is no longer valid for this bot; upload again.
+                    await media_registry.forget(bot_id, asset)
+                    asset = await media_registry.resolve(bot_id, key)
+                    edited = await message.edit_media(
+                        InputMediaPhoto(media=asset.media, caption=caption),
+                        reply_markup=reply_markup,
+                    )
+                await media_registry.remember(bot_id, asset, edited)
             else:
                 await message.edit_caption(caption=caption, reply_markup=reply_markup)
             return
-        if asset:
-            await message.answer_photo(asset, caption=caption, reply_markup=reply_markup)
+        if await answer_asset(message, key, caption, reply_markup=reply_markup):
             return
         await message.edit_text(caption, reply_markup=reply_markup)
     except TelegramBadRequest as exc:
@@ -290,22 +358,22 @@ async def edit_text_message(
 
 @router.message(CommandStart())
 async def cmd_start(message: Message) -> None:
-    lang = get_lang(message.from_user.id)
-    upsert_user(message.from_user.id, lang)
+    lang = await get_lang(message.from_user.id)
+    await profiles.touch(message.from_user.id, lang)
     await message.answer(t(lang, "welcome_text"), reply_markup=main_menu_kb(lang))
     await message.answer(t(lang, "device_prompt"), reply_markup=device_kb(lang))
 
 
 @router.message(F.text.in_(["Установить VPN", "Install VPN"]))
 async def install_vpn(message: Message) -> None:
-    lang = get_lang(message.from_user.id)
+    lang = await get_lang(message.from_user.id)
     await message.answer(t(lang, "device_prompt"), reply_markup=device_kb(lang))
 
 
 @router.message(F.text.in_(["Тарифы", "Plans"]))
 async def show_tariffs(message: Message) -> None:
-    lang = get_lang(message.from_user.id)
-    upsert_user(message.from_user.id, lang)
+    lang = await get_lang(message.from_user.id)
+    await profiles.touch(message.from_user.id, lang)
     await send_asset(message, "pro", t(lang, "pro_features"))
     await send_asset(
         message,
@@ -317,21 +385,22 @@ async def show_tariffs(message: Message) -> None:
 
 @router.message(F.text.in_(["Профиль", "Profile"]))
 async def show_profile(message: Message) -> None:
-    lang = get_lang(message.from_user.id)
-    upsert_user(message.from_user.id, lang)
-    stored_key, stored_sub = get_user_key_from_db(message.from_user.id)
+    lang = await get_lang(message.from_user.id)
+    await profiles.touch(message.from_user.id, lang)
+    stored_key, stored_sub = await get_stored_key(message.from_user.id)
     if not stored_key:
         await message.answer(t(lang, "profile_empty"), reply_markup=plans_kb(lang))
         return
-    subscription = get_subscription(message.from_user.id)
+    subscription = (await profiles.get(message.from_user.id)).subscription
     plan = format_plan(lang, subscription.plan_code if subscription else "")
     expires_at = format_expires(subscription.expires_at if subscription else "")
+    up, down = await get_traffic_used(message.from_user.id, int(time.time()) - 30 * 86400)
     await message.answer(
         t(
             lang,
             "profile",
             key=stored_key,
-            traffic="0.0 GB",
+            traffic=format_traffic(lang, up + down),
             expires=expires_at,
             plan=plan,
             limit=format_limit(lang),
@@ -346,15 +415,15 @@ async def show_profile(message: Message) -> None:
 
 @router.message(F.text.in_(["Вопросы", "Questions"]))
 async def show_faq(message: Message) -> None:
-    lang = get_lang(message.from_user.id)
-    upsert_user(message.from_user.id, lang)
+    lang = await get_lang(message.from_user.id)
+    await profiles.touch(message.from_user.id, lang)
     await message.answer(t(lang, "faq_main"), reply_markup=faq_kb(lang))
 
 
 @router.message(F.text.in_(["Пригласить друга", "Invite a friend"]))
 async def invite_friend(message: Message) -> None:
-    lang = get_lang(message.from_user.id)
-    upsert_user(message.from_user.id, lang)
+    lang = await get_lang(message.from_user.id)
+    await profiles.touch(message.from_user.id, lang)
     await send_asset(message, "referral", t(lang, "referral_banner"))
     await message.answer(
         t(lang, "invite_friend", ref_link=ref_link(message.from_user.id))
@@ -363,8 +432,8 @@ async def invite_friend(message: Message) -> None:
 
 @router.message(F.text.in_(["Поддержка", "Support"]))
 async def show_support(message: Message) -> None:
-    lang = get_lang(message.from_user.id)
-    upsert_user(message.from_user.id, lang)
+    lang = await get_lang(message.from_user.id)
+    await profiles.touch(message.from_user.id, lang)
     await send_asset(
         message,
         "support",
@@ -375,8 +444,8 @@ async def show_support(message: Message) -> None:
 
 @router.message(F.text.in_(["Канал", "Channel"]))
 async def show_channel(message: Message) -> None:
-    lang = get_lang(message.from_user.id)
-    upsert_user(message.from_user.id, lang)
+    lang = await get_lang(message.from_user.id)
+    await profiles.touch(message.from_user.id, lang)
     await send_asset(
         message,
         "channel",
@@ -387,20 +456,20 @@ async def show_channel(message: Message) -> None:
 
 @router.message(F.text == "Switch to English")
 async def switch_to_english(message: Message) -> None:
-    set_lang(message.from_user.id, "en")
+    await set_lang(message.from_user.id, "en")
     await message.answer(t("en", "lang_switched"), reply_markup=main_menu_kb("en"))
 
 
 @router.message(F.text == "Switch to Russian")
 async def switch_to_russian(message: Message) -> None:
-    set_lang(message.from_user.id, "ru")
+    await set_lang(message.from_user.id, "ru")
     await message.answer(t("ru", "lang_switched"), reply_markup=main_menu_kb("ru"))
 
 
 @router.callback_query(F.data == "menu")
 async def cb_menu(callback: CallbackQuery) -> None:
-    lang = get_lang(callback.from_user.id)
-    upsert_user(callback.from_user.id, lang)
+    lang = await get_lang(callback.from_user.id)
+    await profiles.touch(callback.from_user.id, lang)
     await edit_text_message(
         callback.message,
         t(lang, "device_prompt"),
@@ -411,10 +480,10 @@ async def cb_menu(callback: CallbackQuery) -> None:
 
 @router.callback_query(F.data.startswith("device:"))
 async def cb_device(callback: CallbackQuery) -> None:
-    lang = get_lang(callback.from_user.id)
-    upsert_user(callback.from_user.id, lang)
+    lang = await get_lang(callback.from_user.id)
+    await profiles.touch(callback.from_user.id, lang)
     code = callback.data.split(":", 1)[1]
-    stored_key, stored_sub = get_user_key_from_db(callback.from_user.id)
+    stored_key, stored_sub = await get_stored_key(callback.from_user.id)
     if not stored_key:
         await edit_text_message(
             callback.message,
@@ -446,6 +515,7 @@ async def cb_device(callback: CallbackQuery) -> None:
         text = t(
             lang,
             "android_setup",
+            key=key,
             key_link=key_link,
             happ_gp=happ_gp,
             happ_apk=happ_apk,
@@ -461,6 +531,7 @@ async def cb_device(callback: CallbackQuery) -> None:
         text = t(
             lang,
             "ios_setup",
+            key=key,
             key_link=key_link,
             happ_ios_ru=happ_ios_ru,
             happ_ios_alt=happ_ios_alt,
@@ -490,6 +561,7 @@ async def cb_device(callback: CallbackQuery) -> None:
         text = t(
             lang,
             "macos_setup",
+            key=key,
             key_link=key_link,
             happ_ios_ru=happ_ios_ru,
             happ_ios_alt=happ_ios_alt,
@@ -554,9 +626,9 @@ async def cb_device(callback: CallbackQuery) -> None:
 
 @router.callback_query(F.data == "android:v2ray")
 async def cb_android_v2ray(callback: CallbackQuery) -> None:
-    lang = get_lang(callback.from_user.id)
-    upsert_user(callback.from_user.id, lang)
-    stored_key, stored_sub = get_user_key_from_db(callback.from_user.id)
+    lang = await get_lang(callback.from_user.id)
+    await profiles.touch(callback.from_user.id, lang)
+    stored_key, stored_sub = await get_stored_key(callback.from_user.id)
     if not stored_key:
         await edit_text_message(
             callback.message,
@@ -578,6 +650,7 @@ async def cb_android_v2ray(callback: CallbackQuery) -> None:
         t(
             lang,
             "android_v2ray",
+            key=sub_url,
             sub_url_link=sub_url_link,
             v2ray_gp=v2ray_gp,
             v2ray_apk=v2ray_apk,
@@ -592,8 +665,8 @@ async def cb_android_v2ray(callback: CallbackQuery) -> None:
 
 @router.callback_query(F.data.startswith("faq:"))
 async def cb_faq(callback: CallbackQuery) -> None:
-    lang = get_lang(callback.from_user.id)
-    upsert_user(callback.from_user.id, lang)
+    lang = await get_lang(callback.from_user.id)
+    await profiles.touch(callback.from_user.id, lang)
     code = callback.data.split(":", 1)[1]
     if code == "broken":
         await callback.message.answer(t(lang, "faq_broken"))
@@ -612,8 +685,8 @@ async def cb_faq(callback: CallbackQuery) -> None:
 
 @router.callback_query(F.data == "tariffs")
 async def cb_tariffs(callback: CallbackQuery) -> None:
-    lang = get_lang(callback.from_user.id)
-    upsert_user(callback.from_user.id, lang)
+    lang = await get_lang(callback.from_user.id)
+    await profiles.touch(callback.from_user.id, lang)
     await send_asset(callback.message, "pro", t(lang, "pro_features"))
     await send_asset(
         callback.message,
@@ -626,9 +699,9 @@ async def cb_tariffs(callback: CallbackQuery) -> None:
 
 @router.callback_query(F.data == "profile:resend")
 async def cb_profile_resend(callback: CallbackQuery) -> None:
-    lang = get_lang(callback.from_user.id)
-    upsert_user(callback.from_user.id, lang)
-    stored_key, stored_sub = get_user_key_from_db(callback.from_user.id)
+    lang = await get_lang(callback.from_user.id)
+    await profiles.touch(callback.from_user.id, lang)
+    stored_key, stored_sub = await get_stored_key(callback.from_user.id)
     if not stored_key:
         await callback.message.answer(t(lang, "profile_empty"), reply_markup=plans_kb(lang))
         await callback.answer()
@@ -666,7 +739,7 @@ async def set_expire_cmd(message: Message) -> None:
             "Неверный формат даты. Пример: 2026-01-20 или 2026-01-20 12:00"
         )
         return
-    set_subscription(user_id, expires.isoformat(timespec="seconds"))
+    await set_subscription(user_id, expires.isoformat(timespec="seconds"))
     await message.answer(
         f"Готово. Подписка до {expires.isoformat(timespec='minutes')}."
     )
@@ -691,7 +764,7 @@ async def set_plan_cmd(message: Message) -> None:
         await message.answer("План должен быть trial, 1m, 3m или 12m.")
         return
     expires = datetime.now(timezone.utc) + timedelta(days=days)
-    set_subscription(user_id, expires.isoformat(timespec="seconds"), plan_code=plan_code)
+    await set_subscription(user_id, expires.isoformat(timespec="seconds"), plan_code=plan_code)
     await message.answer(
         f"Готово. План {plan_code}, до {expires.isoformat(timespec='minutes')}."
     )
@@ -745,35 +818,274 @@ async def issue_cmd(message: Message) -> None:
     )
 
 
-async def reminder_loop(bot: Bot) -> None:
-    while True:
-        now = datetime.now(timezone.utc)
-        for reminder in list_due_reminders(now):
-            key = f"renew_{reminder.kind}"
-            text = t(reminder.lang, key)
-            if reminder.kind == "expired":
-                set_status_expired(reminder.user_id)
+@router.message(Command("cache_stats"))
+async def cache_stats_cmd(message: Message) -> None:
+    if not is_admin(message.from_user.id):
+        return
+    stats = profiles.stats()
+    docs = sub_documents.stats()
+    await message.answer(
+        "Profile cache:\n"
+        f"size: {stats['size']}/{stats['max_size']}\n"
+        f"hits: {stats['hits']} | misses: {stats['misses']} "
+        f"({stats['hit_rate']:.0%} hit rate)\n"
+        f"evictions: {stats['evictions']} | invalidations: {stats['invalidations']}\n"
+        f"Subscription documents: {docs['size']}/{docs['max_size']}, "
+        f"hits: {docs['hits']} | misses: {docs['misses']} | invalidations: {docs['invalidations']}"
+    )
+
+
+@router.message(Command("xui_stats"))
+async def xui_stats_cmd(message: Message) -> None:
+    if not is_admin(message.from_user.id):
+        return
+    if not panel_registry.panels:
+        await message.answer("XUI не настроен.")
+        return
+    assigned = await count_panel_users()
+    lines = []
+    for panel in panel_registry.panels:
+        users = assigned.get(panel.name, 0)
+        if panel is panel_registry.primary:
+            users += assigned.get(LEGACY_PANEL, 0)
+        stats = panel_registry.client(panel).stats()
+        lines.append(
+            f"[{panel.name}] weight {panel.weight}, users {users}, "
+            f"circuit: {stats['circuit']} (failures: {stats['failures']})"
+        )
+        for endpoint, endpoint_stats in sorted(stats["endpoints"].items()):
+            lines.append(
+                f"{endpoint}: {endpoint_stats.calls} calls, {endpoint_stats.errors} errors, "
+                f"avg {endpoint_stats.avg_ms:.0f} ms, max {endpoint_stats.max_ms:.0f} ms"
+            )
+    await message.answer("\n".join(lines))
+
+
+async def _client_ips(user_id: int) -> list[str]:
+    ips: list[str] = []
+    for client in await list_traffic_clients([user_id]):
+        panel = panel_registry.get(client.panel)
+        if panel:
             try:
-                await bot.send_message(
-                    reminder.user_id,
-                    text,
-                    reply_markup=renew_kb(reminder.lang),
-                )
-                mark_reminded(reminder.user_id, reminder.kind)
-            except Exception:
-                logging.exception("Failed to send reminder to %s", reminder.user_id)
-        await asyncio.sleep(REMINDER_INTERVAL_MINUTES * 60)
+                ips += await panel_registry.client(panel).client_ips(client.email)
+            except Exception as exc:
+                logging.warning("Client IPs of %s failed: %s", client.email, exc)
+    return ips
+
+
+@router.message(Command("traffic"))
+async def traffic_cmd(message: Message) -> None:
+    if not is_admin(message.from_user.id):
+        return
+    parts = (message.text or "").split()
+    now = int(time.time())
+    # A client stamped by the last poll or the one before is online now.
+    online_since = now - 2 * int(TRAFFIC_POLL_SECONDS or 60)
+    if len(parts) > 1:
+        if not parts[1].isdigit():
+            await message.answer("Формат: /traffic [USER_ID]")
+            return
+        user_id = int(parts[1])
+        day_up, day_down = await get_traffic_used(user_id, now - 86400)
+        month_up, month_down = await get_traffic_used(user_id, now - 30 * 86400)
+        clients = await list_traffic_clients([user_id])
+        last_online = max((client.online_ts for client in clients), default=0)
+        if last_online >= online_since:
+            online = "now"
+        elif last_online:
+            online = datetime.fromtimestamp(last_online, timezone.utc).strftime("%Y-%m-%d %H:%M")
+        else:
+            online = "—"
+        ips = await _client_ips(user_id)
+        lines = [
+            f"User {user_id}:",
+            f"24h: {format_bytes(day_up + day_down)} (up {format_bytes(day_up)}, down {format_bytes(day_down)})",
+            f"30d: {format_bytes(month_up + month_down)}",
+            f"online: {online}",
+            f"IPs: {len(ips)} (limit {XUI_LIMIT_IP or '—'})",
+        ]
+        lines += ips[:20]
+        await message.answer("\n".join(lines))
+        return
+    summary = await traffic_summary(now - 86400, online_since)
+    top = await top_traffic(now - 86400, 10)
+    online = {
+        client.user_id
+        for client in await list_traffic_clients([user_id for user_id, _ in top])
+        if client.online_ts >= online_since
+    }
+    lines = [f"Traffic 24h: {format_bytes(summary['used'])}, online now: {summary['online']}"]
+    for user_id, used in top:
+        line = f"{user_id}: {format_bytes(used)}"
+        if user_id in online:
+            line += " online"
+            # Heavy users connected right now are the ones worth checking
+            # for a shared key.
+            if XUI_LIMIT_IP > 0:
+                ips = len(await _client_ips(user_id))
+                if ips > XUI_LIMIT_IP:
+                    line += f", {ips} IPs > limit {XUI_LIMIT_IP}"
+        lines.append(line)
+    await message.answer("\n".join(lines))
+
+
+@router.message(Command("payments"))
+async def payments_cmd(message: Message) -> None:
+    if not is_admin(message.from_user.id):
+        return
+    counts = await count_payment_jobs()
+    lines = [
+        "Payment jobs: "
+        + ", ".join(f"{status} {counts.get(status, 0)}" for status in ("pending", "running", "done", "dead"))
+    ]
+    for job in await list_dead_payment_jobs(10):
+        lines.append(f"#{job.id} user {job.user_id} plan {job.plan_code}: {job.last_error}")
+    await message.answer("\n".join(lines))
+
+
+@router.message(Command("payment_retry"))
+async def payment_retry_cmd(message: Message) -> None:
+    if not is_admin(message.from_user.id):
+        return
+    parts = (message.text or "").split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        await message.answer("Формат: /payment_retry JOB_ID")
+        return
+    if await requeue_payment_job(int(parts[1])):
+        await message.answer("Платёж поставлен в очередь повторно.")
+    else:
+        await message.answer("Задача не найдена или не в статусе dead.")
+
+
+async def send_reminders(bot: Bot, reminders: list[Reminder]) -> None:
+    if not reminders:
+        return
+    expired = [r.user_id for r in reminders if r.kind == "expired"]
+    if expired:
+        await set_status_expired_many(expired)
+    jobs = [
+        SendJob(
+            chat_id=reminder.user_id,
+            text=t(reminder.lang, f"renew_{reminder.kind}"),
+            reply_markup=renew_kb(reminder.lang),
+            payload=reminder,
+        )
+        for reminder in reminders
+    ]
+
+    async def commit(batch: list[SendJob]) -> None:
+        await mark_reminded_many((job.payload.user_id, job.payload.kind) for job in batch)
+
+    scheduler = SendScheduler(bot, REMINDER_SEND_RATE, REMINDER_SEND_CONCURRENCY)
+    stats = await scheduler.run(jobs, on_batch=commit, batch_size=REMINDER_BATCH_SIZE)
+    logging.info("Reminder run: due=%s %s", len(reminders), stats.summary())
+
+
+async def reminder_loop(bot: Bot) -> None:
+    scheduler = ReminderScheduler(
+        functools.partial(send_reminders, bot),
+        resync_seconds=REMINDER_RESYNC_HOURS * 3600,
+        retry_seconds=REMINDER_INTERVAL_MINUTES * 60,
+    )
+    await scheduler.run()
+
+
+def bot_webhook_secret() -> str:
+    # Telegram allows [A-Za-z0-9_-]; derive a stable one if none is set.
+    return BOT_WEBHOOK_SECRET or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher) -> None:
+    """Receive updates on the payment webhook server until cancelled.
+
+    This server replaces ``src.webhook`` run on its own. Not being able to
+    bind it or register the webhook is fatal rather than a reason to fall
+    back to polling, which would leave payments without a server.
+    """
+    # start_background already runs this process's change feed.
+    app = await webhook.init_app(bot, change_feed=False)
+    webhook.add_bot_updates(
+        app,
+        dp,
+        bot,
+        urlparse(BOT_WEBHOOK_URL).path or "/",
+        bot_webhook_secret(),
+        BOT_UPDATE_WORKERS,
+    )
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        try:
+            await web.TCPSite(runner, webhook.WEBHOOK_BIND, webhook.WEBHOOK_PORT).start()
+        except OSError as exc:
+            raise RuntimeError(
+                f"Cannot serve webhook mode on {webhook.WEBHOOK_BIND}:{webhook.WEBHOOK_PORT}; "
+                "stop getnius-webhook.service, which it replaces"
+            ) from exc
+        await bot.set_webhook(
+            BOT_WEBHOOK_URL,
+            secret_token=bot_webhook_secret(),
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=min(100, max(1, BOT_UPDATE_WORKERS)),
+        )
+        logging.info("Receiving updates via webhook at %s", BOT_WEBHOOK_URL)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def build_dispatcher() -> Dispatcher:
+    dp = Dispatcher()
+    dp.include_router(router)
+    return dp
+
+
+def _on_remote_change(kind: str, user_ids: list[int]) -> None:
+    # Another process provisioned clients, so cached inbound snapshots
+    # may be missing them.
+    if kind == "key":
+        panel_registry.invalidate_inbounds()
+
+
+def start_background(bot: Bot) -> list[asyncio.Task]:
+    """Start the per-process loops; reminders and traffic polling only run on the lease holder."""
+    profiles.attach()
+    feed = ChangeFeed()
+    feed.subscribe(_on_remote_change)
+    tasks = [
+        asyncio.create_task(feed.run()),
+        asyncio.create_task(LeaderLease("reminders", functools.partial(reminder_loop, bot)).run()),
+        asyncio.create_task(profiles.run_flush_loop()),
+    ]
+    if TRAFFIC_POLL_SECONDS > 0 and panel_registry.panels:
+        tasks.append(asyncio.create_task(LeaderLease("traffic", TrafficPoller().run).run()))
+    return tasks
+
+
+async def stop_background(tasks: list[asyncio.Task]) -> None:
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
 
 
 async def main() -> None:
     if not BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN is missing")
     bot = Bot(BOT_TOKEN)
-    dp = Dispatcher()
-    dp.include_router(router)
-    init_db()
-    asyncio.create_task(reminder_loop(bot))
-    await dp.start_polling(bot)
+    dp = build_dispatcher()
+    await init_db()
+    tasks = start_background(bot)
+    try:
+        if BOT_WEBHOOK_URL:
+            await run_webhook(bot, dp)
+        else:
+            # A webhook left over from webhook mode would block getUpdates.
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        await stop_background(tasks)
+        await panel_registry.close()
+        async_storage.shutdown()
 
 
 if __name__ == "__main__":
@@ -1,7 +1,13 @@
+import asyncio
+from dataclasses import dataclass
+import hashlib
+import logging
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Union
 
-from aiogram.types import FSInputFile
+from aiogram.types import FSInputFile, Message
+
+from . import async_storage
 
 
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -18,11 +24,108 @@ ASSET_MAP = {
 }
 
 
-def asset_file(key: str) -> Optional[FSInputFile]:
+def asset_path(key: str) -> Optional[Path]:
     filename = ASSET_MAP.get(key)
     if not filename:
         return None
     path = ASSETS_DIR / filename
     if not path.exists():
         return None
+    return path
+
+
+def asset_file(key: str) -> Optional[FSInputFile]:
+    path = asset_path(key)
+    if not path:
+        return None
     return FSInputFile(str(path))
+
+
+@dataclass(frozen=True)
+class ResolvedAsset:
+    key: str
+    file_hash: str
+    media: Union[str, FSInputFile]
+
+    @property
+    def cached(self) -> bool:
+        return isinstance(self.media, str)
+
+
+class MediaRegistry:
+    """Upload each asset once per bot and reuse Telegram's ``file_id``.
+
+    File ids are stored per ``(bot_id, asset_key)`` together with the asset's
+    content hash, so editing a PNG on disk triggers a fresh upload. Assets
+    are hashed once when the registry is loaded and checked again only when
+    one is uploaded; a send that reuses a file id does not touch the disk,
+    so a PNG replaced meanwhile is picked up after a restart.
+    """
+
+    def __init__(self) -> None:
+        # asset key -> (path, (mtime_ns, size), sha256); None until loaded
+        self._assets: Optional[dict[str, tuple[Path, tuple[int, int], str]]] = None
+        # (bot_id, asset key, sha256) -> file_id ("" when known to be absent)
+        self._file_ids: dict[tuple[int, str, str], str] = {}
+
+    @staticmethod
+    def _scan(assets: dict[str, tuple[Path, tuple[int, int], str]], key: str) -> Optional[str]:
+        """(Re)hash ``key`` into ``assets`` if its file changed; None if it is gone."""
+        path = asset_path(key)
+        if not path:
+            assets.pop(key, None)
+            return None
+        stat = path.stat()
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = assets.get(key)
+        if cached and cached[1] == signature:
+            return cached[2]
+        digest = hashlib.sha256(path.read_bytes()).hexdigest()
+        assets[key] = (path, signature, digest)
+        return digest
+
+    def _load(self) -> dict[str, tuple[Path, tuple[int, int], str]]:
+        assets: dict[str, tuple[Path, tuple[int, int], str]] = {}
+        for key in ASSET_MAP:
+            self._scan(assets, key)
+        self._assets = assets
+        return assets
+
+    async def resolve(self, bot_id: int, key: str) -> Optional[ResolvedAsset]:
+        assets = self._assets
+        if assets is None:
+            assets = await asyncio.to_thread(self._load)
+        entry = assets.get(key)
+        if not entry:
+            return None
+        path, _, file_hash = entry
+        cache_key = (bot_id, key, file_hash)
+        file_id = self._file_ids.get(cache_key)
+        if file_id is None:
+            file_id = await async_storage.get_media_file_id(bot_id, key, file_hash)
+            self._file_ids[cache_key] = file_id
+        if file_id:
+            return ResolvedAsset(key, file_hash, file_id)
+        return ResolvedAsset(key, file_hash, FSInputFile(str(path)))
+
+    async def remember(self, bot_id: int, asset: ResolvedAsset, message: object) -> None:
+        if asset.cached or not isinstance(message, Message) or not message.photo:
+            return
+        file_id = message.photo[-1].file_id
+        # The upload read the file again; only keep its file_id if that was
+        # still the content the asset was resolved with.
+        assets = self._assets if self._assets is not None else {}
+        if await asyncio.to_thread(self._scan, assets, asset.key) != asset.file_hash:
+            return
+        self._file_ids[(bot_id, asset.key, asset.file_hash)] = file_id
+        try:
+            await async_storage.set_media_file_id(bot_id, asset.key, asset.file_hash, file_id)
+        except Exception:
+            logging.exception("Failed to persist file_id for %s", asset.key)
+
+    async def forget(self, bot_id: int, asset: ResolvedAsset) -> None:
+        self._file_ids[(bot_id, asset.key, asset.file_hash)] = ""
+        await async_storage.delete_media_file_id(bot_id, asset.key)
+
+
+media_registry = MediaRegistry()
@@ -1 +1 @@
-"""Operational helpers (healthchecks, update checks)."""
+"""Operational helpers (healthchecks, update checks, benchmarks)."""
@@ -0,0 +1,114 @@
+"""Move long-expired customers out of the hot tables.
+
+Subscriptions that ended more than ``--after-days`` ago (and were already
+sent their expiry reminder), together with their keys, are moved to
+``archived_subscriptions`` / ``archived_user_keys``; so are keys without a
+subscription that have not changed since the cutoff. Each batch is one
+short transaction, so the bot keeps running. A user who pays again is
+restored by ``issue_access`` before the new period is issued. Freed pages
+are then returned to the filesystem with incremental VACUUM::
+
+    python -m src.ops.archive --after-days 90
+
+Databases created before incremental auto-vacuum was enabled need one full
+VACUUM to switch over (``--enable-incremental-vacuum``); it rewrites the
+whole file and blocks writers meanwhile, so run it in a quiet window.
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import time
+
+from .. import storage
+
+
+def _get_env(name: str, default: str) -> str:
+    return os.getenv(name, default).strip()
+
+
+ARCHIVE_AFTER_DAYS = int(_get_env("ARCHIVE_AFTER_DAYS", "90") or "90")
+ARCHIVE_VACUUM_PAGES = int(_get_env("ARCHIVE_VACUUM_PAGES", "1000") or "1000")
+
+BATCH_SIZE = 500
+
+
+def _counts() -> str:
+    counts = storage.count_archived()
+    return (
+        f"hot: {counts['subscriptions']} subscriptions, {counts['user_keys']} keys | "
+        f"archived: {counts['archived_subscriptions']} subscriptions, {counts['archived_user_keys']} keys"
+    )
+
+
+def archive(after_days: int, dry_run: bool, pause: float) -> int:
+    cutoff_ts = int(time.time()) - after_days * 24 * 3600
+    candidates = storage.list_archivable(cutoff_ts)
+    print(f"{len(candidates)} user(s) expired or stale for more than {after_days} days")
+    if dry_run:
+        return 0
+    moved = 0
+    for start in range(0, len(candidates), BATCH_SIZE):
+        moved += len(storage.archive_users(candidates[start:start + BATCH_SIZE], cutoff_ts))
+        if pause:
+            time.sleep(pause)
+    print(f"archived {moved} user(s)")
+    return moved
+
+
+def vacuum(pages: int, pause: float) -> None:
+    conn = storage._connect()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        print("incremental auto-vacuum is off; run once with --enable-incremental-vacuum")
+        return
+    before = int(conn.execute("PRAGMA freelist_count").fetchone()[0])
+    left = before
+    # Small steps keep each write lock short.
+    while left:
+        remaining = storage.incremental_vacuum(pages)
+        if remaining >= left:
+            break
+        left = remaining
+        if pause:
+            time.sleep(pause)
+    page_size = int(conn.execute("PRAGMA page_size").fetchone()[0])
+    released = before - left
+    print(f"released {released} free page(s), {released * page_size / 1e6:.1f} MB")
+
+
+def enable_incremental_vacuum() -> None:
+    conn = storage._connect()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        print("incremental auto-vacuum is already on")
+        return
+    started = time.monotonic()
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+    print(f"switched to incremental auto-vacuum in {time.monotonic() - started:.1f}s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Archive long-expired subscriptions and stale keys")
+    parser.add_argument("--after-days", type=int, default=ARCHIVE_AFTER_DAYS)
+    parser.add_argument("--vacuum-pages", type=int, default=ARCHIVE_VACUUM_PAGES, help="pages freed per step")
+    parser.add_argument("--pause", type=float, default=0.05, help="sleep between batches")
+    parser.add_argument("--dry-run", action="store_true", help="only count what would be archived")
+    parser.add_argument(
+        "--enable-incremental-vacuum",
+        action="store_true",
+        help="one-off full VACUUM that switches an old database to incremental auto-vacuum",
+    )
+    args = parser.parse_args()
+
+    storage.init_db()
+    print(_counts())
+    if args.enable_incremental_vacuum:
+        enable_incremental_vacuum()
+    archive(args.after_days, args.dry_run, args.pause)
+    if not args.dry_run:
+        vacuum(args.vacuum_pages, args.pause)
+        print(_counts())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""Hot backups and JSONL exports of ``data/bot.db`` while the bot runs.
+
+``snapshot`` copies the database with SQLite's online backup API a few
+pages at a time. The copy runs inside one read transaction, so it sees a
+single point in time. In WAL mode that transaction never blocks writers.
+Without it, every write from the bot would restart the copy. The copy is
+integrity-checked, gzip-compressed, read back and rotated::
+
+    python -m src.ops.backup snapshot --keep 14
+
+``export`` streams users, subscriptions and keys as JSON lines from one
+consistent read snapshot, again without blocking the bot::
+
+    python -m src.ops.backup export --out data/export.jsonl.gz
+
+``verify`` re-checks an existing snapshot.
+"""
+from __future__ import annotations
+
+import argparse
+from datetime import datetime, timezone
+import gzip
+import hashlib
+import json
+import os
+from pathlib import Path
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from typing import IO, Iterator
+
+from .. import storage
+
+
+BASE_DIR = Path(__file__).resolve().parents[2]
+
+
+def _get_env(name: str, default: str) -> str:
+    return os.getenv(name, default).strip()
+
+
+BACKUP_DIR = Path(_get_env("BACKUP_DIR", "") or BASE_DIR / "data" / "backups")
+BACKUP_KEEP = int(_get_env("BACKUP_KEEP", "14") or "14")
+BACKUP_STEP_PAGES = int(_get_env("BACKUP_STEP_PAGES", "256") or "256")
+BACKUP_STEP_PAUSE_SECONDS = float(_get_env("BACKUP_STEP_PAUSE_SECONDS", "0.01") or "0.01")
+
+SNAPSHOT_PREFIX = "bot-"
+SNAPSHOT_SUFFIX = ".db.gz"
+CHUNK = 1 << 20
+
+# Epoch columns exported as ISO ``*_at`` fields, like the storage API returns them.
+_TIMESTAMP_COLUMNS = {"created_ts", "updated_ts", "last_seen_ts", "expires_ts"}
+EXPORT_TABLES = {
+    "users": "SELECT * FROM users ORDER BY user_id",
+    "subscriptions": "SELECT * FROM subscriptions ORDER BY user_id",
+    "keys": "SELECT * FROM user_keys ORDER BY user_id",
+}
+
+
+def _read_only(path: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=10, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA busy_timeout=10000")
+    return conn
+
+
+def _pin_snapshot(conn: sqlite3.Connection) -> None:
+    # A read transaction only takes its snapshot at the first read.
+    conn.execute("BEGIN")
+    conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+
+
+def integrity_check(path: Path) -> str:
+    conn = sqlite3.connect(path)
+    try:
+        rows = conn.execute("PRAGMA integrity_check").fetchall()
+    finally:
+        conn.close()
+    return "; ".join(str(row[0]) for row in rows)
+
+
+def _sha256(stream: IO[bytes]) -> str:
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(CHUNK), b""):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def copy_online(source_path: Path, target_path: Path, pages: int, pause: float) -> int:
+    """Copy the live database into ``target_path``; returns the page count."""
+    source = _read_only(source_path)
+    target = sqlite3.connect(target_path)
+    total_pages = 0
+
+    def progress(status: int, remaining: int, total: int) -> None:
+        nonlocal total_pages
+        total_pages = total
+        if remaining and pause:
+            time.sleep(pause)
+
+    try:
+        _pin_snapshot(source)
+        source.backup(target, pages=max(1, pages), progress=progress)
+        source.execute("COMMIT")
+    finally:
+        target.close()
+        source.close()
+    return total_pages
+
+
+def snapshot(directory: Path, keep: int, pages: int, pause: float) -> Path:
+    directory.mkdir(parents=True, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    final = directory / f"{SNAPSHOT_PREFIX}{stamp}{SNAPSHOT_SUFFIX}"
+    started = time.monotonic()
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        raw = Path(tmp) / "bot.db"
+        page_count = copy_online(storage.DB_PATH, raw, pages, pause)
+        copied = time.monotonic() - started
+        result = integrity_check(raw)
+        if result != "ok":
+            raise SystemExit(f"integrity check failed, snapshot discarded: {result}")
+        with raw.open("rb") as plain:
+            raw_digest = _sha256(plain)
+        packed = Path(tmp) / final.name
+        with raw.open("rb") as plain, gzip.open(packed, "wb", compresslevel=6) as compressed:
+            shutil.copyfileobj(plain, compressed, CHUNK)
+        # Read the archive back so a bad write is caught now, not at restore time.
+        with gzip.open(packed, "rb") as compressed:
+            if _sha256(compressed) != raw_digest:
+                raise SystemExit("compressed snapshot does not match the copy")
+        raw_size = raw.stat().st_size
+        os.replace(packed, final)
+    print(
+        f"{final.name}: {page_count} pages, {raw_size / 1e6:.1f} MB -> "
+        f"{final.stat().st_size / 1e6:.1f} MB, copied in {copied:.1f}s, "
+        f"total {time.monotonic() - started:.1f}s, integrity ok"
+    )
+    for stale in rotate(directory, keep):
+        print(f"removed {stale.name}")
+    return final
+
+
+def rotate(directory: Path, keep: int) -> list[Path]:
+    """Delete all but the newest ``keep`` snapshots; returns what was removed."""
+    snapshots = sorted(directory.glob(f"{SNAPSHOT_PREFIX}*{SNAPSHOT_SUFFIX}"))
+    stale = snapshots[:-keep] if keep > 0 else []
+    for path in stale:
+        path.unlink()
+    return stale
+
+
+def verify(path: Path) -> str:
+    with tempfile.TemporaryDirectory() as tmp:
+        raw = Path(tmp) / "bot.db"
+        with gzip.open(path, "rb") as compressed, raw.open("wb") as plain:
+            shutil.copyfileobj(compressed, plain, CHUNK)
+        return integrity_check(raw)
+
+
+def export_rows(path: Path, tables: list[str]) -> Iterator[dict]:
+    """Rows of ``tables`` as dicts, all read from one point in time."""
+    conn = _read_only(path)
+    try:
+        _pin_snapshot(conn)
+        for table in tables:
+            for row in conn.execute(EXPORT_TABLES[table]):
+                record = {"table": table}
+                for column in row.keys():
+                    if column in _TIMESTAMP_COLUMNS:
+                        record[f"{column[:-3]}_at"] = storage._ts_to_iso(row[column]) or None
+                    else:
+                        record[column] = row[column]
+                yield record
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+
+def export(out: str, tables: list[str]) -> int:
+    if out == "-":
+        stream: IO[str] = sys.stdout
+    elif out.endswith(".gz"):
+        stream = gzip.open(out, "wt", encoding="utf-8")
+    else:
+        stream = open(out, "w", encoding="utf-8")
+    count = 0
+    try:
+        for record in export_rows(storage.DB_PATH, tables):
+            stream.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+            stream.write("\n")
+            count += 1
+    finally:
+        if stream is not sys.stdout:
+            stream.close()
+    return count
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Online backups and exports of the bot database")
+    sub = parser.add_subparsers(dest="command", required=True)
+    snap = sub.add_parser("snapshot", help="compressed, verified, rotated backup")
+    snap.add_argument("--dir", type=Path, default=BACKUP_DIR)
+    snap.add_argument("--keep", type=int, default=BACKUP_KEEP, help="snapshots to keep (0 = all)")
+    snap.add_argument("--pages", type=int, default=BACKUP_STEP_PAGES, help="pages copied per step")
+    snap.add_argument("--pause", type=float, default=BACKUP_STEP_PAUSE_SECONDS, help="sleep between steps")
+    check = sub.add_parser("verify", help="integrity-check a snapshot")
+    check.add_argument("path", type=Path)
+    dump = sub.add_parser("export", help="point-in-time JSONL export")
+    dump.add_argument("--out", default="-", help="file (.gz to compress) or - for stdout")
+    dump.add_argument("--tables", default=",".join(EXPORT_TABLES), help="comma-separated subset of %(default)s")
+    args = parser.parse_args()
+
+    if args.command == "snapshot":
+        snapshot(args.dir, args.keep, args.pages, args.pause)
+    elif args.command == "verify":
+        result = verify(args.path)
+        print(f"{args.path.name}: {result}")
+        sys.exit(0 if result == "ok" else 1)
+    else:
+        tables = [name.strip() for name in args.tables.split(",") if name.strip()]
+        unknown = [name for name in tables if name not in EXPORT_TABLES]
+        if unknown:
+            raise SystemExit(f"unknown table(s): {', '.join(unknown)}")
+        count = export(args.out, tables)
+        print(f"exported {count} rows", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
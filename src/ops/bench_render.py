@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import argparse
+from string import Formatter
+import time
+from typing import Callable
+
+from .. import keyboards
+from ..texts import EN, RU, STATIC_FIELDS, _fmt, t
+
+
+_LEGACY_DEFAULTS = (
+    "happ_gp", "happ_apk", "happ_ios_ru", "happ_ios_alt", "app_store_link",
+    "flclash_link", "v2ray_gp", "v2ray_apk", "key_link", "sub_url",
+    "sub_url_link", "happ_url", "v2raytun_url", "client_line",
+)
+
+
+def _legacy_t(lang: str, text_id: str, **kwargs: str) -> str:
+    # Pre-compilation behaviour: build the full value dict and format.
+    data = EN if lang == "en" else RU
+    base = dict(STATIC_FIELDS)
+    base.update({name: kwargs.get(name, "") for name in _LEGACY_DEFAULTS})
+    base.update(kwargs)
+    return _fmt(data.get(text_id, ""), **base)
+
+
+def _check_equivalence() -> int:
+    sample = {"key_link": "<a>k</a>", "sub_url": "https://s", "ref_link": "https://r"}
+    checked = 0
+    for lang, data in (("ru", RU), ("en", EN)):
+        for text_id in data:
+            # The legacy renderer raised KeyError for fields it had no default
+            # for, so always pass those.
+            required = {
+                name: "x"
+                for _, name, _, _ in Formatter().parse(data[text_id])
+                if name and name not in _LEGACY_DEFAULTS and name not in STATIC_FIELDS
+            }
+            for extra in ({}, sample, {**sample, "brand": "&lt;b&gt;"}):
+                kwargs = {**required, **extra}
+                if t(lang, text_id, **kwargs) != _legacy_t(lang, text_id, **kwargs):
+                    raise SystemExit(f"render mismatch for {lang}:{text_id}")
+                checked += 1
+    return checked
+
+
+def _render_screens(render_text: Callable[..., str], kb: Callable[[Callable], Callable], user: int) -> None:
+    # Roughly what cb_device (android), /start and the tariffs screen render.
+    sub_url = f"https://example.com/sub/{user % 500}"
+    render_text("ru", "android_setup", key_link=f"vless://{user}", happ_gp="gp", happ_apk="apk")
+    kb(keyboards.android_actions_kb)("ru", sub_url)
+    render_text("ru", "welcome_text")
+    kb(keyboards.main_menu_kb)("ru")
+    kb(keyboards.device_kb)("ru")
+    render_text("en", "tariffs")
+    kb(keyboards.plans_kb)("en")
+
+
+def _measure(label: str, render_text: Callable[..., str], kb: Callable[[Callable], Callable], iterations: int) -> float:
+    start = time.perf_counter()
+    for user in range(iterations):
+        _render_screens(render_text, kb, user)
+    per_call = (time.perf_counter() - start) / iterations * 1e6
+    print(f"{label:<8} {per_call:8.1f} us per handler round")
+    return per_call
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Keyboard/text render benchmark")
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"equivalent renders checked: {_check_equivalence()}")
+    before = _measure("before", _legacy_t, lambda fn: fn.__wrapped__, args.iterations)
+    after = _measure("after", t, lambda fn: fn, args.iterations)
+    print(f"speedup: {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
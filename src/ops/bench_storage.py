@@ -0,0 +1,257 @@
+from __future__ import annotations
+
+import argparse
+from datetime import datetime, timedelta, timezone
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable
+
+from .. import storage
+
+
+def _legacy_connect() -> sqlite3.Connection:
+    # Pre-pooling behaviour: one fresh connection (and mkdir) per call.
+    storage.DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(storage.DB_PATH, timeout=10)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _tap(user_id: int) -> None:
+    # Roughly what cb_device does per button tap.
+    storage.upsert_user(user_id, "ru")
+    storage.get_user_key(user_id)
+    storage.get_subscription(user_id)
+
+
+def _measure(fn: Callable[[int], None], users: int, iterations: int) -> list[float]:
+    samples: list[float] = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        fn(i % users)
+        samples.append((time.perf_counter() - start) * 1e6)
+    return samples
+
+
+def _report(label: str, samples: list[float], calls_per_sample: int) -> float:
+    ordered = sorted(samples)
+    mean = statistics.fmean(ordered) / calls_per_sample
+    p50 = ordered[len(ordered) // 2] / calls_per_sample
+    p99 = ordered[int(len(ordered) * 0.99) - 1] / calls_per_sample
+    print(f"{label:<8} per call: mean {mean:8.1f} us | p50 {p50:8.1f} us | p99 {p99:8.1f} us")
+    return mean
+
+
+def bench_calls(users: int, iterations: int) -> None:
+    original_connect = storage._connect
+    storage.init_db()
+    for user_id in range(users):
+        storage.upsert_user(user_id, "ru")
+        storage.set_user_key(user_id, f"vless://{user_id}", f"https://sub/{user_id}")
+        storage.set_subscription(user_id, "2030-01-01T00:00:00+00:00")
+    try:
+        storage._connect = _legacy_connect
+        before = _report("before", _measure(_tap, users, iterations), 3)
+        storage._connect = original_connect
+        after = _report("after", _measure(_tap, users, iterations), 3)
+    finally:
+        storage._connect = original_connect
+    print(f"speedup: {before / after:.1f}x")
+
+
+def _legacy_due_reminders(now: datetime) -> list[storage.Reminder]:
+    # Pre-index behaviour: fetch every subscription and filter it in Python.
+    reminders: list[storage.Reminder] = []
+    with storage._connect() as conn:
+        rows = conn.execute(
+            """
+            SELECT s.*, u.lang
+            FROM subscriptions s
+            JOIN users u ON u.user_id = s.user_id
+            WHERE s.expires_ts IS NOT NULL
+            """
+        ).fetchall()
+    now_ts = now.timestamp()
+    for row in rows:
+        seconds = row["expires_ts"] - now_ts
+        reminded = row["reminders"]
+        if seconds <= 0:
+            if not reminded & storage.REMIND_EXPIRED:
+                reminders.append(storage.Reminder(row["user_id"], row["lang"], "expired"))
+            continue
+        if reminded & storage.REMIND_EXPIRED:
+            continue
+        if seconds <= 24 * 3600:
+            if not reminded & storage.REMIND_1D:
+                reminders.append(storage.Reminder(row["user_id"], row["lang"], "1d"))
+            continue
+        if seconds <= 3 * 24 * 3600:
+            if not reminded & storage.REMIND_3D:
+                reminders.append(storage.Reminder(row["user_id"], row["lang"], "3d"))
+    return reminders
+
+
+def _synthetic_subscriptions(count: int, now: datetime):
+    # Most rows are long-expired (already reminded) or far in the future;
+    # a thin slice falls inside the reminder windows.
+    rng = random.Random(42)
+    for user_id in range(count):
+        expires = now + timedelta(hours=rng.randint(-400 * 24, 400 * 24))
+        yield user_id, expires, expires <= now - timedelta(days=1)
+
+
+def _seed_subscriptions(count: int, now: datetime) -> None:
+    now_ts = int(now.timestamp())
+    with storage._connect() as conn:
+        conn.executemany(
+            "INSERT INTO users (user_id, lang, created_ts, updated_ts) VALUES (?, 'ru', ?, ?)",
+            ((user_id, now_ts, now_ts) for user_id in range(count)),
+        )
+        conn.executemany(
+            """
+            INSERT INTO subscriptions (user_id, plan_code, status, expires_ts, reminders, updated_ts)
+            VALUES (?, '1m', ?, ?, ?, ?)
+            """,
+            (
+                (
+                    user_id,
+                    "expired" if expired else "active",
+                    int(expires.timestamp()),
+                    storage.REMIND_EXPIRED if expired else 0,
+                    now_ts,
+                )
+                for user_id, expires, expired in _synthetic_subscriptions(count, now)
+            ),
+        )
+
+
+def _seed_legacy_subscriptions(count: int, now: datetime) -> None:
+    # The same rows in the version 5 layout: ISO text and four flag columns.
+    now_iso = now.isoformat(timespec="seconds")
+    with storage._connect() as conn:
+        conn.executemany(
+            "INSERT INTO users (user_id, lang, created_at, updated_at, last_seen_at) VALUES (?, 'ru', ?, ?, ?)",
+            ((user_id, now_iso, now_iso, now_iso) for user_id in range(count)),
+        )
+        conn.executemany(
+            """
+            INSERT INTO subscriptions (
+                user_id, plan_code, expires_at, expires_ts, status,
+                reminded_3d, reminded_1d, reminded_0d, reminded_expired, updated_at
+            )
+            VALUES (?, '1m', ?, ?, ?, ?, ?, 0, ?, ?)
+            """,
+            (
+                (
+                    user_id,
+                    expires.isoformat(timespec="seconds"),
+                    int(expires.timestamp()),
+                    "expired" if expired else "active",
+                    int(expired),
+                    int(expired),
+                    int(expired),
+                    now_iso,
+                )
+                for user_id, expires, expired in _synthetic_subscriptions(count, now)
+            ),
+        )
+
+
+def bench_reminders(count: int, rounds: int) -> None:
+    now = datetime.now(timezone.utc)
+    storage.init_db()
+    start = time.perf_counter()
+    _seed_subscriptions(count, now)
+    print(f"seeded {count} subscriptions in {time.perf_counter() - start:.1f}s")
+    plan = storage._connect().execute(
+        "EXPLAIN QUERY PLAN SELECT user_id FROM subscriptions "
+        f"WHERE reminders & {storage.REMIND_EXPIRED} = 0 AND expires_ts <= ?",
+        (int(now.timestamp()),),
+    ).fetchall()
+    print("plan:", "; ".join(row["detail"] for row in plan))
+
+    results = {}
+    for label, fn in (("before", _legacy_due_reminders), ("after", storage.list_due_reminders)):
+        samples = []
+        for _ in range(rounds):
+            begin = time.perf_counter()
+            due = fn(now)
+            samples.append((time.perf_counter() - begin) * 1000)
+        results[label] = sorted((r.user_id, r.kind) for r in due)
+        print(f"{label:<8} {len(due):6d} due | median {statistics.median(samples):9.1f} ms")
+    if results["before"] != results["after"]:
+        raise SystemExit("due sets differ between legacy and indexed query")
+
+
+def _db_bytes() -> int:
+    conn = storage._connect()
+    conn.execute("VACUUM")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return storage.DB_PATH.stat().st_size
+
+
+def bench_migrate(count: int) -> None:
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    migrations = storage.MIGRATIONS
+    # Build a version 5 database (ISO text timestamps, four reminder flags).
+    storage.MIGRATIONS = migrations[:5]
+    try:
+        storage.init_db()
+    finally:
+        storage.MIGRATIONS = migrations
+    _seed_legacy_subscriptions(count, now)
+    before_states = {
+        row["user_id"]: (row["expires_at"], row["reminded_expired"])
+        for row in storage._connect().execute("SELECT user_id, expires_at, reminded_expired FROM subscriptions")
+    }
+    before = _db_bytes()
+    print(f"version {storage.schema_version()}: {before / count:6.1f} bytes per user ({before / 1e6:.1f} MB)")
+
+    start = time.perf_counter()
+    storage.init_db()
+    elapsed = time.perf_counter() - start
+    after = _db_bytes()
+    print(f"version {storage.schema_version()}: {after / count:6.1f} bytes per user ({after / 1e6:.1f} MB)")
+    print(f"migrated {count} users in {elapsed:.1f}s, {1 - after / before:.0%} smaller")
+
+    for user_id, (expires_at, reminded_expired) in before_states.items():
+        subscription = storage.get_subscription(user_id)
+        states = storage.get_reminder_states([user_id])
+        if subscription.expires_at != expires_at or bool(states) == bool(reminded_expired):
+            raise SystemExit(f"user {user_id} changed during migration")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Storage benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+    calls = sub.add_parser("calls", help="per-call latency of a handler tap")
+    calls.add_argument("--users", type=int, default=1000)
+    calls.add_argument("--iterations", type=int, default=3000)
+    reminders = sub.add_parser("reminders", help="due-reminder query over synthetic rows")
+    reminders.add_argument("--subscriptions", type=int, default=1_000_000)
+    reminders.add_argument("--rounds", type=int, default=3)
+    migrate = sub.add_parser("migrate", help="size and duration of the compact-columns migration")
+    migrate.add_argument("--users", type=int, default=200_000)
+    args = parser.parse_args()
+
+    original_path = storage.DB_PATH
+    with tempfile.TemporaryDirectory() as tmp:
+        storage.DB_PATH = Path(tmp) / "bench.db"
+        try:
+            if args.command == "calls":
+                bench_calls(args.users, args.iterations)
+            elif args.command == "migrate":
+                bench_migrate(args.users)
+            else:
+                bench_reminders(args.subscriptions, args.rounds)
+        finally:
+            storage.close_db()
+            storage.DB_PATH = original_path
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""Benchmark VLESS URI rendering against the per-user builder it replaced.
+
+Checks that the compiled templates produce byte-identical URIs for every
+security/flow/port combination, then times rendering keys for a batch of
+users one by one and through ``build_vless_uris``::
+
+    python -m src.ops.bench_vless --users 50000
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import time
+from typing import Callable
+from urllib.parse import quote, urlencode
+
+from ..xui_api import XuiInbound, build_vless_uri, build_vless_uris
+
+
+HOST = "vpn.example.com"
+
+
+def _legacy_build_vless_uri(
+    inbound: XuiInbound,
+    client_id: str,
+    email: str,
+    host: str,
+    flow: str = "",
+    public_port: int | None = None,
+) -> str:
+    # Pre-template behaviour: params and urlencode on every call.
+    stream = inbound.stream_settings
+    security = stream.get("security", "none")
+    network = stream.get("network", "tcp")
+    params: dict[str, str] = {
+        "type": network,
+        "encryption": "none",
+    }
+    if flow:
+        params["flow"] = flow
+    if security == "reality":
+        reality = stream.get("realitySettings") or {}
+        params["security"] = "reality"
+        params["pbk"] = reality.get("publicKey", "")
+        params["fp"] = reality.get("fingerprint", "chrome")
+        server_names = reality.get("serverNames") or []
+        if server_names:
+            params["sni"] = server_names[0]
+        short_ids = reality.get("shortIds") or []
+        if short_ids:
+            params["sid"] = short_ids[0]
+        params["spx"] = reality.get("spiderX", "/")
+    elif security == "tls":
+        params["security"] = "tls"
+    port = public_port or inbound.port
+    query = urlencode(params, quote_via=quote, safe="/:")
+    return f"vless://{client_id}@{host}:{port}?{query}#{email}"
+
+
+def _inbound(security: str) -> XuiInbound:
+    stream: dict = {"network": "tcp", "security": security}
+    if security == "reality":
+        stream["realitySettings"] = {
+            "publicKey": "Zx3nY_publicKey-Base64+/=",
+            "fingerprint": "chrome",
+            "serverNames": ["www.microsoft.com", "microsoft.com"],
+            "shortIds": ["6ba85179e30d4fc2", ""],
+            "spiderX": "/path with space",
+        }
+    return XuiInbound({"id": 1, "port": 443, "protocol": "vless", "streamSettings": json.dumps(stream)})
+
+
+def _clients(count: int) -> list[tuple[str, str, str]]:
+    return [
+        (f"{user:08x}-5c1e-4c1b-9f2e-{user:012x}", f"tg_{user}", "xtls-rprx-vision" if user % 4 else "")
+        for user in range(count)
+    ]
+
+
+def _check_equivalence() -> int:
+    clients = _clients(64) + [("id", "name with space#ü", ""), ("id", "", "xtls-rprx-vision")]
+    checked = 0
+    for security in ("reality", "tls", "none"):
+        for public_port in (None, 8443):
+            inbound = _inbound(security)
+            bulk = build_vless_uris(inbound, clients, HOST, public_port)
+            for (client_id, email, flow), uri in zip(clients, bulk):
+                expected = _legacy_build_vless_uri(inbound, client_id, email, HOST, flow, public_port)
+                if build_vless_uri(inbound, client_id, email, HOST, flow, public_port) != expected or uri != expected:
+                    raise SystemExit(f"render mismatch for {security}/{public_port}/{email!r}")
+                checked += 1
+    return checked
+
+
+def _measure(label: str, render: Callable[[XuiInbound, list[tuple[str, str, str]]], list[str]], users: int) -> float:
+    clients = _clients(users)
+    # A fresh snapshot, as after an inbound refresh, so compiling is included.
+    inbound = _inbound("reality")
+    start = time.perf_counter()
+    render(inbound, clients)
+    per_uri = (time.perf_counter() - start) / users * 1e6
+    print(f"{label:<8} {per_uri:8.2f} us per URI")
+    return per_uri
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="VLESS URI render benchmark")
+    parser.add_argument("--users", type=int, default=50000)
+    args = parser.parse_args()
+
+    print(f"equivalent URIs checked: {_check_equivalence()}")
+    before = _measure(
+        "before",
+        lambda inbound, clients: [_legacy_build_vless_uri(inbound, c, e, HOST, f) for c, e, f in clients],
+        args.users,
+    )
+    single = _measure(
+        "single",
+        lambda inbound, clients: [build_vless_uri(inbound, c, e, HOST, f) for c, e, f in clients],
+        args.users,
+    )
+    bulk = _measure("bulk", lambda inbound, clients: build_vless_uris(inbound, clients, HOST), args.users)
+    print(f"speedup: {before / single:.1f}x single, {before / bulk:.1f}x bulk")
+
+
+if __name__ == "__main__":
+    main()
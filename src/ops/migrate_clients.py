@@ -0,0 +1,276 @@
+"""Provision stored users on one or more inbounds in bulk.
+
+Used to move users to a new inbound or server, or to re-issue clients
+after a panel rebuild. Users are streamed from ``user_keys`` and
+``subscriptions`` in keyset pages. New clients of a page are created with
+one ``addClient`` call per inbound, and progress is checkpointed so an
+interrupted run resumes where it stopped. Users that failed are listed in
+the checkpoint and can be provisioned again on their own::
+
+    python -m src.ops.migrate_clients --inbound-ids 7,8 --batch-size 500
+    python -m src.ops.migrate_clients --inbound-ids 7,8 --retry-failed
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+from pathlib import Path
+import sys
+import time
+from typing import Any
+
+from .. import storage
+from ..config import XUI_CONCURRENCY, XUI_FLOW
+from ..issue import client_settings, ensure_xui
+from ..panels import Panel, registry
+from ..storage import ClientRecord
+from ..xui_api import XuiApi, XuiInbound, XuiUnavailable, build_sub_url, build_vless_uris
+
+
+BASE_DIR = Path(__file__).resolve().parents[2]
+CHECKPOINT_FILE = BASE_DIR / "data" / "migrate_clients.json"
+
+
+def _load_checkpoint(path: Path, inbound_ids: list[int], restart: bool) -> dict[str, Any]:
+    fresh = {"inbound_ids": inbound_ids, "last_user_id": 0, "done": 0, "failed": []}
+    if restart or not path.exists():
+        return fresh
+    state = json.loads(path.read_text(encoding="utf-8"))
+    if state.get("inbound_ids") != inbound_ids:
+        raise SystemExit(
+            f"{path} belongs to a run for inbounds {state.get('inbound_ids')}; "
+            "pass --restart to start over"
+        )
+    return state
+
+
+def _save_checkpoint(path: Path, state: dict[str, Any]) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(state), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def _plan(inbound: XuiInbound, records: list[ClientRecord]) -> tuple[list[dict], list[dict], dict[int, dict]]:
+    """Split a page into clients to create and clients whose settings changed."""
+    new: list[dict] = []
+    changed: list[dict] = []
+    settings_by_user: dict[int, dict] = {}
+    for record in records:
+        existing = inbound.find_client(email=record.email, tg_id=str(record.user_id))
+        settings = client_settings(
+            record.user_id,
+            existing.get("id") if existing else record.client_id,
+            record.email,
+            record.sub_id,
+            record.expires_ts * 1000,
+            XUI_FLOW or (existing.get("flow") if existing else ""),
+        )
+        settings_by_user[record.user_id] = settings
+        if not existing:
+            new.append(settings)
+        elif any(existing.get(field) != value for field, value in settings.items()):
+            changed.append(settings)
+    return new, changed, settings_by_user
+
+
+async def _provision(
+    xui: XuiApi,
+    inbound: XuiInbound,
+    records: list[ClientRecord],
+    concurrency: int,
+    dry_run: bool,
+) -> tuple[dict[int, dict], set[int], int, int]:
+    new, changed, settings_by_user = _plan(inbound, records)
+    if dry_run:
+        return settings_by_user, set(), len(new), len(changed)
+    failed: set[int] = set()
+    if new:
+        result = await xui.add_clients(inbound.id, new)
+        if not result.get("success"):
+            # One bad client fails the whole call; find it one by one.
+            print(f"  inbound {inbound.id}: bulk add failed ({result.get('msg')}), adding one by one")
+            semaphore = asyncio.Semaphore(max(1, concurrency))
+
+            async def add_one(settings: dict) -> dict:
+                async with semaphore:
+                    return await xui.add_client(inbound.id, settings)
+
+            results = await asyncio.gather(*(add_one(settings) for settings in new), return_exceptions=True)
+            for outcome in results:
+                if isinstance(outcome, XuiUnavailable):
+                    raise outcome
+            for settings, outcome in zip(new, results):
+                if isinstance(outcome, BaseException) or not outcome.get("success"):
+                    failed.add(int(settings["tgId"]))
+    if changed:
+        results = await xui.update_clients(inbound.id, changed, concurrency)
+        for settings, outcome in zip(changed, results):
+            if not outcome.get("success"):
+                failed.add(int(settings["tgId"]))
+    return settings_by_user, failed, len(new), len(changed)
+
+
+def _progress(done: int, total: int, started: float, processed: int, failed: int) -> str:
+    elapsed = max(time.monotonic() - started, 1e-6)
+    rate = processed / elapsed
+    remaining = max(total - done, 0)
+    eta = remaining / rate if rate else 0.0
+    percent = done / total * 100 if total else 100.0
+    return (
+        f"[{done:>7}/{total}] {percent:5.1f}% | {rate:7.1f} users/s | "
+        f"eta {eta:6.0f}s | failed {failed}"
+    )
+
+
+async def _migrate_page(
+    xui: XuiApi,
+    panel: Panel,
+    inbounds: list[XuiInbound],
+    records: list[ClientRecord],
+    args: argparse.Namespace,
+) -> tuple[set[int], int, int]:
+    """Provision one page of users; returns ``(failed user ids, created, updated)``."""
+    failed: set[int] = set()
+    created = updated = 0
+    primary_settings: dict[int, dict] = {}
+    for position, inbound in enumerate(inbounds):
+        settings_by_user, inbound_failed, new_count, changed_count = await _provision(
+            xui, inbound, records, args.concurrency, args.dry_run
+        )
+        failed |= inbound_failed
+        created += new_count
+        updated += changed_count
+        if position == 0:
+            primary_settings = settings_by_user
+    if args.rewrite_keys and not args.dry_run:
+        issued = [(user_id, settings) for user_id, settings in primary_settings.items() if user_id not in failed]
+        uris = build_vless_uris(
+            inbounds[0],
+            [(settings["id"], settings["email"], settings.get("flow", "")) for _, settings in issued],
+            host=panel.host,
+            public_port=panel.public_port,
+        )
+        rows = [
+            (
+                user_id,
+                uri,
+                build_sub_url(panel.sub_base, settings["subId"]),
+                settings["id"],
+                settings["email"],
+                settings["subId"],
+            )
+            for (user_id, settings), uri in zip(issued, uris)
+        ]
+        storage.set_user_keys_many(rows)
+        storage.set_panels_many([row[0] for row in rows], panel.name)
+    return failed, created, updated
+
+
+async def migrate(args: argparse.Namespace) -> int:
+    inbound_ids = [int(part) for part in args.inbound_ids.split(",") if part.strip().isdigit()]
+    if not inbound_ids:
+        raise SystemExit("--inbound-ids must list at least one inbound id")
+    if args.retry_failed and args.restart:
+        raise SystemExit("--retry-failed needs the checkpoint that --restart discards")
+    storage.init_db()
+    state = _load_checkpoint(args.checkpoint, inbound_ids, args.restart)
+    min_expires_ts = 0 if args.include_expired else int(time.time())
+    if args.retry_failed:
+        retry = list(state["failed"])
+        if not retry:
+            print("No failed users recorded in the checkpoint")
+            return 0
+        pending = storage.get_client_records(retry, min_expires_ts)
+        print(f"Retrying {len(pending)} of {len(retry)} failed user(s); the others are no longer provisioned")
+        total = len(pending)
+    else:
+        pending = []
+        total = state["done"] + storage.count_client_records(state["last_user_id"], min_expires_ts)
+        if state["last_user_id"]:
+            print(f"Resuming after user {state['last_user_id']} ({state['done']} done)")
+
+    panel = registry.get(args.panel) if args.panel else registry.primary
+    if not panel:
+        raise SystemExit(f"Unknown panel {args.panel!r}" if args.panel else "XUI is not configured")
+    xui = await ensure_xui(panel)
+    started = time.monotonic()
+    processed = 0
+    created = updated = 0
+    try:
+        inbounds: list[XuiInbound] = []
+        for inbound_id in inbound_ids:
+            inbound = await xui.get_inbound(inbound_id, fresh=True)
+            if not inbound:
+                raise SystemExit(f"Inbound {inbound_id} not found")
+            inbounds.append(inbound)
+
+        if args.retry_failed:
+            still_failed: set[int] = set()
+            for start in range(0, len(pending), args.batch_size):
+                records = pending[start:start + args.batch_size]
+                failed, page_created, page_updated = await _migrate_page(xui, panel, inbounds, records, args)
+                still_failed |= failed
+                created += page_created
+                updated += page_updated
+                processed += len(records)
+                print(_progress(processed, total, started, processed, len(still_failed)), flush=True)
+            state["failed"] = sorted(still_failed)
+            if not args.dry_run:
+                _save_checkpoint(args.checkpoint, state)
+        else:
+            while True:
+                records = storage.list_client_records(state["last_user_id"], args.batch_size, min_expires_ts)
+                if not records:
+                    break
+                failed, page_created, page_updated = await _migrate_page(xui, panel, inbounds, records, args)
+                created += page_created
+                updated += page_updated
+                state["last_user_id"] = records[-1].user_id
+                state["done"] += len(records)
+                state["failed"] = sorted(set(state["failed"]) | failed)
+                if not args.dry_run:
+                    _save_checkpoint(args.checkpoint, state)
+                processed += len(records)
+                print(_progress(state["done"], total, started, processed, len(state["failed"])), flush=True)
+    finally:
+        # The client belongs to the registry; close it there so none is left closed in it.
+        await registry.close()
+
+    verb = "would create" if args.dry_run else "created"
+    print(f"Done: {verb} {created}, {'would update' if args.dry_run else 'updated'} {updated} client(s)")
+    if state["failed"]:
+        print(f"Failed users ({len(state['failed'])}): {' '.join(map(str, state['failed']))}")
+        print("Re-run with --retry-failed to provision only them; unchanged clients are skipped.")
+        return 1
+    return 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Bulk-provision stored users on 3x-ui inbounds")
+    parser.add_argument("--panel", default="", help="target panel name (default: the primary panel)")
+    parser.add_argument("--inbound-ids", required=True, help="comma-separated target inbound ids")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=XUI_CONCURRENCY, help="parallel updateClient calls")
+    parser.add_argument("--checkpoint", type=Path, default=CHECKPOINT_FILE)
+    parser.add_argument("--restart", action="store_true", help="ignore an existing checkpoint")
+    parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="only re-provision the users the checkpoint lists as failed",
+    )
+    parser.add_argument("--include-expired", action="store_true", help="also provision expired subscriptions")
+    parser.add_argument(
+        "--rewrite-keys",
+        action="store_true",
+        help="point stored keys (and panel assignments) at the first target inbound",
+    )
+    parser.add_argument("--dry-run", action="store_true", help="report what would change without writing")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(migrate(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""Registry of 3x-ui panels and per-user placement.
+
+Panels come from the JSON file named by ``XUI_PANELS_FILE``; without it the
+single panel described by the ``XUI_*`` variables is used, so existing
+deployments keep working unchanged. A user is placed once, on a weighted
+consistent-hash ring, and the assignment is stored in ``panel_assignments``.
+Later issues for that user always go to the same panel, so adding a node
+(or changing weights) only affects users who have not been placed yet.
+A panel with ``weight`` 0 is drained: it keeps its users but gets no new ones.
+"""
+from __future__ import annotations
+
+from bisect import bisect
+from dataclasses import dataclass
+import hashlib
+import json
+import logging
+from pathlib import Path
+from typing import Any, Optional
+
+from . import async_storage
+from .config import (
+    XUI_API_PATH,
+    XUI_BASE_URL,
+    XUI_INBOUND_ID,
+    XUI_INBOUND_IDS,
+    XUI_PANELS_FILE,
+    XUI_PASSWORD,
+    XUI_PUBLIC_HOST,
+    XUI_PUBLIC_PORT,
+    XUI_SSL_VERIFY,
+    XUI_SUB_BASE_URL,
+    XUI_USERNAME,
+)
+from .xui_api import XuiApi
+
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+# Ring points per unit of weight; enough to keep the split close to the weights.
+VNODES_PER_WEIGHT = 256
+
+# Stored for users provisioned before panels were tracked: the primary panel.
+LEGACY_PANEL = ""
+
+
+def _parse_ids(raw: Any) -> tuple[int, ...]:
+    if isinstance(raw, str):
+        raw = raw.split(",")
+    ids: list[int] = []
+    for value in raw or []:
+        value = str(value).strip()
+        if value.isdigit() and int(value) not in ids:
+            ids.append(int(value))
+    return tuple(ids)
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+@dataclass(frozen=True)
+class Panel:
+    name: str
+    base_url: str
+    username: str
+    password: str
+    inbound_ids: tuple[int, ...]
+    weight: int = 1
+    api_path: str = "/panel/api"
+    verify_ssl: bool = True
+    public_host: str = ""
+    public_port: Optional[int] = None
+    sub_base_url: str = ""
+
+    @property
+    def host(self) -> str:
+        if self.public_host:
+            return self.public_host
+        if self.base_url.startswith("http"):
+            return self.base_url.split("://", 1)[1].split(":", 1)[0]
+        return ""
+
+    @property
+    def sub_base(self) -> str:
+        return self.sub_base_url or self.base_url
+
+    @classmethod
+    def from_dict(cls, raw: dict[str, Any]) -> "Panel":
+        port = str(raw.get("public_port", "") or "").strip()
+        return cls(
+            name=str(raw["name"]),
+            base_url=str(raw["base_url"]).rstrip("/"),
+            username=str(raw.get("username") or XUI_USERNAME),
+            password=str(raw.get("password") or XUI_PASSWORD),
+            inbound_ids=_parse_ids(raw.get("inbound_ids")),
+            weight=max(0, int(raw.get("weight", 1))),
+            api_path=str(raw.get("api_path") or XUI_API_PATH or "/panel/api"),
+            verify_ssl=bool(raw.get("verify_ssl", XUI_SSL_VERIFY)),
+            public_host=str(raw.get("public_host") or ""),
+            public_port=int(port) if port.isdigit() else None,
+            sub_base_url=str(raw.get("sub_base_url") or ""),
+        )
+
+
+def load_panels() -> list[Panel]:
+    if XUI_PANELS_FILE:
+        path = Path(XUI_PANELS_FILE)
+        if not path.is_absolute():
+            path = BASE_DIR / path
+        return [Panel.from_dict(raw) for raw in json.loads(path.read_text(encoding="utf-8"))]
+    if not (XUI_BASE_URL and XUI_USERNAME and XUI_PASSWORD):
+        return []
+    return [
+        Panel.from_dict(
+            {
+                "name": "default",
+                "base_url": XUI_BASE_URL,
+                "inbound_ids": XUI_INBOUND_IDS or XUI_INBOUND_ID,
+                "public_host": XUI_PUBLIC_HOST,
+                "public_port": XUI_PUBLIC_PORT,
+                "sub_base_url": XUI_SUB_BASE_URL,
+            }
+        )
+    ]
+
+
+class PanelRegistry:
+    def __init__(self, panels: list[Panel]) -> None:
+        self.panels = list(panels)
+        self._by_name = {panel.name: panel for panel in self.panels}
+        if len(self._by_name) != len(self.panels):
+            raise ValueError("Panel names must be unique")
+        self._ring = sorted(
+            (_hash(f"{panel.name}#{vnode}"), panel.name)
+            for panel in self.panels
+            for vnode in range(panel.weight * VNODES_PER_WEIGHT)
+        )
+        self._points = [point for point, _ in self._ring]
+        self._clients: dict[str, XuiApi] = {}
+
+    @property
+    def primary(self) -> Optional[Panel]:
+        return self.panels[0] if self.panels else None
+
+    def get(self, name: str) -> Optional[Panel]:
+        if name == LEGACY_PANEL:
+            return self.primary
+        return self._by_name.get(name)
+
+    def place(self, user_id: int) -> Panel:
+        """Panel a not-yet-assigned user belongs on."""
+        if not self._ring:
+            raise RuntimeError("No XUI panel accepts new users")
+        position = bisect(self._points, _hash(str(user_id))) % len(self._ring)
+        return self._by_name[self._ring[position][1]]
+
+    async def resolve(self, user_id: int) -> Panel:
+        """The user's panel, placing and persisting it on first use."""
+        name = await async_storage.get_panel(user_id)
+        if name is not None:
+            panel = self.get(name)
+            if panel:
+                return panel
+            logging.warning("User %s is assigned to unknown panel %r, re-placing", user_id, name)
+            panel = self.place(user_id)
+            await async_storage.set_panel(user_id, panel.name)
+            return panel
+        # Another process may place the same user concurrently; the first
+        # stored assignment wins.
+        stored = await async_storage.assign_panel(user_id, self.place(user_id).name)
+        return self.get(stored) or self.place(user_id)
+
+    def client(self, panel: Panel) -> XuiApi:
+        xui = self._clients.get(panel.name)
+        if xui is None:
+            xui = XuiApi(
+                panel.base_url,
+                panel.username,
+                panel.password,
+                api_path=panel.api_path,
+                verify_ssl=panel.verify_ssl,
+            )
+            self._clients[panel.name] = xui
+        return xui
+
+    def invalidate_inbounds(self) -> None:
+        """Drop cached inbound snapshots, e.g. after another process added clients."""
+        for xui in self._clients.values():
+            xui.invalidate_inbound()
+
+    async def close(self) -> None:
+        clients, self._clients = self._clients, {}
+        for xui in clients.values():
+            await xui.close()
+
+
+registry = PanelRegistry(load_panels())
@@ -0,0 +1,174 @@
+"""Durable queue between payment webhooks and key issuance.
+
+Webhook handlers only validate an event, store it in ``payment_jobs`` and
+acknowledge it. :class:`PaymentWorkers` lease due jobs and run them. A
+failed job is retried with jittered exponential backoff, and one that keeps
+failing is dead-lettered for an admin to inspect and re-drive
+(``/payment_retry``). Jobs leased by a worker that died become due again
+once the lease runs out.
+"""
+from __future__ import annotations
+
+import asyncio
+from collections import OrderedDict
+import hashlib
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Optional
+
+from .async_storage import (
+    claim_payment_jobs,
+    complete_payment_job,
+    dead_letter_payment_job,
+    enqueue_payment_job,
+    recent_payment_job_keys,
+    retry_payment_job,
+)
+from .config import (
+    PAYMENT_JOB_LEASE_SECONDS,
+    PAYMENT_LEDGER_CACHE_SIZE,
+    PAYMENT_MAX_ATTEMPTS,
+    PAYMENT_RETRY_BASE_SECONDS,
+    PAYMENT_RETRY_MAX_SECONDS,
+    PAYMENT_WORKERS,
+)
+from .storage import PaymentJob
+
+
+JobHandler = Callable[[PaymentJob], Awaitable[None]]
+DeadLetterHandler = Callable[[PaymentJob, str], Awaitable[None]]
+
+
+def idempotency_key(source: str, event_id: str, raw: bytes) -> str:
+    """Key identifying one payment event across provider redeliveries.
+
+    Prefer the provider's own event/order id; fall back to the body hash,
+    which still catches byte-identical redeliveries.
+    """
+    if event_id:
+        return f"{source}:{event_id}"
+    return f"{source}:sha256:{hashlib.sha256(raw).hexdigest()}"
+
+
+class EventLedger:
+    """Deduplicates payment events before they reach the queue.
+
+    ``payment_jobs`` (unique on the idempotency key) is the persisted
+    ledger. This bounded in-memory front answers redeliveries of recent
+    events with a dict lookup, without a database write and without ever
+    reaching 3x-ui.
+    """
+
+    def __init__(self, max_size: int = PAYMENT_LEDGER_CACHE_SIZE) -> None:
+        self.max_size = max(1, max_size)
+        self.hits = 0
+        self._keys: OrderedDict[str, int] = OrderedDict()
+
+    def _remember(self, key: str, job_id: int) -> None:
+        self._keys[key] = job_id
+        self._keys.move_to_end(key)
+        while len(self._keys) > self.max_size:
+            self._keys.popitem(last=False)
+
+    async def warm(self) -> None:
+        """Preload the newest keys so a restart does not open a window."""
+        for key, job_id in reversed(await recent_payment_job_keys(self.max_size)):
+            self._remember(key, job_id)
+
+    async def record(
+        self,
+        key: str,
+        source: str,
+        user_id: int,
+        plan_code: str,
+        payload: str,
+    ) -> tuple[int, bool]:
+        """Queue the event unless it was seen before; returns ``(job_id, created)``."""
+        job_id = self._keys.get(key)
+        if job_id is not None:
+            self.hits += 1
+            self._keys.move_to_end(key)
+            return job_id, False
+        job_id, created = await enqueue_payment_job(key, source, user_id, plan_code, payload)
+        self._remember(key, job_id)
+        return job_id, created
+
+
+class PaymentWorkers:
+    def __init__(
+        self,
+        handler: JobHandler,
+        on_dead: Optional[DeadLetterHandler] = None,
+        workers: int = PAYMENT_WORKERS,
+        max_attempts: int = PAYMENT_MAX_ATTEMPTS,
+        retry_base: float = PAYMENT_RETRY_BASE_SECONDS,
+        retry_max: float = PAYMENT_RETRY_MAX_SECONDS,
+        lease_seconds: int = PAYMENT_JOB_LEASE_SECONDS,
+        poll_seconds: float = 5.0,
+    ) -> None:
+        self._handler = handler
+        self._on_dead = on_dead
+        self.workers = max(1, workers)
+        self.max_attempts = max(1, max_attempts)
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self._wake: Optional[asyncio.Event] = None
+
+    def wake(self) -> None:
+        """Tell idle workers a job was just queued."""
+        if self._wake:
+            self._wake.set()
+
+    def _retry_delay(self, attempts: int) -> float:
+        ceiling = min(self.retry_max, self.retry_base * 2 ** (attempts - 1))
+        return random.uniform(ceiling / 2, ceiling)
+
+    async def run(self) -> None:
+        self._wake = asyncio.Event()
+        try:
+            await asyncio.gather(*(self._worker() for _ in range(self.workers)))
+        finally:
+            self._wake = None
+
+    async def _worker(self) -> None:
+        while True:
+            # Cleared before claiming, so a wake() during the claim is kept.
+            self._wake.clear()
+            try:
+                jobs = await claim_payment_jobs(1, int(time.time()), self.lease_seconds)
+            except Exception:
+                logging.exception("Failed to claim payment jobs")
+                jobs = []
+            if jobs:
+                await self._process(jobs[0])
+                continue
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _process(self, job: PaymentJob) -> None:
+        try:
+            await self._handler(job)
+        except Exception as exc:
+            error = f"{type(exc).__name__}: {exc}"
+            if job.attempts >= self.max_attempts:
+                logging.error("Payment job %s dead after %s attempts: %s", job.id, job.attempts, error)
+                await dead_letter_payment_job(job.id, error)
+                if self._on_dead:
+                    try:
+                        await self._on_dead(job, error)
+                    except Exception:
+                        logging.exception("Dead-letter notification failed for job %s", job.id)
+                return
+            delay = self._retry_delay(job.attempts)
+            logging.warning(
+                "Payment job %s failed (attempt %s/%s), retrying in %.0fs: %s",
+                job.id, job.attempts, self.max_attempts, delay, error,
+            )
+            await retry_payment_job(job.id, error, int(time.time() + delay))
+            return
+        await complete_payment_job(job.id)
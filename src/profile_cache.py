@@ -0,0 +1,161 @@
+"""Bounded in-process cache of per-user profiles (lang, key, subscription)."""
+from __future__ import annotations
+
+import asyncio
+from collections import OrderedDict
+from dataclasses import replace
+import logging
+import threading
+import time
+from typing import Optional
+
+from . import async_storage, storage
+from .config import LAST_SEEN_FLUSH_SECONDS, PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL_SECONDS
+from .storage import UserProfile
+
+
+# Users without a key are usually about to pay; their key may be written by
+# the webhook process, so keep that negative state only briefly.
+NO_KEY_TTL_SECONDS = 5.0
+
+
+class ProfileCache:
+    """LRU + TTL cache in front of ``storage.get_profile``.
+
+    Language changes are written through. Key and subscription writes made
+    through :mod:`src.storage` in this process invalidate the entry via the
+    storage change hook; writes from other processes arrive the same way
+    through the change feed, and the TTL bounds anything missed.
+    """
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries: OrderedDict[int, tuple[float, UserProfile]] = OrderedDict()
+        # user_id -> "invalidated while loading" flag for in-flight misses.
+        self._loading: dict[int, bool] = {}
+        self._lock = threading.Lock()
+        self._attached = False
+        # Coalesced last-seen timestamps waiting for the next flush.
+        self._seen: dict[int, int] = {}
+
+    def attach(self) -> None:
+        if not self._attached:
+            storage.on_change(self._on_storage_change)
+            self._attached = True
+
+    def detach(self) -> None:
+        if self._attached:
+            storage.remove_listener(self._on_storage_change)
+            self._attached = False
+
+    def _on_storage_change(self, kind: str, user_id: int) -> None:
+        # "user" writes only carry the language, which is written through.
+        if kind in ("key", "subscription"):
+            self.invalidate(user_id)
+
+    def _lookup(self, user_id: int) -> Optional[UserProfile]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            expires, profile = entry
+            if expires < time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return profile
+
+    def _store(self, profile: UserProfile) -> None:
+        ttl = self.ttl if profile.vless_uri else min(self.ttl, NO_KEY_TTL_SECONDS)
+        with self._lock:
+            self._entries[profile.user_id] = (time.monotonic() + ttl, profile)
+            self._entries.move_to_end(profile.user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    async def get(self, user_id: int) -> UserProfile:
+        profile = self._lookup(user_id)
+        if profile is not None:
+            self.hits += 1
+            return profile
+        self.misses += 1
+        with self._lock:
+            self._loading[user_id] = False
+        try:
+            profile = await async_storage.get_profile(user_id)
+        finally:
+            with self._lock:
+                stale = self._loading.pop(user_id, True)
+        if not stale:
+            self._store(profile)
+        return profile
+
+    async def get_lang(self, user_id: int) -> str:
+        return (await self.get(user_id)).lang
+
+    async def set_lang(self, user_id: int, lang: str) -> None:
+        await async_storage.upsert_user(user_id, lang)
+        profile = self._lookup(user_id)
+        if profile is not None:
+            self._store(replace(profile, lang=lang, registered=True))
+
+    async def touch(self, user_id: int, lang: str) -> None:
+        """Note user activity; only hits the database if ``lang`` changed.
+
+        The last-seen timestamp is buffered and written by ``flush_last_seen``.
+        """
+        profile = await self.get(user_id)
+        if not profile.registered or profile.lang != lang:
+            await self.set_lang(user_id, lang)
+        self._seen[user_id] = int(time.time())
+
+    async def flush_last_seen(self) -> int:
+        seen, self._seen = self._seen, {}
+        if seen:
+            await async_storage.touch_users(seen)
+        return len(seen)
+
+    async def run_flush_loop(self, interval: float = LAST_SEEN_FLUSH_SECONDS) -> None:
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    await self.flush_last_seen()
+                except Exception:
+                    logging.exception("Failed to flush last-seen timestamps")
+        finally:
+            await self.flush_last_seen()
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            if user_id in self._loading:
+                self._loading[user_id] = True
+            if self._entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            for user_id in self._loading:
+                self._loading[user_id] = True
+
+    def stats(self) -> dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+profiles = ProfileCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL_SECONDS)
@@ -0,0 +1,164 @@
+"""Deadline-driven reminder scheduler.
+
+Instead of re-scanning subscriptions on a fixed interval, the scheduler
+keeps a min-heap of each user's next reminder moment and sleeps until the
+earliest one. Writes made through :mod:`src.storage` wake it up to re-plan
+the affected user, including writes from other processes once they arrive
+through the change feed. The whole schedule is only loaded at startup and,
+as a safety net for changes the feed lost, every ``resync_seconds`` (daily
+by default; 0 turns it off).
+"""
+from __future__ import annotations
+
+import asyncio
+from datetime import datetime, timezone
+import heapq
+import itertools
+import logging
+import math
+import time
+from typing import Awaitable, Callable, Iterable, Optional
+
+from . import storage
+from .async_storage import get_reminder_states, list_due_reminders, list_reminder_states
+from .storage import Reminder, ReminderState
+
+
+DAY = 24 * 3600
+
+Dispatch = Callable[[list[Reminder]], Awaitable[None]]
+
+
+def next_deadline(state: ReminderState, now_ts: float) -> int:
+    """Moment the next pending reminder for ``state`` becomes due.
+
+    Mirrors the windows in ``storage.list_due_reminders``: a 3-day reminder
+    that was never sent is skipped once the 1-day window has started.
+    """
+    if not state.reminded_3d and now_ts < state.expires_ts - DAY:
+        return state.expires_ts - 3 * DAY
+    if not state.reminded_1d and now_ts < state.expires_ts:
+        return state.expires_ts - DAY
+    return state.expires_ts
+
+
+class ReminderScheduler:
+    def __init__(self, dispatch: Dispatch, resync_seconds: float, retry_seconds: float) -> None:
+        self._dispatch = dispatch
+        self._resync_seconds = max(resync_seconds, 1.0) if resync_seconds > 0 else math.inf
+        self._retry_seconds = max(retry_seconds, 1.0)
+        self._heap: list[tuple[float, int, int]] = []
+        self._tokens: dict[int, int] = {}
+        self._counter = itertools.count()
+        self._dirty: set[int] = set()
+        self._wake: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+    def next_wakeup(self) -> Optional[float]:
+        self._drop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def notify(self, user_id: int) -> None:
+        """Re-plan ``user_id``; safe to call from any thread."""
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        loop.call_soon_threadsafe(self._mark_dirty, user_id)
+
+    def _on_storage_change(self, kind: str, user_id: int) -> None:
+        if kind == "subscription":
+            self.notify(user_id)
+
+    def _mark_dirty(self, user_id: int) -> None:
+        self._dirty.add(user_id)
+        if self._wake:
+            self._wake.set()
+
+    def _push(self, state: ReminderState, now_ts: float, not_before: float = 0.0) -> None:
+        token = next(self._counter)
+        self._tokens[state.user_id] = token
+        deadline = max(next_deadline(state, now_ts), not_before)
+        heapq.heappush(self._heap, (deadline, token, state.user_id))
+
+    def _drop_stale(self) -> None:
+        heap = self._heap
+        while heap and self._tokens.get(heap[0][2]) != heap[0][1]:
+            heapq.heappop(heap)
+
+    def _pop_due(self, now_ts: float) -> set[int]:
+        due: set[int] = set()
+        heap = self._heap
+        while heap and heap[0][0] <= now_ts:
+            _, token, user_id = heapq.heappop(heap)
+            if self._tokens.get(user_id) == token:
+                del self._tokens[user_id]
+                due.add(user_id)
+        return due
+
+    def load(self, states: Iterable[ReminderState], now_ts: float) -> None:
+        self._heap = []
+        self._tokens = {}
+        for state in states:
+            token = next(self._counter)
+            self._tokens[state.user_id] = token
+            self._heap.append((next_deadline(state, now_ts), token, state.user_id))
+        heapq.heapify(self._heap)
+
+    async def _refresh(self, user_ids: set[int], not_before: float = 0.0) -> None:
+        if not user_ids:
+            return
+        states = await get_reminder_states(user_ids)
+        now_ts = time.time()
+        for user_id in user_ids:
+            self._tokens.pop(user_id, None)
+        for state in states:
+            deadline = next_deadline(state, now_ts)
+            self._push(state, now_ts, not_before if deadline <= now_ts else 0.0)
+
+    async def _fire(self, due: set[int]) -> None:
+        reminders = await list_due_reminders(datetime.now(timezone.utc))
+        try:
+            await self._dispatch(reminders)
+        except Exception:
+            logging.exception("Reminder dispatch failed")
+        # Anything still due after dispatch was not delivered; retry later
+        # instead of spinning on it.
+        touched = due | {reminder.user_id for reminder in reminders}
+        await self._refresh(touched, not_before=time.time() + self._retry_seconds)
+
+    async def run(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        storage.on_change(self._on_storage_change)
+        try:
+            next_resync = 0.0
+            while True:
+                if time.monotonic() >= next_resync:
+                    self.load(await list_reminder_states(), time.time())
+                    self._dirty.clear()
+                    next_resync = time.monotonic() + self._resync_seconds
+                    logging.info("Reminder scheduler tracking %s subscriptions", len(self))
+                if self._dirty:
+                    dirty, self._dirty = self._dirty, set()
+                    await self._refresh(dirty)
+                due = self._pop_due(time.time())
+                if due:
+                    await self._fire(due)
+                    continue
+                timeout = next_resync - time.monotonic()
+                wakeup = self.next_wakeup()
+                if wakeup is not None:
+                    timeout = min(timeout, wakeup - time.time())
+                self._wake.clear()
+                if self._dirty:
+                    continue
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=max(timeout, 0.0) if timeout < math.inf else None)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            storage.remove_listener(self._on_storage_change)
+            self._loop = None
@@ -0,0 +1,246 @@
+"""Rate-limited bulk sending for reminders and other broadcasts."""
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass, field
+import logging
+import time
+from typing import Any, Awaitable, Callable, Iterable, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+
+class TokenBucket:
+    """Async token bucket shared by all senders of one bot.
+
+    ``block_for`` empties the bucket and holds every caller back, which is
+    how a flood-wait from Telegram is applied globally rather than per task.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None) -> None:
+        self.rate = max(rate, 0.1)
+        self.capacity = capacity if capacity is not None else max(1.0, self.rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def block_for(self, seconds: float) -> None:
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+        self._updated = self._blocked_until
+
+
+@dataclass
+class SendJob:
+    chat_id: int
+    text: str
+    reply_markup: Any = None
+    payload: Any = None
+
+
+@dataclass
+class SendStats:
+    sent: int = 0
+    failed: int = 0
+    retries: int = 0
+    flood_waits: int = 0
+    started: float = field(default_factory=time.monotonic)
+    finished: float = 0.0
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rate(self) -> float:
+        return self.sent / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self) -> str:
+        return (
+            f"sent={self.sent} failed={self.failed} retries={self.retries} "
+            f"flood_waits={self.flood_waits} elapsed={self.elapsed:.1f}s "
+            f"rate={self.rate:.1f} msg/s"
+        )
+
+
+BatchCallback = Callable[[list[SendJob]], Awaitable[None]]
+
+
+async def send_one(bot: Bot, bucket: TokenBucket, job: SendJob, stats: SendStats, max_retries: int = 3) -> bool:
+    """Send ``job`` within the bucket's rate; False if it could not be delivered."""
+    attempt = 0
+    while True:
+        await bucket.acquire()
+        try:
+            await bot.send_message(job.chat_id, job.text, reply_markup=job.reply_markup)
+            return True
+        except TelegramRetryAfter as exc:
+            stats.flood_waits += 1
+            bucket.block_for(exc.retry_after)
+            logging.warning("Flood wait %ss while sending to %s", exc.retry_after, job.chat_id)
+        except TelegramForbiddenError:
+            return False
+        except (TelegramNetworkError, TelegramServerError):
+            attempt += 1
+            if attempt > max_retries:
+                logging.exception("Giving up sending to %s", job.chat_id)
+                return False
+            stats.retries += 1
+            await asyncio.sleep(min(2 ** attempt, 30))
+        except Exception:
+            logging.exception("Failed to send message to %s", job.chat_id)
+            return False
+
+
+class SendScheduler:
+    """Send many messages concurrently without exceeding the bot's rate.
+
+    Delivered jobs are handed to ``on_batch`` in groups of ``batch_size`` so
+    the caller can persist their state in one transaction per batch.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        rate: float,
+        concurrency: int,
+        max_retries: int = 3,
+        bucket: Optional[TokenBucket] = None,
+    ) -> None:
+        self.bot = bot
+        self.bucket = bucket or TokenBucket(rate)
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+
+    async def _send(self, job: SendJob, stats: SendStats) -> bool:
+        return await send_one(self.bot, self.bucket, job, stats, self.max_retries)
+
+    async def run(
+        self,
+        jobs: Iterable[SendJob],
+        on_batch: Optional[BatchCallback] = None,
+        batch_size: int = 200,
+    ) -> SendStats:
+        stats = SendStats()
+        queue: asyncio.Queue[Optional[SendJob]] = asyncio.Queue()
+        for job in jobs:
+            queue.put_nowait(job)
+        delivered: list[SendJob] = []
+        flush_lock = asyncio.Lock()
+
+        async def flush(force: bool = False) -> None:
+            async with flush_lock:
+                if not delivered or (len(delivered) < batch_size and not force):
+                    return
+                batch = delivered[:]
+                delivered.clear()
+                if on_batch:
+                    await on_batch(batch)
+
+        async def worker() -> None:
+            while True:
+                job = await queue.get()
+                if job is None:
+                    return
+                if await self._send(job, stats):
+                    stats.sent += 1
+                    delivered.append(job)
+                    await flush()
+                else:
+                    stats.failed += 1
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        for _ in workers:
+            queue.put_nowait(None)
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            await flush(force=True)
+            stats.finished = time.monotonic()
+        return stats
+
+
+class Outbox:
+    """Long-lived, bounded queue of notifications for one bot.
+
+    A fixed pool of senders drains the queue through a shared token bucket,
+    so a burst of events waits in memory (and, once the queue is full, at
+    ``post``/``deliver``) instead of opening more connections to Telegram.
+    """
+
+    def __init__(self, bot: Bot, rate: float, concurrency: int, max_size: int, max_retries: int = 3) -> None:
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+        self.stats = SendStats()
+        self._queue: asyncio.Queue[tuple[SendJob, Optional[asyncio.Future]]] = asyncio.Queue(maxsize=max(1, max_size))
+        self._workers: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def close(self, timeout: float = 10.0) -> None:
+        """Give queued messages ``timeout`` seconds to go out, then stop."""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Dropping %s queued notification(s) on shutdown", self._queue.qsize())
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            if future and not future.done():
+                future.cancel()
+
+    async def post(self, chat_id: int, text: str, reply_markup: Any = None) -> None:
+        """Queue a message without waiting for it to be sent."""
+        await self._queue.put((SendJob(chat_id, text, reply_markup), None))
+
+    async def deliver(self, chat_id: int, text: str, reply_markup: Any = None) -> bool:
+        """Queue a message and wait until it was sent (True) or given up on."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((SendJob(chat_id, text, reply_markup), future))
+        return await future
+
+    async def _worker(self) -> None:
+        while True:
+            job, future = await self._queue.get()
+            try:
+                delivered = await send_one(self.bot, self.bucket, job, self.stats, self.max_retries)
+                if delivered:
+                    self.stats.sent += 1
+                else:
+                    self.stats.failed += 1
+                if future and not future.done():
+                    future.set_result(delivered)
+            except asyncio.CancelledError:
+                if future and not future.done():
+                    future.cancel()
+                raise
+            finally:
+                self._queue.task_done()
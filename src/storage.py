@@ -1,15 +1,39 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from datetime import datetime, timezone
+import logging
 from pathlib import Path
+import os
 import sqlite3
-from typing import List
+import threading
+import time
+from typing import Callable, Iterable, List
 
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 DB_PATH = BASE_DIR / "data" / "bot.db"
 
+# Applied once per connection. WAL lets readers run alongside the writer,
+# NORMAL sync is durable across app crashes in WAL mode, and the busy
+# timeout replaces the old per-connect ``timeout=10``. Incremental
+# auto-vacuum only takes effect on a new database (it has to precede WAL)
+# or at the next full VACUUM, see ``src.ops.archive``.
+_PRAGMAS = (
+    "PRAGMA auto_vacuum=INCREMENTAL",
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=10000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+)
+_STATEMENT_CACHE_SIZE = 256
+
+_local = threading.local()
+
+ChangeListener = Callable[[str, int], None]
+_listeners: List[ChangeListener] = []
+
 
 @dataclass(frozen=True)
 class Reminder:
@@ -25,18 +49,514 @@ class SubscriptionInfo:
     status: str
 
 
+@dataclass(frozen=True)
+class UserProfile:
+    user_id: int
+    lang: str
+    vless_uri: str
+    sub_url: str
+    subscription: SubscriptionInfo | None
+    registered: bool = True
+
+
+@dataclass(frozen=True)
+class ReminderState:
+    user_id: int
+    expires_ts: int
+    reminded_3d: bool
+    reminded_1d: bool
+
+
+@dataclass(frozen=True)
+class PaymentJob:
+    id: int
+    idempotency_key: str
+    source: str
+    user_id: int
+    plan_code: str
+    stage: str
+    attempts: int
+    last_error: str = ""
+    target_expires_ts: int = 0
+
+
+@dataclass(frozen=True)
+class ClientRecord:
+    user_id: int
+    client_id: str
+    email: str
+    sub_id: str
+    expires_ts: int
+
+
+@dataclass(frozen=True)
+class SubscriptionSource:
+    """What a subscription document for ``sub_id`` is built from."""
+
+    user_id: int
+    vless_uri: str
+    client_id: str
+    email: str
+    panel: str | None
+    expires_ts: int
+    up: int
+    down: int
+
+
+@dataclass(frozen=True)
+class TrafficClient:
+    panel: str
+    email: str
+    user_id: int
+    online_ts: int
+
+
+# Bits of ``subscriptions.reminders``: reminders already sent for the
+# current expiry. ``set_subscription`` resets them.
+REMIND_3D = 1
+REMIND_1D = 2
+REMIND_0D = 4
+REMIND_EXPIRED = 8
+REMINDER_BITS = {"3d": REMIND_3D, "1d": REMIND_1D, "0d": REMIND_0D, "expired": REMIND_EXPIRED}
+
+# Bucket widths of ``traffic_usage``; older buckets are folded into the next one.
+TRAFFIC_MINUTE = 60
+TRAFFIC_HOUR = 3600
+TRAFFIC_DAY = 86400
+
+
+def on_change(listener: ChangeListener) -> None:
+    """Register ``listener(kind, user_id)`` to run after a committed write.
+
+    ``kind`` is ``"user"``, ``"subscription"`` or ``"key"``. Listeners run on
+    the writing thread, so they must be quick and thread-safe. Writes made by
+    other processes reach them through ``change_log`` once a
+    :class:`~src.coordination.ChangeFeed` is running.
+    """
+    _listeners.append(listener)
+
+
+def remove_listener(listener: ChangeListener) -> None:
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+
+def _notify(kind: str, user_ids: Iterable[int]) -> None:
+    if not _listeners:
+        return
+    for user_id in user_ids:
+        for listener in list(_listeners):
+            try:
+                listener(kind, user_id)
+            except Exception:
+                logging.exception("Storage change listener failed")
+
+
+def _log_changes(conn: sqlite3.Connection, kind: str, user_ids: Iterable[int]) -> None:
+    # Written in the same transaction as the change itself, so other
+    # processes see the row exactly when the data is visible to them.
+    now = _now_ts()
+    origin = os.getpid()
+    conn.executemany(
+        "INSERT INTO change_log (kind, user_id, origin, created_ts) VALUES (?, ?, ?, ?)",
+        ((kind, user_id, origin, now) for user_id in user_ids),
+    )
+
+
 def _now_iso() -> str:
     return datetime.now(timezone.utc).isoformat(timespec="seconds")
 
 
-def _connect() -> sqlite3.Connection:
-    DB_PATH.parent.mkdir(parents=True, exist_ok=True)
-    conn = sqlite3.connect(DB_PATH, timeout=10)
+def _now_ts() -> int:
+    return int(time.time())
+
+
+def _ts_to_iso(value: int | None) -> str:
+    if value is None:
+        return ""
+    return datetime.fromtimestamp(value, timezone.utc).isoformat(timespec="seconds")
+
+
+def _iso_to_ts(value: str) -> int | None:
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+
+def _open(path: Path) -> sqlite3.Connection:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=10, cached_statements=_STATEMENT_CACHE_SIZE)
     conn.row_factory = sqlite3.Row
+    for pragma in _PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def _connect() -> sqlite3.Connection:
+    """Return this thread's long-lived connection, opening it on first use.
+
+    Connections are kept per thread (sqlite3 objects must not cross threads)
+    and reopened after a fork or when ``DB_PATH`` is repointed. Use it as
+    ``with _connect() as conn:`` - the block commits or rolls back but leaves
+    the connection open, so statements stay in its prepared-statement cache.
+    """
+    conn = getattr(_local, "conn", None)
+    key = (os.getpid(), DB_PATH)
+    if conn is not None and _local.key == key:
+        return conn
+    if conn is not None and _local.key[0] == key[0]:
+        conn.close()
+    conn = _open(DB_PATH)
+    _local.conn = conn
+    _local.key = key
     return conn
 
 
+def close_db() -> None:
+    """Close the calling thread's connection (it is reopened on next use)."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        return
+    _local.conn = None
+    if _local.key[0] == os.getpid():
+        conn.close()
+
+
+def _migrate_expires_ts(conn: sqlite3.Connection) -> None:
+    # Sortable epoch copy of expires_at so reminder windows become index
+    # range scans. The partial index only holds rows still owed a reminder.
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(subscriptions)")}
+    if "expires_ts" not in columns:
+        conn.execute("ALTER TABLE subscriptions ADD COLUMN expires_ts INTEGER")
+    conn.execute(
+        """
+        UPDATE subscriptions
+        SET expires_ts = CAST(strftime('%s', expires_at) AS INTEGER)
+        WHERE expires_at IS NOT NULL
+        """
+    )
+    conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_due
+        ON subscriptions(expires_ts) WHERE reminded_expired = 0
+        """
+    )
+
+
+def _migrate_last_seen(conn: sqlite3.Connection) -> None:
+    # Activity timestamps are flushed in batches; updated_at now only moves
+    # when the row content changes.
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(users)")}
+    if "last_seen_at" not in columns:
+        conn.execute("ALTER TABLE users ADD COLUMN last_seen_at TEXT")
+    conn.execute("UPDATE users SET last_seen_at = updated_at WHERE last_seen_at IS NULL")
+
+
+def _migrate_media_files(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS media_files (
+            bot_id INTEGER NOT NULL,
+            asset_key TEXT NOT NULL,
+            file_hash TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (bot_id, asset_key)
+        )
+        """
+    )
+
+
+def _migrate_panel_assignments(conn: sqlite3.Connection) -> None:
+    # Users issued before panels were tracked live on the primary panel,
+    # recorded as "" so renaming that panel does not orphan them.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS panel_assignments (
+            user_id INTEGER PRIMARY KEY,
+            panel TEXT NOT NULL,
+            assigned_at TEXT NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO panel_assignments (user_id, panel, assigned_at)
+        SELECT user_id, '', updated_at FROM user_keys
+        """
+    )
+
+
+def _migrate_payment_jobs(conn: sqlite3.Connection) -> None:
+    # Durable queue between the payment webhook and key issuance. The
+    # idempotency key makes provider redeliveries of one event a no-op.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS payment_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            idempotency_key TEXT NOT NULL UNIQUE,
+            source TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            plan_code TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            stage TEXT NOT NULL DEFAULT '',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_run_ts INTEGER NOT NULL,
+            locked_until_ts INTEGER,
+            last_error TEXT NOT NULL DEFAULT '',
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_payment_jobs_ready ON payment_jobs(status, next_run_ts)"
+    )
+
+
+def _migrate_compact_columns(conn: sqlite3.Connection) -> None:
+    # Rebuild the core tables with epoch INTEGER timestamps and a single
+    # reminder bitmask (see REMINDER_BITS) instead of four flag columns.
+    # The ISO strings are converted here once; the public API keeps
+    # returning ISO strings.
+    epoch = "CAST(strftime('%s', {}) AS INTEGER)"
+    now = _now_ts()
+    conn.execute(
+        """
+        CREATE TABLE users_new (
+            user_id INTEGER PRIMARY KEY,
+            lang TEXT NOT NULL,
+            created_ts INTEGER NOT NULL,
+            updated_ts INTEGER NOT NULL,
+            last_seen_ts INTEGER
+        )
+        """
+    )
+    conn.execute(
+        f"""
+        INSERT INTO users_new (user_id, lang, created_ts, updated_ts, last_seen_ts)
+        SELECT
+            user_id, lang,
+            COALESCE({epoch.format('created_at')}, :now),
+            COALESCE({epoch.format('updated_at')}, :now),
+            {epoch.format('last_seen_at')}
+        FROM users
+        """,
+        {"now": now},
+    )
+    conn.execute(
+        """
+        CREATE TABLE subscriptions_new (
+            user_id INTEGER PRIMARY KEY,
+            plan_code TEXT,
+            status TEXT NOT NULL,
+            expires_ts INTEGER,
+            reminders INTEGER NOT NULL DEFAULT 0,
+            updated_ts INTEGER NOT NULL,
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+        )
+        """
+    )
+    conn.execute(
+        f"""
+        INSERT INTO subscriptions_new (user_id, plan_code, status, expires_ts, reminders, updated_ts)
+        SELECT
+            user_id, plan_code, status,
+            COALESCE(expires_ts, {epoch.format('expires_at')}),
+            (reminded_3d != 0) * {REMIND_3D}
+                | (reminded_1d != 0) * {REMIND_1D}
+                | (reminded_0d != 0) * {REMIND_0D}
+                | (reminded_expired != 0) * {REMIND_EXPIRED},
+            COALESCE({epoch.format('updated_at')}, :now)
+        FROM subscriptions
+        """,
+        {"now": now},
+    )
+    conn.execute(
+        """
+        CREATE TABLE user_keys_new (
+            user_id INTEGER PRIMARY KEY,
+            vless_uri TEXT,
+            sub_url TEXT,
+            client_id TEXT,
+            email TEXT,
+            sub_id TEXT,
+            updated_ts INTEGER NOT NULL,
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+        )
+        """
+    )
+    conn.execute(
+        f"""
+        INSERT INTO user_keys_new (user_id, vless_uri, sub_url, client_id, email, sub_id, updated_ts)
+        SELECT user_id, vless_uri, sub_url, client_id, email, sub_id, COALESCE({epoch.format('updated_at')}, :now)
+        FROM user_keys
+        """,
+        {"now": now},
+    )
+    for table in ("users", "subscriptions", "user_keys"):
+        conn.execute(f"DROP TABLE {table}")
+        conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+    conn.execute(
+        f"""
+        CREATE INDEX idx_subscriptions_due
+        ON subscriptions(expires_ts) WHERE reminders & {REMIND_EXPIRED} = 0
+        """
+    )
+
+
+def _migrate_coordination(conn: sqlite3.Connection) -> None:
+    # Shared state for running several bot processes: a log of committed
+    # changes that keeps per-process caches coherent, and named leases for
+    # work that must run on exactly one process. AUTOINCREMENT keeps ids
+    # from being reused after old log rows are pruned.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS change_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            origin INTEGER NOT NULL,
+            created_ts INTEGER NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires_ts REAL NOT NULL
+        )
+        """
+    )
+
+
+def _migrate_archive(conn: sqlite3.Connection) -> None:
+    # Cold copies of long-expired subscriptions and their keys, moved out by
+    # ``archive_users`` so the hot tables only hold current customers.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS archived_subscriptions (
+            user_id INTEGER PRIMARY KEY,
+            plan_code TEXT,
+            status TEXT NOT NULL,
+            expires_ts INTEGER,
+            reminders INTEGER NOT NULL DEFAULT 0,
+            updated_ts INTEGER NOT NULL,
+            archived_ts INTEGER NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS archived_user_keys (
+            user_id INTEGER PRIMARY KEY,
+            vless_uri TEXT,
+            sub_url TEXT,
+            client_id TEXT,
+            email TEXT,
+            sub_id TEXT,
+            updated_ts INTEGER NOT NULL,
+            archived_ts INTEGER NOT NULL
+        )
+        """
+    )
+
+
+def _migrate_traffic(conn: sqlite3.Connection) -> None:
+    # Last cumulative counters read from each panel, to turn the next
+    # reading into a delta, and the deltas themselves per user in minute,
+    # hour and day buckets (``span`` seconds wide).
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS traffic_counters (
+            panel TEXT NOT NULL,
+            email TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            up INTEGER NOT NULL,
+            down INTEGER NOT NULL,
+            online_ts INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (panel, email)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_traffic_counters_user ON traffic_counters(user_id)")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS traffic_usage (
+            user_id INTEGER NOT NULL,
+            span INTEGER NOT NULL,
+            bucket_ts INTEGER NOT NULL,
+            up INTEGER NOT NULL,
+            down INTEGER NOT NULL,
+            PRIMARY KEY (user_id, span, bucket_ts)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_traffic_usage_bucket ON traffic_usage(span, bucket_ts)")
+
+
+def _migrate_sub_id_index(conn: sqlite3.Connection) -> None:
+    # Subscription documents are looked up by the id in their URL.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_keys_sub_id ON user_keys(sub_id)")
+
+
+def _migrate_payment_target(conn: sqlite3.Connection) -> None:
+    # The expiry a payment job extends to, fixed before the first panel
+    # call so a re-run sets the same date instead of adding the days again.
+    conn.execute("ALTER TABLE payment_jobs ADD COLUMN target_expires_ts INTEGER")
+
+
+# Append-only: the position in this list is the schema version stored in
+# ``PRAGMA user_version`` once the migration has been applied.
+MIGRATIONS: List[Callable[[sqlite3.Connection], None]] = [
+    _migrate_expires_ts,
+    _migrate_last_seen,
+    _migrate_media_files,
+    _migrate_panel_assignments,
+    _migrate_payment_jobs,
+    _migrate_compact_columns,
+    _migrate_coordination,
+    _migrate_archive,
+    _migrate_traffic,
+    _migrate_sub_id_index,
+    _migrate_payment_target,
+]
+
+
+def schema_version() -> int:
+    return _connect().execute("PRAGMA user_version").fetchone()[0]
+
+
+def _run_migrations(conn: sqlite3.Connection) -> None:
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Re-check under the write lock in case another process migrated.
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= number:
+                conn.rollback()
+                continue
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+
+
 def init_db() -> None:
+    _create_tables()
+    _run_migrations(_connect())
+
+
+def _create_tables() -> None:
+    # The version 0 schema; everything after it is a migration.
     with _connect() as conn:
         conn.execute(
             """
@@ -81,21 +601,34 @@ def init_db() -> None:
 
 
 def upsert_user(user_id: int, lang: str) -> None:
-    now = _now_iso()
+    now = _now_ts()
     with _connect() as conn:
         conn.execute(
             """
-            INSERT OR IGNORE INTO users (user_id, lang, created_at, updated_at)
+            INSERT OR IGNORE INTO users (user_id, lang, created_ts, updated_ts)
             VALUES (?, ?, ?, ?)
             """,
             (user_id, lang, now, now),
         )
         conn.execute(
             """
-            UPDATE users SET lang = ?, updated_at = ? WHERE user_id = ?
+            UPDATE users SET lang = ?, updated_ts = ? WHERE user_id = ?
             """,
             (lang, now, user_id),
         )
+        _log_changes(conn, "user", [user_id])
+    _notify("user", [user_id])
+
+
+def touch_users(last_seen: dict[int, int]) -> None:
+    """Record last-seen epoch timestamps for many users in one transaction."""
+    if not last_seen:
+        return
+    with _connect() as conn:
+        conn.executemany(
+            "UPDATE users SET last_seen_ts = ? WHERE user_id = ?",
+            ((seen_at, user_id) for user_id, seen_at in last_seen.items()),
+        )
 
 
 def get_user_lang(user_id: int) -> str:
@@ -110,52 +643,55 @@ def get_user_lang(user_id: int) -> str:
 
 
 def set_subscription(user_id: int, expires_at_iso: str, plan_code: str = "manual") -> None:
-    now = _now_iso()
     with _connect() as conn:
         conn.execute(
             """
-            INSERT INTO subscriptions (
-                user_id, plan_code, expires_at, status,
-                reminded_3d, reminded_1d, reminded_0d, reminded_expired, updated_at
-            )
-            VALUES (?, ?, ?, 'active', 0, 0, 0, 0, ?)
+            INSERT INTO subscriptions (user_id, plan_code, status, expires_ts, reminders, updated_ts)
+            VALUES (?, ?, 'active', ?, 0, ?)
             ON CONFLICT(user_id) DO UPDATE SET
                 plan_code = excluded.plan_code,
-                expires_at = excluded.expires_at,
                 status = 'active',
-                reminded_3d = 0,
-                reminded_1d = 0,
-                reminded_0d = 0,
-                reminded_expired = 0,
-                updated_at = excluded.updated_at
+                expires_ts = excluded.expires_ts,
+                reminders = 0,
+                updated_ts = excluded.updated_ts
             """,
-            (user_id, plan_code, expires_at_iso, now),
+            (user_id, plan_code, _iso_to_ts(expires_at_iso), _now_ts()),
         )
+        _log_changes(conn, "subscription", [user_id])
+    _notify("subscription", [user_id])
 
 
 def mark_reminded(user_id: int, kind: str) -> None:
-    field_map = {
-        "3d": "reminded_3d",
-        "1d": "reminded_1d",
-        "0d": "reminded_0d",
-        "expired": "reminded_expired",
-    }
-    field = field_map.get(kind)
-    if not field:
+    mark_reminded_many([(user_id, kind)])
+
+
+def mark_reminded_many(items: Iterable[tuple[int, str]]) -> None:
+    """Set reminder bits for many ``(user_id, kind)`` pairs in one transaction."""
+    rows = [(REMINDER_BITS[kind], user_id) for user_id, kind in items if kind in REMINDER_BITS]
+    if not rows:
         return
+    now = _now_ts()
     with _connect() as conn:
-        conn.execute(
-            f"UPDATE subscriptions SET {field} = 1, updated_at = ? WHERE user_id = ?",
-            (_now_iso(), user_id),
+        conn.executemany(
+            "UPDATE subscriptions SET reminders = reminders | ?, updated_ts = ? WHERE user_id = ?",
+            ((bit, now, user_id) for bit, user_id in rows),
         )
 
 
 def set_status_expired(user_id: int) -> None:
+    set_status_expired_many([user_id])
+
+
+def set_status_expired_many(user_ids: Iterable[int]) -> None:
+    user_ids = list(user_ids)
+    now = _now_ts()
     with _connect() as conn:
-        conn.execute(
-            "UPDATE subscriptions SET status = 'expired', updated_at = ? WHERE user_id = ?",
-            (_now_iso(), user_id),
+        conn.executemany(
+            "UPDATE subscriptions SET status = 'expired', updated_ts = ? WHERE user_id = ?",
+            ((now, user_id) for user_id in user_ids),
         )
+        _log_changes(conn, "subscription", user_ids)
+    _notify("subscription", user_ids)
 
 
 def set_user_key(
@@ -166,10 +702,19 @@ def set_user_key(
     email: str = "",
     sub_id: str = "",
 ) -> None:
+    set_user_keys_many([(user_id, vless_uri, sub_url, client_id, email, sub_id)])
+
+
+def set_user_keys_many(rows: Iterable[tuple[int, str, str, str, str, str]]) -> None:
+    """Upsert ``(user_id, vless_uri, sub_url, client_id, email, sub_id)`` rows in one transaction."""
+    rows = list(rows)
+    if not rows:
+        return
+    now = _now_ts()
     with _connect() as conn:
-        conn.execute(
+        conn.executemany(
             """
-            INSERT INTO user_keys (user_id, vless_uri, sub_url, client_id, email, sub_id, updated_at)
+            INSERT INTO user_keys (user_id, vless_uri, sub_url, client_id, email, sub_id, updated_ts)
             VALUES (?, ?, ?, ?, ?, ?, ?)
             ON CONFLICT(user_id) DO UPDATE SET
                 vless_uri = excluded.vless_uri,
@@ -177,10 +722,12 @@ def set_user_key(
                 client_id = excluded.client_id,
                 email = excluded.email,
                 sub_id = excluded.sub_id,
-                updated_at = excluded.updated_at
+                updated_ts = excluded.updated_ts
             """,
-            (user_id, vless_uri, sub_url, client_id, email, sub_id, _now_iso()),
+            ((*row, now) for row in rows),
         )
+        _log_changes(conn, "key", [row[0] for row in rows])
+    _notify("key", [row[0] for row in rows])
 
 
 def get_user_key(user_id: int) -> tuple[str, str]:
@@ -194,45 +741,857 @@ def get_user_key(user_id: int) -> tuple[str, str]:
     return row["vless_uri"] or "", row["sub_url"] or ""
 
 
+def get_user_client(user_id: int) -> tuple[str, str, str] | None:
+    """``(client_id, email, sub_id)`` of the stored key, if it has a client id."""
+    with _connect() as conn:
+        row = conn.execute(
+            "SELECT client_id, email, sub_id FROM user_keys WHERE user_id = ?",
+            (user_id,),
+        ).fetchone()
+    if not row or not row["client_id"]:
+        return None
+    return row["client_id"], row["email"] or "", row["sub_id"] or ""
+
+
+def get_subscription_source(sub_id: str) -> SubscriptionSource | None:
+    if not sub_id:
+        return None
+    with _connect() as conn:
+        row = conn.execute(
+            """
+            SELECT k.user_id, k.vless_uri, k.client_id, k.email, p.panel, s.expires_ts,
+                   (SELECT COALESCE(SUM(up), 0) FROM traffic_counters t WHERE t.user_id = k.user_id) AS up,
+                   (SELECT COALESCE(SUM(down), 0) FROM traffic_counters t WHERE t.user_id = k.user_id) AS down
+            FROM user_keys k
+            LEFT JOIN subscriptions s ON s.user_id = k.user_id
+            LEFT JOIN panel_assignments p ON p.user_id = k.user_id
+            WHERE k.sub_id = ?
+            ORDER BY k.user_id LIMIT 1
+            """,
+            (sub_id,),
+        ).fetchone()
+    if row is None:
+        return None
+    return SubscriptionSource(
+        user_id=int(row["user_id"]),
+        vless_uri=row["vless_uri"] or "",
+        client_id=row["client_id"] or "",
+        email=row["email"] or "",
+        panel=row["panel"],
+        expires_ts=int(row["expires_ts"] or 0),
+        up=int(row["up"]),
+        down=int(row["down"]),
+    )
+
+
 def get_subscription(user_id: int) -> SubscriptionInfo | None:
     with _connect() as conn:
         row = conn.execute(
-            "SELECT plan_code, expires_at, status FROM subscriptions WHERE user_id = ?",
+            "SELECT plan_code, expires_ts, status FROM subscriptions WHERE user_id = ?",
             (user_id,),
         ).fetchone()
     if not row:
         return None
     return SubscriptionInfo(
         plan_code=row["plan_code"] or "",
-        expires_at=row["expires_at"] or "",
+        expires_at=_ts_to_iso(row["expires_ts"]),
         status=row["status"] or "",
     )
 
 
-def list_due_reminders(now: datetime) -> List[Reminder]:
-    reminders: List[Reminder] = []
+def get_profile(user_id: int) -> UserProfile:
+    """Language, key and subscription of one user in a single query."""
+    with _connect() as conn:
+        row = conn.execute(
+            """
+            SELECT
+                (SELECT lang FROM users WHERE user_id = q.user_id) AS lang,
+                k.vless_uri, k.sub_url,
+                s.plan_code, s.expires_ts, s.status
+            FROM (SELECT ? AS user_id) q
+            LEFT JOIN user_keys k ON k.user_id = q.user_id
+            LEFT JOIN subscriptions s ON s.user_id = q.user_id
+            """,
+            (user_id,),
+        ).fetchone()
+    subscription = None
+    if row["status"] is not None:
+        subscription = SubscriptionInfo(
+            plan_code=row["plan_code"] or "",
+            expires_at=_ts_to_iso(row["expires_ts"]),
+            status=row["status"] or "",
+        )
+    return UserProfile(
+        user_id=user_id,
+        lang=row["lang"] or "ru",
+        vless_uri=row["vless_uri"] or "",
+        sub_url=row["sub_url"] or "",
+        subscription=subscription,
+        registered=row["lang"] is not None,
+    )
+
+
+def get_panel(user_id: int) -> str | None:
+    with _connect() as conn:
+        row = conn.execute(
+            "SELECT panel FROM panel_assignments WHERE user_id = ?",
+            (user_id,),
+        ).fetchone()
+    return row["panel"] if row else None
+
+
+def assign_panel(user_id: int, panel: str) -> str:
+    """Assign ``panel`` unless the user already has one; returns the stored panel."""
+    with _connect() as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO panel_assignments (user_id, panel, assigned_at) VALUES (?, ?, ?)",
+            (user_id, panel, _now_iso()),
+        )
+        row = conn.execute(
+            "SELECT panel FROM panel_assignments WHERE user_id = ?",
+            (user_id,),
+        ).fetchone()
+    return row["panel"]
+
+
+def set_panel(user_id: int, panel: str) -> None:
+    set_panels_many([user_id], panel)
+
+
+def set_panels_many(user_ids: Iterable[int], panel: str) -> None:
+    """Move users to ``panel`` (e.g. after migrating their clients there)."""
+    now = _now_iso()
+    with _connect() as conn:
+        conn.executemany(
+            """
+            INSERT INTO panel_assignments (user_id, panel, assigned_at) VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET panel = excluded.panel, assigned_at = excluded.assigned_at
+            """,
+            ((user_id, panel, now) for user_id in user_ids),
+        )
+
+
+def count_panel_users() -> dict[str, int]:
     with _connect() as conn:
         rows = conn.execute(
+            "SELECT panel, COUNT(*) AS users FROM panel_assignments GROUP BY panel"
+        ).fetchall()
+    return {row["panel"]: int(row["users"]) for row in rows}
+
+
+def get_media_file_id(bot_id: int, asset_key: str, file_hash: str) -> str:
+    with _connect() as conn:
+        row = conn.execute(
+            """
+            SELECT file_id FROM media_files
+            WHERE bot_id = ? AND asset_key = ? AND file_hash = ?
+            """,
+            (bot_id, asset_key, file_hash),
+        ).fetchone()
+    return row["file_id"] if row else ""
+
+
+def set_media_file_id(bot_id: int, asset_key: str, file_hash: str, file_id: str) -> None:
+    with _connect() as conn:
+        conn.execute(
             """
-            SELECT s.*, u.lang
+            INSERT INTO media_files (bot_id, asset_key, file_hash, file_id, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(bot_id, asset_key) DO UPDATE SET
+                file_hash = excluded.file_hash,
+                file_id = excluded.file_id,
+                updated_at = excluded.updated_at
+            """,
+            (bot_id, asset_key, file_hash, file_id, _now_iso()),
+        )
+
+
+def delete_media_file_id(bot_id: int, asset_key: str) -> None:
+    with _connect() as conn:
+        conn.execute(
+            "DELETE FROM media_files WHERE bot_id = ? AND asset_key = ?",
+            (bot_id, asset_key),
+        )
+
+
+def list_due_reminders(now: datetime) -> List[Reminder]:
+    """Return the reminders that are due at ``now``.
+
+    Each window (expired, within 1 day, within 3 days) is a range scan over
+    ``idx_subscriptions_due``, so only rows that are actually due are read.
+    """
+    now_ts = int(now.timestamp())
+    with _connect() as conn:
+        rows = conn.execute(
+            f"""
+            SELECT s.user_id, u.lang, 'expired' AS kind
+            FROM subscriptions s
+            JOIN users u ON u.user_id = s.user_id
+            WHERE s.reminders & {REMIND_EXPIRED} = 0 AND s.expires_ts <= :now
+            UNION ALL
+            SELECT s.user_id, u.lang, '1d' AS kind
             FROM subscriptions s
             JOIN users u ON u.user_id = s.user_id
-            WHERE s.expires_at IS NOT NULL
+            WHERE s.reminders & {REMIND_EXPIRED} = 0
+              AND s.expires_ts > :now AND s.expires_ts <= :day
+              AND s.reminders & {REMIND_1D} = 0
+            UNION ALL
+            SELECT s.user_id, u.lang, '3d' AS kind
+            FROM subscriptions s
+            JOIN users u ON u.user_id = s.user_id
+            WHERE s.reminders & {REMIND_EXPIRED} = 0
+              AND s.expires_ts > :day AND s.expires_ts <= :three_days
+              AND s.reminders & {REMIND_3D} = 0
+            """,
+            {"now": now_ts, "day": now_ts + 24 * 3600, "three_days": now_ts + 3 * 24 * 3600},
+        ).fetchall()
+    return [Reminder(row["user_id"], row["lang"], row["kind"]) for row in rows]
+
+
+_REMINDER_STATE_SQL = f"""
+    SELECT user_id, expires_ts, reminders
+    FROM subscriptions
+    WHERE reminders & {REMIND_EXPIRED} = 0 AND expires_ts IS NOT NULL
+"""
+
+
+def _reminder_state(row: sqlite3.Row) -> ReminderState:
+    return ReminderState(
+        user_id=row["user_id"],
+        expires_ts=row["expires_ts"],
+        reminded_3d=bool(row["reminders"] & REMIND_3D),
+        reminded_1d=bool(row["reminders"] & REMIND_1D),
+    )
+
+
+def list_reminder_states() -> List[ReminderState]:
+    """Every subscription that is still owed at least one reminder."""
+    with _connect() as conn:
+        rows = conn.execute(_REMINDER_STATE_SQL).fetchall()
+    return [_reminder_state(row) for row in rows]
+
+
+def get_reminder_states(user_ids: Iterable[int]) -> List[ReminderState]:
+    ids = list(user_ids)
+    states: List[ReminderState] = []
+    with _connect() as conn:
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"{_REMINDER_STATE_SQL} AND user_id IN ({placeholders})",
+                chunk,
+            ).fetchall()
+            states.extend(_reminder_state(row) for row in rows)
+    return states
+
+
+_CLIENT_RECORD_SQL = """
+    SELECT k.user_id, k.client_id, k.email, k.sub_id, s.expires_ts
+    FROM user_keys k
+    JOIN subscriptions s ON s.user_id = k.user_id
+    WHERE k.user_id > ?
+      AND COALESCE(k.client_id, '') != ''
+      AND s.expires_ts IS NOT NULL
+      AND s.expires_ts > ?
+"""
+
+
+def _client_record(row: sqlite3.Row) -> ClientRecord:
+    return ClientRecord(
+        user_id=int(row["user_id"]),
+        client_id=row["client_id"],
+        email=row["email"] or f"tg_{row['user_id']}",
+        sub_id=row["sub_id"] or "",
+        expires_ts=int(row["expires_ts"]),
+    )
+
+
+def list_client_records(after_user_id: int, limit: int, min_expires_ts: int = 0) -> List[ClientRecord]:
+    """Provisioned users ordered by ``user_id``, one keyset page at a time.
+
+    Only subscriptions expiring after ``min_expires_ts`` are returned.
+    """
+    with _connect() as conn:
+        rows = conn.execute(
+            f"{_CLIENT_RECORD_SQL} ORDER BY k.user_id LIMIT ?",
+            (after_user_id, min_expires_ts, limit),
+        ).fetchall()
+    return [_client_record(row) for row in rows]
+
+
+def get_client_records(user_ids: Iterable[int], min_expires_ts: int = 0) -> List[ClientRecord]:
+    """Provisioned users among ``user_ids``, ordered by ``user_id``."""
+    ids = sorted(set(user_ids))
+    records: List[ClientRecord] = []
+    with _connect() as conn:
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"{_CLIENT_RECORD_SQL} AND k.user_id IN ({placeholders}) ORDER BY k.user_id",
+                (0, min_expires_ts, *chunk),
+            ).fetchall()
+            records.extend(_client_record(row) for row in rows)
+    return records
+
+
+def count_client_records(after_user_id: int = 0, min_expires_ts: int = 0) -> int:
+    with _connect() as conn:
+        row = conn.execute(
+            f"SELECT COUNT(*) FROM ({_CLIENT_RECORD_SQL})",
+            (after_user_id, min_expires_ts),
+        ).fetchone()
+    return int(row[0])
+
+
+_PAYMENT_JOB_COLUMNS = (
+    "id, idempotency_key, source, user_id, plan_code, stage, attempts, last_error, target_expires_ts"
+)
+
+
+def _payment_job(row: sqlite3.Row) -> PaymentJob:
+    return PaymentJob(
+        id=int(row["id"]),
+        idempotency_key=row["idempotency_key"],
+        source=row["source"],
+        user_id=int(row["user_id"]),
+        plan_code=row["plan_code"],
+        stage=row["stage"],
+        attempts=int(row["attempts"]),
+        last_error=row["last_error"],
+        target_expires_ts=int(row["target_expires_ts"] or 0),
+    )
+
+
+def enqueue_payment_job(
+    idempotency_key: str,
+    source: str,
+    user_id: int,
+    plan_code: str,
+    payload: str,
+) -> tuple[int, bool]:
+    """Queue a payment; returns ``(job_id, created)``.
+
+    A second event with the same ``idempotency_key`` returns the existing
+    job with ``created=False`` instead of queueing it again.
+    """
+    now = _now_iso()
+    with _connect() as conn:
+        cursor = conn.execute(
+            """
+            INSERT OR IGNORE INTO payment_jobs (
+                idempotency_key, source, user_id, plan_code, payload,
+                next_run_ts, created_at, updated_at
+            )
+            VALUES (?, ?, ?, ?, ?, CAST(strftime('%s', 'now') AS INTEGER), ?, ?)
+            """,
+            (idempotency_key, source, user_id, plan_code, payload, now, now),
+        )
+        if cursor.rowcount:
+            return int(cursor.lastrowid), True
+        row = conn.execute(
+            "SELECT id FROM payment_jobs WHERE idempotency_key = ?",
+            (idempotency_key,),
+        ).fetchone()
+    return int(row["id"]), False
+
+
+def claim_payment_jobs(limit: int, now_ts: int, lease_seconds: int) -> List[PaymentJob]:
+    """Lease up to ``limit`` due jobs to the caller.
+
+    Jobs whose lease ran out while ``running`` (the worker died) are due
+    again. Selection and lease happen under one write lock, so concurrent
+    workers, even in other processes, never get the same job.
+    """
+    conn = _connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute(
+            f"""
+            SELECT {_PAYMENT_JOB_COLUMNS} FROM payment_jobs
+            WHERE (status = 'pending' AND next_run_ts <= ?)
+               OR (status = 'running' AND locked_until_ts <= ?)
+            ORDER BY next_run_ts, id
+            LIMIT ?
+            """,
+            (now_ts, now_ts, limit),
+        ).fetchall()
+        conn.executemany(
+            """
+            UPDATE payment_jobs
+            SET status = 'running', attempts = attempts + 1, locked_until_ts = ?, updated_at = ?
+            WHERE id = ?
+            """,
+            ((now_ts + lease_seconds, _now_iso(), row["id"]) for row in rows),
+        )
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+    return [replace(_payment_job(row), attempts=int(row["attempts"]) + 1) for row in rows]
+
+
+def set_payment_job_stage(job_id: int, stage: str) -> None:
+    with _connect() as conn:
+        conn.execute(
+            "UPDATE payment_jobs SET stage = ?, updated_at = ? WHERE id = ?",
+            (stage, _now_iso(), job_id),
+        )
+
+
+def set_payment_job_target(job_id: int, target_expires_ts: int) -> int:
+    """Fix the job's target expiry unless one is set; returns the stored one.
+
+    The first attempt wins, so every later run of the job uses its date.
+    """
+    with _connect() as conn:
+        conn.execute(
+            """
+            UPDATE payment_jobs SET target_expires_ts = ?, updated_at = ?
+            WHERE id = ? AND target_expires_ts IS NULL
+            """,
+            (target_expires_ts, _now_iso(), job_id),
+        )
+        row = conn.execute("SELECT target_expires_ts FROM payment_jobs WHERE id = ?", (job_id,)).fetchone()
+    return int(row["target_expires_ts"] or 0) if row else 0
+
+
+def complete_payment_job(job_id: int) -> None:
+    with _connect() as conn:
+        conn.execute(
+            """
+            UPDATE payment_jobs
+            SET status = 'done', locked_until_ts = NULL, last_error = '', updated_at = ?
+            WHERE id = ?
+            """,
+            (_now_iso(), job_id),
+        )
+
+
+def retry_payment_job(job_id: int, error: str, next_run_ts: int) -> None:
+    with _connect() as conn:
+        conn.execute(
+            """
+            UPDATE payment_jobs
+            SET status = 'pending', locked_until_ts = NULL, last_error = ?, next_run_ts = ?, updated_at = ?
+            WHERE id = ?
+            """,
+            (error, next_run_ts, _now_iso(), job_id),
+        )
+
+
+def dead_letter_payment_job(job_id: int, error: str) -> None:
+    with _connect() as conn:
+        conn.execute(
+            """
+            UPDATE payment_jobs
+            SET status = 'dead', locked_until_ts = NULL, last_error = ?, updated_at = ?
+            WHERE id = ?
+            """,
+            (error, _now_iso(), job_id),
+        )
+
+
+def requeue_payment_job(job_id: int) -> bool:
+    """Give a dead job a fresh set of attempts; False if it is not dead."""
+    with _connect() as conn:
+        cursor = conn.execute(
+            """
+            UPDATE payment_jobs
+            SET status = 'pending', attempts = 0, next_run_ts = CAST(strftime('%s', 'now') AS INTEGER),
+                updated_at = ?
+            WHERE id = ? AND status = 'dead'
+            """,
+            (_now_iso(), job_id),
+        )
+    return cursor.rowcount > 0
+
+
+def recent_payment_job_keys(limit: int) -> List[tuple[str, int]]:
+    """``(idempotency_key, job_id)`` of the newest jobs, newest first."""
+    with _connect() as conn:
+        rows = conn.execute(
+            "SELECT idempotency_key, id FROM payment_jobs ORDER BY id DESC LIMIT ?",
+            (limit,),
+        ).fetchall()
+    return [(row["idempotency_key"], int(row["id"])) for row in rows]
+
+
+def count_payment_jobs() -> dict[str, int]:
+    with _connect() as conn:
+        rows = conn.execute(
+            "SELECT status, COUNT(*) AS jobs FROM payment_jobs GROUP BY status"
+        ).fetchall()
+    return {row["status"]: int(row["jobs"]) for row in rows}
+
+
+def list_dead_payment_jobs(limit: int = 20) -> List[PaymentJob]:
+    with _connect() as conn:
+        rows = conn.execute(
+            f"""
+            SELECT {_PAYMENT_JOB_COLUMNS} FROM payment_jobs
+            WHERE status = 'dead'
+            ORDER BY updated_at DESC
+            LIMIT ?
+            """,
+            (limit,),
+        ).fetchall()
+    return [_payment_job(row) for row in rows]
+
+
+def last_change_id() -> int:
+    with _connect() as conn:
+        row = conn.execute("SELECT COALESCE(MAX(id), 0) FROM change_log").fetchone()
+    return int(row[0])
+
+
+def read_changes(after_id: int, limit: int = 1000) -> List[tuple[int, str, int, int]]:
+    """``(id, kind, user_id, origin)`` rows logged after ``after_id``, oldest first."""
+    with _connect() as conn:
+        rows = conn.execute(
+            "SELECT id, kind, user_id, origin FROM change_log WHERE id > ? ORDER BY id LIMIT ?",
+            (after_id, limit),
+        ).fetchall()
+    return [(int(row["id"]), row["kind"], int(row["user_id"]), int(row["origin"])) for row in rows]
+
+
+def dispatch_changes(kind: str, user_ids: Iterable[int]) -> None:
+    """Run this process's change listeners for a write made elsewhere."""
+    _notify(kind, user_ids)
+
+
+def prune_changes(before_ts: int) -> int:
+    with _connect() as conn:
+        cursor = conn.execute("DELETE FROM change_log WHERE created_ts < ?", (before_ts,))
+    return cursor.rowcount
+
+
+def acquire_lease(name: str, holder: str, ttl: float) -> bool:
+    """Take or renew the lease ``name`` for ``ttl`` seconds.
+
+    Succeeds when the lease is free, expired or already held by ``holder``;
+    SQLite's write lock makes the check-and-set atomic across processes.
+    """
+    now = time.time()
+    with _connect() as conn:
+        cursor = conn.execute(
+            """
+            INSERT INTO leases (name, holder, expires_ts) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_ts = excluded.expires_ts
+            WHERE leases.holder = excluded.holder OR leases.expires_ts <= ?
+            """,
+            (name, holder, now + ttl, now),
+        )
+    return cursor.rowcount > 0
+
+
+def release_lease(name: str, holder: str) -> None:
+    with _connect() as conn:
+        conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+
+
+def get_lease_holder(name: str) -> str | None:
+    with _connect() as conn:
+        row = conn.execute(
+            "SELECT holder FROM leases WHERE name = ? AND expires_ts > ?",
+            (name, time.time()),
+        ).fetchone()
+    return row["holder"] if row else None
+
+
+_SUBSCRIPTION_COLUMNS = "user_id, plan_code, status, expires_ts, reminders, updated_ts"
+_USER_KEY_COLUMNS = "user_id, vless_uri, sub_url, client_id, email, sub_id, updated_ts"
+
+
+def list_archivable(cutoff_ts: int) -> List[int]:
+    """Users whose subscription ended before ``cutoff_ts`` or whose key is stale.
+
+    Only subscriptions whose expiry reminder was already sent qualify; a key
+    qualifies when it has no subscription and was last written before the
+    cutoff.
+    """
+    with _connect() as conn:
+        rows = conn.execute(
+            f"""
+            SELECT user_id FROM subscriptions
+            WHERE expires_ts < :cutoff AND reminders & {REMIND_EXPIRED} != 0
+            UNION
+            SELECT k.user_id FROM user_keys k
+            WHERE k.updated_ts < :cutoff
+              AND NOT EXISTS (SELECT 1 FROM subscriptions s WHERE s.user_id = k.user_id)
+            ORDER BY user_id
+            """,
+            {"cutoff": cutoff_ts},
+        ).fetchall()
+    return [int(row["user_id"]) for row in rows]
+
+
+def archive_users(user_ids: Iterable[int], cutoff_ts: int) -> List[int]:
+    """Move up to 500 users' subscription and key rows to the archive tables.
+
+    The conditions of ``list_archivable`` are re-checked under the write
+    lock, so a user who paid in the meantime is left alone. Returns the
+    users that were archived.
+    """
+    ids = list(user_ids)[:500]
+    if not ids:
+        return []
+    placeholders = ",".join("?" * len(ids))
+    now = _now_ts()
+    conn = _connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        archived = [
+            int(row["user_id"])
+            for row in conn.execute(
+                f"""
+                SELECT user_id FROM subscriptions
+                WHERE user_id IN ({placeholders})
+                  AND expires_ts < ? AND reminders & {REMIND_EXPIRED} != 0
+                UNION
+                SELECT k.user_id FROM user_keys k
+                WHERE k.user_id IN ({placeholders}) AND k.updated_ts < ?
+                  AND NOT EXISTS (SELECT 1 FROM subscriptions s WHERE s.user_id = k.user_id)
+                """,
+                (*ids, cutoff_ts, *ids, cutoff_ts),
+            )
+        ]
+        if archived:
+            placeholders = ",".join("?" * len(archived))
+            for table, columns in (("subscriptions", _SUBSCRIPTION_COLUMNS), ("user_keys", _USER_KEY_COLUMNS)):
+                conn.execute(
+                    f"""
+                    INSERT OR REPLACE INTO archived_{table} ({columns}, archived_ts)
+                    SELECT {columns}, ? FROM {table} WHERE user_id IN ({placeholders})
+                    """,
+                    (now, *archived),
+                )
+                conn.execute(f"DELETE FROM {table} WHERE user_id IN ({placeholders})", archived)
+            _log_changes(conn, "subscription", archived)
+            _log_changes(conn, "key", archived)
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+    _notify("subscription", archived)
+    _notify("key", archived)
+    return archived
+
+
+def restore_archived(user_id: int) -> bool:
+    """Move an archived user back into the hot tables; False if not archived.
+
+    Live rows win over archived ones, so restoring after a fresh issue is
+    harmless.
+    """
+    with _connect() as conn:
+        found = conn.execute(
+            """
+            SELECT EXISTS (SELECT 1 FROM archived_subscriptions WHERE user_id = :user)
+                OR EXISTS (SELECT 1 FROM archived_user_keys WHERE user_id = :user)
+            """,
+            {"user": user_id},
+        ).fetchone()[0]
+        if not found:
+            return False
+        for table, columns in (("subscriptions", _SUBSCRIPTION_COLUMNS), ("user_keys", _USER_KEY_COLUMNS)):
+            conn.execute(
+                f"INSERT OR IGNORE INTO {table} ({columns}) SELECT {columns} FROM archived_{table} WHERE user_id = ?",
+                (user_id,),
+            )
+            conn.execute(f"DELETE FROM archived_{table} WHERE user_id = ?", (user_id,))
+        _log_changes(conn, "subscription", [user_id])
+        _log_changes(conn, "key", [user_id])
+    _notify("subscription", [user_id])
+    _notify("key", [user_id])
+    return True
+
+
+def count_archived() -> dict[str, int]:
+    """Row counts of the hot tables and their archives."""
+    with _connect() as conn:
+        row = conn.execute(
+            """
+            SELECT
+                (SELECT COUNT(*) FROM subscriptions) AS subscriptions,
+                (SELECT COUNT(*) FROM user_keys) AS user_keys,
+                (SELECT COUNT(*) FROM archived_subscriptions) AS archived_subscriptions,
+                (SELECT COUNT(*) FROM archived_user_keys) AS archived_user_keys
+            """
+        ).fetchone()
+    return {key: int(row[key]) for key in row.keys()}
+
+
+def incremental_vacuum(pages: int) -> int:
+    """Return up to ``pages`` free pages to the filesystem; returns how many are left.
+
+    Does nothing unless the database uses incremental auto-vacuum.
+    """
+    conn = _connect()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+    return int(conn.execute("PRAGMA freelist_count").fetchone()[0])
+
+
+def record_traffic(panel: str, readings: Iterable[tuple[str, int, int, int]], now_ts: int) -> int:
+    """Store cumulative counters ``(email, user_id, up, down)`` read from ``panel``.
+
+    The difference to the previous reading is added to the user's minute
+    bucket of ``now_ts``. A counter below its previous reading was reset on
+    the panel and counts from zero; a client's first reading only sets the
+    baseline. Unchanged counters are not written. Returns how many clients
+    had new traffic.
+    """
+    bucket = now_ts - now_ts % TRAFFIC_MINUTE
+    rows = list(readings)
+    moved = 0
+    with _connect() as conn:
+        for start in range(0, len(rows), 500):
+            chunk = rows[start:start + 500]
+            emails = list({row[0] for row in chunk})
+            placeholders = ",".join("?" * len(emails))
+            previous = {
+                row["email"]: (int(row["up"]), int(row["down"]))
+                for row in conn.execute(
+                    f"""
+                    SELECT email, up, down FROM traffic_counters
+                    WHERE panel = ? AND email IN ({placeholders})
+                    """,
+                    (panel, *emails),
+                )
+            }
+            counters = []
+            usage = []
+            for email, user_id, up, down in chunk:
+                last = previous.get(email)
+                if last == (up, down):
+                    continue
+                # The same client may be listed under several inbounds.
+                previous[email] = (up, down)
+                counters.append((panel, email, user_id, up, down))
+                if last is None:
+                    continue
+                delta_up = up - last[0] if up >= last[0] else up
+                delta_down = down - last[1] if down >= last[1] else down
+                if delta_up or delta_down:
+                    usage.append((user_id, TRAFFIC_MINUTE, bucket, delta_up, delta_down))
+            conn.executemany(
+                """
+                INSERT INTO traffic_counters (panel, email, user_id, up, down) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(panel, email) DO UPDATE SET
+                    user_id = excluded.user_id, up = excluded.up, down = excluded.down
+                """,
+                counters,
+            )
+            conn.executemany(
+                """
+                INSERT INTO traffic_usage (user_id, span, bucket_ts, up, down) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(user_id, span, bucket_ts) DO UPDATE SET
+                    up = traffic_usage.up + excluded.up, down = traffic_usage.down + excluded.down
+                """,
+                usage,
+            )
+            moved += len(usage)
+    return moved
+
+
+def mark_online(panel: str, emails: Iterable[str], now_ts: int) -> None:
+    ids = list(emails)
+    with _connect() as conn:
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            conn.execute(
+                f"UPDATE traffic_counters SET online_ts = ? WHERE panel = ? AND email IN ({placeholders})",
+                (now_ts, panel, *chunk),
+            )
+
+
+def rollup_traffic(now_ts: int, minutes_for: int, hours_for: int, days_for: int) -> int:
+    """Fold minute buckets older than ``minutes_for`` seconds into hours and
+    hour buckets older than ``hours_for`` into days; drop days older than
+    ``days_for``. Only whole target buckets are folded. Returns rows removed.
+    """
+    removed = 0
+    with _connect() as conn:
+        for span, target, keep in ((TRAFFIC_MINUTE, TRAFFIC_HOUR, minutes_for), (TRAFFIC_HOUR, TRAFFIC_DAY, hours_for)):
+            cutoff = now_ts - keep
+            cutoff -= cutoff % target
+            conn.execute(
+                """
+                INSERT INTO traffic_usage (user_id, span, bucket_ts, up, down)
+                SELECT user_id, :target, bucket_ts - bucket_ts % :target, SUM(up), SUM(down)
+                FROM traffic_usage WHERE span = :span AND bucket_ts < :cutoff
+                GROUP BY user_id, bucket_ts - bucket_ts % :target
+                ON CONFLICT(user_id, span, bucket_ts) DO UPDATE SET
+                    up = traffic_usage.up + excluded.up, down = traffic_usage.down + excluded.down
+                """,
+                {"span": span, "target": target, "cutoff": cutoff},
+            )
+            removed += conn.execute(
+                "DELETE FROM traffic_usage WHERE span = ? AND bucket_ts < ?",
+                (span, cutoff),
+            ).rowcount
+        removed += conn.execute(
+            "DELETE FROM traffic_usage WHERE span = ? AND bucket_ts < ?",
+            (TRAFFIC_DAY, now_ts - days_for),
+        ).rowcount
+    return removed
+
+
+def get_traffic_used(user_id: int, since_ts: int) -> tuple[int, int]:
+    """``(up, down)`` bytes of ``user_id`` since ``since_ts``, to bucket precision."""
+    with _connect() as conn:
+        row = conn.execute(
+            """
+            SELECT COALESCE(SUM(up), 0), COALESCE(SUM(down), 0) FROM traffic_usage
+            WHERE user_id = ? AND bucket_ts >= ?
+            """,
+            (user_id, since_ts),
+        ).fetchone()
+    return int(row[0]), int(row[1])
+
+
+def top_traffic(since_ts: int, limit: int = 10) -> List[tuple[int, int]]:
+    """``(user_id, bytes)`` of the heaviest users since ``since_ts``."""
+    with _connect() as conn:
+        rows = conn.execute(
             """
+            SELECT user_id, SUM(up + down) AS used FROM traffic_usage
+            WHERE bucket_ts >= ?
+            GROUP BY user_id ORDER BY used DESC LIMIT ?
+            """,
+            (since_ts, limit),
+        ).fetchall()
+    return [(int(row["user_id"]), int(row["used"])) for row in rows]
+
+
+def traffic_summary(since_ts: int, online_since_ts: int) -> dict[str, int]:
+    """Total bytes since ``since_ts`` and users seen online since ``online_since_ts``."""
+    with _connect() as conn:
+        row = conn.execute(
+            """
+            SELECT
+                (SELECT COALESCE(SUM(up + down), 0) FROM traffic_usage WHERE bucket_ts >= :since) AS used,
+                (SELECT COUNT(DISTINCT user_id) FROM traffic_counters WHERE online_ts >= :online) AS online
+            """,
+            {"since": since_ts, "online": online_since_ts},
+        ).fetchone()
+    return {"used": int(row["used"]), "online": int(row["online"])}
+
+
+def list_traffic_clients(user_ids: Iterable[int]) -> List[TrafficClient]:
+    ids = list(user_ids)
+    if not ids:
+        return []
+    placeholders = ",".join("?" * len(ids))
+    with _connect() as conn:
+        rows = conn.execute(
+            f"""
+            SELECT panel, email, user_id, online_ts FROM traffic_counters
+            WHERE user_id IN ({placeholders})
+            """,
+            ids,
         ).fetchall()
-    for row in rows:
-        expires_at = datetime.fromisoformat(row["expires_at"])
-        delta = expires_at - now
-        seconds = delta.total_seconds()
-        if seconds <= 0:
-            if not row["reminded_expired"]:
-                reminders.append(Reminder(row["user_id"], row["lang"], "expired"))
-            continue
-        if seconds <= 24 * 3600:
-            if not row["reminded_1d"]:
-                reminders.append(Reminder(row["user_id"], row["lang"], "1d"))
-            continue
-        if seconds <= 3 * 24 * 3600:
-            if not row["reminded_3d"]:
-                reminders.append(Reminder(row["user_id"], row["lang"], "3d"))
-    return reminders
+    return [TrafficClient(row["panel"], row["email"], int(row["user_id"]), int(row["online_ts"])) for row in rows]
@@ -0,0 +1,205 @@
+"""Subscription documents served by the webhook app instead of the panel.
+
+Client apps refresh their subscription every few hours on every device.
+:class:`SubscriptionDocuments` builds a user's document once from
+``user_keys`` and the cached inbound snapshots. It keeps the document, its
+gzipped copy and its ETag until the user's key or subscription changes,
+the subscription expires, or ``SUB_CACHE_SECONDS`` pass. A refresh that
+sends the ETag back is answered with a 304 from memory.
+"""
+from __future__ import annotations
+
+import base64
+from collections import OrderedDict
+from dataclasses import dataclass
+import gzip
+import hashlib
+import logging
+import threading
+import time
+from typing import Optional
+
+from . import async_storage, storage
+from .config import BRAND_NAME, SUB_CACHE_SECONDS, SUB_CACHE_SIZE, SUB_UPDATE_INTERVAL_HOURS, XUI_TOTAL_GB
+from .panels import LEGACY_PANEL, registry
+from .storage import SubscriptionSource
+from .xui_api import build_vless_uri
+
+
+# A document built from the stored key alone (panel unreachable, client
+# missing) is retried soon instead of being kept for the full TTL.
+FALLBACK_TTL_SECONDS = 60.0
+
+
+@dataclass(frozen=True)
+class SubscriptionDocument:
+    user_id: int
+    body: bytes
+    gzipped: bytes
+    etag: str
+    headers: dict[str, str]
+    expires_ts: int
+
+
+def build_document(source: SubscriptionSource, links: list[str]) -> SubscriptionDocument:
+    """The panel's format: base64 of the newline-separated links."""
+    body = base64.b64encode("\n".join(links).encode())
+    # Usage is left out of the ETag: it changes all the time and would turn
+    # every refresh into a full download. A renewal still gets through.
+    digest = hashlib.sha256(body + b"|%d" % source.expires_ts).hexdigest()
+    etag = f'"{digest[:32]}"'
+    headers = {
+        "Content-Type": "text/plain; charset=utf-8",
+        "Cache-Control": "no-cache",
+        "ETag": etag,
+        "Profile-Update-Interval": str(SUB_UPDATE_INTERVAL_HOURS),
+        "Profile-Title": "base64:" + base64.b64encode(BRAND_NAME.encode()).decode(),
+        # totalGB is passed to the panel as is, which counts it in bytes.
+        "Subscription-Userinfo": (
+            f"upload={source.up}; download={source.down}; total={XUI_TOTAL_GB}; expire={source.expires_ts}"
+        ),
+    }
+    return SubscriptionDocument(
+        user_id=source.user_id,
+        body=body,
+        gzipped=gzip.compress(body, compresslevel=6, mtime=0),
+        etag=etag,
+        headers=headers,
+        expires_ts=source.expires_ts,
+    )
+
+
+async def build_links(source: SubscriptionSource) -> tuple[list[str], bool]:
+    """Links of every inbound the client is enabled on, and whether the panel data was used.
+
+    An expired subscription has no links, as its clients are disabled on
+    the panel. Without panel data the stored key is the only link.
+    """
+    if source.expires_ts and source.expires_ts <= time.time():
+        return [], True
+    panel = registry.get(source.panel or LEGACY_PANEL)
+    if panel and source.email:
+        xui = registry.client(panel)
+        links = []
+        try:
+            for inbound_id in panel.inbound_ids:
+                inbound = await xui.get_inbound(inbound_id)
+                client = inbound.find_client(email=source.email) if inbound else None
+                if client and client.get("enable", True):
+                    links.append(
+                        build_vless_uri(
+                            inbound,
+                            str(client.get("id") or source.client_id),
+                            source.email,
+                            host=panel.host,
+                            flow=client.get("flow") or "",
+                            public_port=panel.public_port,
+                        )
+                    )
+        except Exception as exc:
+            logging.warning("Inbounds for subscription of user %s unavailable: %s", source.user_id, exc)
+            links = []
+        if links:
+            return links, True
+    return ([source.vless_uri] if source.vless_uri else []), False
+
+
+class SubscriptionDocuments:
+    """LRU + TTL cache of subscription documents by ``sub_id``.
+
+    Invalidated per user through the storage change hook, like
+    :class:`~src.profile_cache.ProfileCache`.
+    """
+
+    def __init__(self, max_size: int = SUB_CACHE_SIZE, ttl: float = SUB_CACHE_SECONDS) -> None:
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries: OrderedDict[str, tuple[float, SubscriptionDocument]] = OrderedDict()
+        self._sub_ids: dict[int, str] = {}
+        # Bumped by every invalidation; a build that overlapped one is not kept.
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._attached = False
+
+    def attach(self) -> None:
+        if not self._attached:
+            storage.on_change(self._on_storage_change)
+            self._attached = True
+
+    def detach(self) -> None:
+        if self._attached:
+            storage.remove_listener(self._on_storage_change)
+            self._attached = False
+
+    def _on_storage_change(self, kind: str, user_id: int) -> None:
+        if kind in ("key", "subscription"):
+            self.invalidate(user_id)
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            self._generation += 1
+            sub_id = self._sub_ids.pop(user_id, None)
+            if sub_id is not None and self._entries.pop(sub_id, None) is not None:
+                self.invalidations += 1
+
+    def _lookup(self, sub_id: str) -> Optional[SubscriptionDocument]:
+        with self._lock:
+            entry = self._entries.get(sub_id)
+            if entry is None:
+                return None
+            stale_at, document = entry
+            if stale_at < time.monotonic() or 0 < document.expires_ts <= time.time():
+                del self._entries[sub_id]
+                self._sub_ids.pop(document.user_id, None)
+                return None
+            self._entries.move_to_end(sub_id)
+            return document
+
+    def _store(self, sub_id: str, document: SubscriptionDocument, ttl: float, generation: int) -> None:
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[sub_id] = (time.monotonic() + ttl, document)
+            self._entries.move_to_end(sub_id)
+            self._sub_ids[document.user_id] = sub_id
+            while len(self._entries) > self.max_size:
+                evicted_sub_id, (_, evicted) = self._entries.popitem(last=False)
+                if self._sub_ids.get(evicted.user_id) == evicted_sub_id:
+                    del self._sub_ids[evicted.user_id]
+
+    async def get(self, sub_id: str) -> Optional[SubscriptionDocument]:
+        """The document for ``sub_id``, or ``None`` if no key has it."""
+        document = self._lookup(sub_id)
+        if document is not None:
+            self.hits += 1
+            return document
+        self.misses += 1
+        generation = self._generation
+        source = await async_storage.get_subscription_source(sub_id)
+        if source is None:
+            return None
+        links, from_panel = await build_links(source)
+        document = build_document(source, links)
+        self._store(sub_id, document, self.ttl if from_panel else min(self.ttl, FALLBACK_TTL_SECONDS), generation)
+        return document
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    tags = [tag.strip() for tag in if_none_match.split(",") if tag.strip()]
+    # Weak comparison, as for GET; proxies may weaken the tag after gzip.
+    return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+
+
+documents = SubscriptionDocuments()
@@ -1,4 +1,6 @@
-from typing import Dict
+from dataclasses import dataclass
+from string import Formatter
+from typing import Dict, FrozenSet
 
 from .config import (
     BRAND_NAME,
@@ -581,33 +583,91 @@ EN: Dict[str, str] = {
 }
 
 
-def t(lang: str, text_id: str, **kwargs: str) -> str:
-    data = EN if lang == "en" else RU
-    base = {
-        "brand": BRAND_NAME,
-        "bot": BOT_USERNAME,
-        "support": SUPPORT_BOT,
-        "channel": CHANNEL,
-        "trial_days": str(TRIAL_DAYS),
-        "trial_price": TRIAL_PRICE_RUB,
-        "one_click_url": ONE_CLICK_URL,
-        "v2ray_url": V2RAY_URL,
-        "privacy_email": PRIVACY_EMAIL,
-        "happ_gp": kwargs.get("happ_gp", ""),
-        "happ_apk": kwargs.get("happ_apk", ""),
-        "happ_ios_ru": kwargs.get("happ_ios_ru", ""),
-        "happ_ios_alt": kwargs.get("happ_ios_alt", ""),
-        "app_store_link": kwargs.get("app_store_link", ""),
-        "flclash_link": kwargs.get("flclash_link", ""),
-        "v2ray_gp": kwargs.get("v2ray_gp", ""),
-        "v2ray_apk": kwargs.get("v2ray_apk", ""),
-        "key_link": kwargs.get("key_link", ""),
-        "sub_url": kwargs.get("sub_url", ""),
-        "sub_url_link": kwargs.get("sub_url_link", ""),
-        "happ_url": kwargs.get("happ_url", ""),
-        "v2raytun_url": kwargs.get("v2raytun_url", ""),
-        "client_line": kwargs.get("client_line", ""),
+# Values that never change at runtime; they are baked into the compiled
+# templates once so ``t`` only substitutes per-user fields.
+STATIC_FIELDS: Dict[str, str] = {
+    "brand": BRAND_NAME,
+    "bot": BOT_USERNAME,
+    "support": SUPPORT_BOT,
+    "channel": CHANNEL,
+    "trial_days": str(TRIAL_DAYS),
+    "trial_price": TRIAL_PRICE_RUB,
+    "one_click_url": ONE_CLICK_URL,
+    "v2ray_url": V2RAY_URL,
+    "privacy_email": PRIVACY_EMAIL,
+}
+
+
+@dataclass(frozen=True)
+class CompiledText:
+    source: str
+    template: str
+    fields: FrozenSet[str]
+    static_fields: FrozenSet[str]
+
+
+def _compile(text: str) -> CompiledText:
+    parts: list[str] = []
+    fields: set[str] = set()
+    static_fields: set[str] = set()
+    for literal, field, spec, conversion in Formatter().parse(text):
+        parts.append(literal.replace("{", "{{").replace("}", "}}"))
+        if field is None:
+            continue
+        if field in STATIC_FIELDS and not spec and not conversion:
+            static_fields.add(field)
+            value = STATIC_FIELDS[field]
+            parts.append(value.replace("{", "{{").replace("}", "}}"))
+            continue
+        fields.add(field)
+        suffix = (f"!{conversion}" if conversion else "") + (f":{spec}" if spec else "")
+        parts.append(f"{{{field}{suffix}}}")
+    template = "".join(parts)
+    if not fields:
+        template = template.format()
+    return CompiledText(text, template, frozenset(fields), frozenset(static_fields))
+
+
+COMPILED_RU: Dict[str, CompiledText] = {key: _compile(value) for key, value in RU.items()}
+COMPILED_EN: Dict[str, CompiledText] = {key: _compile(value) for key, value in EN.items()}
+
+
+# Link fields callers may leave out; they render as "". Any other field a
+# text uses must be passed, and a missing one raises KeyError.
+OPTIONAL_FIELDS: FrozenSet[str] = frozenset(
+    {
+        "happ_gp",
+        "happ_apk",
+        "happ_ios_ru",
+        "happ_ios_alt",
+        "app_store_link",
+        "flclash_link",
+        "v2ray_gp",
+        "v2ray_apk",
+        "key_link",
+        "sub_url",
+        "sub_url_link",
+        "happ_url",
+        "v2raytun_url",
+        "client_line",
     }
-    base.update(kwargs)
-    text = data.get(text_id, "")
-    return _fmt(text, **base)
+)
+
+
+def _values(compiled: CompiledText, kwargs: Dict[str, str]) -> Dict[str, str]:
+    missing = compiled.fields - kwargs.keys() - OPTIONAL_FIELDS
+    if missing:
+        raise KeyError(", ".join(sorted(missing)))
+    return {name: kwargs.get(name, "") for name in compiled.fields}
+
+
+def t(lang: str, text_id: str, **kwargs: str) -> str:
+    compiled = (COMPILED_EN if lang == "en" else COMPILED_RU).get(text_id)
+    if compiled is None:
+        return ""
+    if kwargs and not compiled.static_fields.isdisjoint(kwargs):
+        # A caller overrides a static value (e.g. an HTML-escaped brand).
+        return _fmt(compiled.source, **{**STATIC_FIELDS, **_values(compiled, kwargs), **kwargs})
+    if not compiled.fields:
+        return compiled.template
+    return compiled.template.format_map(_values(compiled, kwargs))
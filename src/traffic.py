@@ -0,0 +1,192 @@
+"""Client traffic and online status from the 3x-ui panels.
+
+:class:`TrafficPoller` stores the deltas of each client's cumulative
+counters since the previous reading in ``traffic_usage``; the previous
+readings live in ``traffic_counters``. Counters only move while a client is
+connected, so after one full ``/inbounds/list`` sweep at startup a poll asks
+the panel who is online and reads ``getClientTraffics`` for those clients
+and the ones online at the previous poll, which catches their last bytes.
+Which Telegram user an email belongs to comes from the cached inbound
+snapshots and is only looked up again after a key change, local or through
+the change feed. Minute buckets are folded into hours and hours into days
+as they age, keeping the table small at tens of thousands of clients.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import re
+import time
+from typing import Any, Iterable, Optional
+
+from . import storage
+from .async_storage import mark_online, record_traffic, rollup_traffic
+from .config import TRAFFIC_POLL_SECONDS, TRAFFIC_RETENTION_DAYS, XUI_CONCURRENCY
+from .panels import Panel, registry
+from .xui_api import XuiApi, XuiInbound
+
+
+# Minute buckets are kept for two hours and hour buckets for two days.
+MINUTES_FOR_SECONDS = 2 * 3600
+HOURS_FOR_SECONDS = 2 * 86400
+ROLLUP_INTERVAL_SECONDS = 600
+
+_EMAIL_USER = re.compile(r"tg_(\d+)")
+
+
+def _user_id(email: str, users: dict[str, int]) -> Optional[int]:
+    match = _EMAIL_USER.fullmatch(email)
+    if match:
+        return int(match.group(1))
+    return users.get(email)
+
+
+def _client_users(inbounds: Iterable[XuiInbound]) -> dict[str, int]:
+    """Telegram ids of clients with a custom email, which still carry it as tgId."""
+    users: dict[str, int] = {}
+    for inbound in inbounds:
+        for client in inbound.clients:
+            email = str(client.get("email") or "")
+            tg_id = str(client.get("tgId") or "")
+            if email and tg_id.isdigit() and not _EMAIL_USER.fullmatch(email):
+                users[email] = int(tg_id)
+    return users
+
+
+class TrafficPoller:
+    def __init__(
+        self,
+        poll_seconds: float = TRAFFIC_POLL_SECONDS,
+        retention_days: int = TRAFFIC_RETENTION_DAYS,
+        chunk_size: int = 1000,
+        concurrency: int = XUI_CONCURRENCY,
+    ) -> None:
+        self.poll_seconds = poll_seconds
+        self.retention_days = retention_days
+        self.chunk_size = max(1, chunk_size)
+        self.concurrency = max(1, concurrency)
+        # panel -> emails online at its last stored poll; a panel without an
+        # entry is swept in full.
+        self._online: dict[str, set[str]] = {}
+        # panel -> custom email -> Telegram id, until the next key change.
+        self._users: dict[str, dict[str, int]] = {}
+        self._key_changes = 0
+
+    def _on_storage_change(self, kind: str, user_id: int) -> None:
+        if kind == "key":
+            # Runs on the writing thread; the next poll reloads the client lists.
+            self._key_changes += 1
+            self._users = {}
+
+    def _keep_users(self, panel: Panel, users: dict[str, int], key_changes: int) -> None:
+        # A list loaded while a key changed may miss that client.
+        if key_changes == self._key_changes:
+            self._users[panel.name] = users
+
+    async def _load_users(self, panel: Panel, xui: XuiApi) -> dict[str, int]:
+        key_changes = self._key_changes
+        if panel.inbound_ids:
+            fetched = [await xui.get_inbound(inbound_id) for inbound_id in panel.inbound_ids]
+            inbounds = [inbound for inbound in fetched if inbound]
+        else:
+            inbounds = [XuiInbound(raw) for raw in await xui.list_inbounds()]
+        users = _client_users(inbounds)
+        self._keep_users(panel, users, key_changes)
+        return users
+
+    async def _record(self, panel: Panel, users: dict[str, int], stats: Iterable[dict[str, Any]], now: int) -> int:
+        moved = 0
+        chunk: list[tuple[str, int, int, int]] = []
+        for stat in stats:
+            email = str(stat.get("email") or "")
+            user_id = _user_id(email, users) if email else None
+            if user_id is None:
+                continue
+            chunk.append((email, user_id, int(stat.get("up", 0) or 0), int(stat.get("down", 0) or 0)))
+            if len(chunk) >= self.chunk_size:
+                moved += await record_traffic(panel.name, chunk, now)
+                chunk = []
+        if chunk:
+            moved += await record_traffic(panel.name, chunk, now)
+        return moved
+
+    async def _sweep(self, panel: Panel, xui: XuiApi, now: int) -> int:
+        """Read every client's counters from one full ``/inbounds/list`` call."""
+        key_changes = self._key_changes
+        inbounds: list[XuiInbound] = []
+        stats: list[dict[str, Any]] = []
+        for raw in await xui.list_inbounds(fresh=True):
+            inbound = XuiInbound(raw)
+            if panel.inbound_ids and inbound.id not in panel.inbound_ids:
+                continue
+            inbounds.append(inbound)
+            stats.extend(raw.get("clientStats") or [])
+        users = _client_users(inbounds)
+        self._keep_users(panel, users, key_changes)
+        return await self._record(panel, users, stats, now)
+
+    async def _read_clients(self, xui: XuiApi, emails: list[str]) -> list[dict[str, Any]]:
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def read(email: str) -> Optional[dict[str, Any]]:
+            async with semaphore:
+                return await xui.client_traffic(email)
+
+        return [stat for stat in await asyncio.gather(*(read(email) for email in emails)) if stat]
+
+    async def poll_panel(self, panel: Panel) -> int:
+        """Store the panel's new traffic and online clients; returns clients with traffic."""
+        xui = registry.client(panel)
+        now = int(time.time())
+        online = set(await xui.online_emails())
+        previous = self._online.get(panel.name)
+        if previous is None:
+            moved = await self._sweep(panel, xui, now)
+        else:
+            users = self._users.get(panel.name)
+            if users is None:
+                users = await self._load_users(panel, xui)
+            emails = [email for email in online | previous if _user_id(email, users) is not None]
+            moved = await self._record(panel, users, await self._read_clients(xui, emails), now)
+        await mark_online(panel.name, online, now)
+        # Only remembered once stored, so a failed poll reads these clients again.
+        self._online[panel.name] = online
+        return moved
+
+    async def poll(self) -> int:
+        moved = 0
+        for panel in registry.panels:
+            try:
+                moved += await self.poll_panel(panel)
+            except Exception as exc:
+                logging.warning("Traffic poll of panel %s failed: %s", panel.name, exc)
+        return moved
+
+    async def rollup(self) -> int:
+        return await rollup_traffic(
+            int(time.time()),
+            MINUTES_FOR_SECONDS,
+            HOURS_FOR_SECONDS,
+            self.retention_days * 86400,
+        )
+
+    async def run(self) -> None:
+        storage.on_change(self._on_storage_change)
+        try:
+            await self._run()
+        finally:
+            storage.remove_listener(self._on_storage_change)
+
+    async def _run(self) -> None:
+        next_rollup = 0.0
+        while True:
+            started = time.monotonic()
+            moved = await self.poll()
+            logging.debug("Traffic poll: %s clients with new traffic in %.1fs", moved, time.monotonic() - started)
+            if time.monotonic() >= next_rollup:
+                next_rollup = time.monotonic() + ROLLUP_INTERVAL_SECONDS
+                try:
+                    await self.rollup()
+                except Exception:
+                    logging.exception("Failed to roll up traffic buckets")
+            await asyncio.sleep(max(0.0, self.poll_seconds - (time.monotonic() - started)))
@@ -1,4 +1,6 @@
 import asyncio
+from collections import OrderedDict
+from datetime import datetime, timezone
 import hashlib
 import hmac
 import json
@@ -7,10 +9,21 @@ from typing import Any, Optional
 from urllib.parse import unquote, urlparse
 
 from aiohttp import web
-from aiogram import Bot
-
-from .config import BOT_TOKEN
-from .issue import issue_access
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.types import Update
+
+from . import async_storage
+from .async_storage import get_user_key, init_db, set_payment_job_stage, set_payment_job_target
+from .config import ADMIN_IDS, BOT_TOKEN, NOTIFY_CONCURRENCY, NOTIFY_QUEUE_SIZE, NOTIFY_SEND_RATE
+from .coordination import ChangeFeed
+from .data import PLAN_DAYS
+from .issue import issue_access, renewal_expiry
+from .panels import registry as panel_registry
+from .payment_queue import EventLedger, PaymentWorkers, idempotency_key
+from .sender import Outbox
+from .storage import PaymentJob
+from .subscriptions import documents as sub_documents, etag_matches
 
 
 logging.basicConfig(level=logging.INFO)
@@ -23,6 +36,15 @@ TRIBUTE_API_KEY = ""
 TRIBUTE_DEFAULT_PLAN = "trial"
 TRIBUTE_PRODUCT_MAP: dict[str, str] = {}
 
+_ledger = EventLedger()
+_bot: Optional[Bot] = None
+_shared_bot: Optional[Bot] = None
+_outbox: Optional[Outbox] = None
+_workers: Optional[PaymentWorkers] = None
+_workers_task: Optional[asyncio.Task] = None
+_feed_task: Optional[asyncio.Task] = None
+_run_change_feed = True
+
 
 def load_env() -> None:
     global WEBHOOK_TOKEN, WEBHOOK_BIND, WEBHOOK_PORT
@@ -109,35 +131,102 @@ def is_success_event(data: dict[str, Any]) -> bool:
     return "succeed" in event or "paid" in event
 
 
+def payment_event_id(data: dict[str, Any]) -> str:
+    obj = data.get("object") if isinstance(data.get("object"), dict) else {}
+    for value in (obj.get("id"), data.get("payment_id"), data.get("id")):
+        if value:
+            return str(value)
+    return ""
+
+
+def tribute_event_id(data: dict[str, Any]) -> str:
+    payload = data.get("payload") if isinstance(data.get("payload"), dict) else {}
+    for key in ("purchase_id", "order_id", "subscription_id", "id"):
+        if payload.get(key):
+            return str(payload[key])
+    user_id, _ = extract_tribute_payment(data)
+    created_at = data.get("created_at") or payload.get("created_at")
+    if user_id and created_at:
+        # Redeliveries keep the event time but may change ``sent_at``.
+        product_id = payload.get("product_id") or payload.get("digital_product_id") or ""
+        return f"{user_id}:{product_id}:{created_at}"
+    return ""
+
+
+def _access_message(vless_uri: str, sub_url: str) -> str:
+    return (
+        "Оплата подтверждена. Вот ваш доступ:\n\n"
+        f"Ключ:\n{vless_uri}\n\n"
+        f"Подписка:\n{sub_url}\n\n"
+        "Нажмите на ключ, чтобы скопировать."
+    )
+
+
+async def process_payment(job: PaymentJob) -> None:
+    # The stage survives retries, so a failed delivery does not issue twice.
+    if job.stage != "issued":
+        # A run that dies between issuing and recording the stage is run
+        # again; the date fixed by the first attempt keeps it from adding
+        # the paid days a second time.
+        target_ts = job.target_expires_ts or await set_payment_job_target(
+            job.id, int((await renewal_expiry(job.user_id, job.plan_code)).timestamp())
+        )
+        expires = datetime.fromtimestamp(target_ts, tz=timezone.utc)
+        await issue_access(job.user_id, job.plan_code, expires=expires)
+        await set_payment_job_stage(job.id, "issued")
+    if not _outbox:
+        return
+    vless_uri, sub_url = await get_user_key(job.user_id)
+    if not await _outbox.deliver(job.user_id, _access_message(vless_uri, sub_url)):
+        # Blocked bot or repeated Telegram errors; the key stays available
+        # from the profile screen, so the job itself is done.
+        logging.warning("Could not deliver key for payment job %s", job.id)
+
+
+async def notify_dead_payment(job: PaymentJob, error: str) -> None:
+    if not _outbox:
+        return
+    for admin_id in ADMIN_IDS:
+        await _outbox.post(
+            admin_id,
+            f"Платёж не обработан (job {job.id}, user {job.user_id}, plan {job.plan_code}):\n"
+            f"{error}\n\nПовторить: /payment_retry {job.id}",
+        )
+
+
+async def _enqueue(source: str, event_id: str, raw: bytes, user_id: int, plan_code: str) -> web.Response:
+    if plan_code not in PLAN_DAYS:
+        return web.json_response({"ok": False, "error": "invalid plan"}, status=400)
+    job_id, created = await _ledger.record(
+        idempotency_key(source, event_id, raw),
+        source,
+        user_id,
+        plan_code,
+        raw.decode("utf-8", "replace"),
+    )
+    if created and _workers:
+        _workers.wake()
+    return web.json_response({"ok": True, "job_id": job_id, "duplicate": not created})
+
+
 async def handle_payment(request: web.Request) -> web.Response:
     token = request.headers.get("X-Webhook-Token") or request.query.get("token", "")
     if WEBHOOK_TOKEN and token != WEBHOOK_TOKEN:
         return web.json_response({"ok": False, "error": "unauthorized"}, status=401)
-    data = await request.json()
+    raw = await request.read()
+    try:
+        data = json.loads(raw.decode("utf-8"))
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        return web.json_response({"ok": False, "error": "invalid json"}, status=400)
+    if not isinstance(data, dict):
+        return web.json_response({"ok": False, "error": "invalid json"}, status=400)
     if not is_success_event(data):
         return web.json_response({"ok": True, "ignored": True})
     extracted = extract_payment(data)
     if not extracted:
         return web.json_response({"ok": False, "error": "missing user_id/plan"}, status=400)
     user_id, plan_code = extracted
-    try:
-        key = await issue_access(user_id, plan_code)
-    except Exception as exc:
-        logging.exception("Issue access failed")
-        return web.json_response({"ok": False, "error": str(exc)}, status=500)
-
-    if BOT_TOKEN:
-        bot = Bot(BOT_TOKEN)
-        await bot.send_message(
-            user_id,
-            "Оплата подтверждена. Вот ваш доступ:\n\n"
-            f"Ключ:\n{key.vless_uri}\n\n"
-            f"Подписка:\n{key.sub_url}\n\n"
-            "Нажмите на ключ, чтобы скопировать.",
-        )
-        await bot.session.close()
-
-    return web.json_response({"ok": True})
+    return await _enqueue("paid", payment_event_id(data), raw, user_id, plan_code)
 
 
 async def handle_tribute(request: web.Request) -> web.Response:
@@ -147,30 +236,15 @@ async def handle_tribute(request: web.Request) -> web.Response:
         return web.json_response({"ok": False, "error": "unauthorized"}, status=401)
     try:
         data = json.loads(raw.decode("utf-8"))
-    except json.JSONDecodeError:
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        return web.json_response({"ok": False, "error": "invalid json"}, status=400)
+    if not isinstance(data, dict):
         return web.json_response({"ok": False, "error": "invalid json"}, status=400)
 
     user_id, plan_code = extract_tribute_payment(data)
     if not user_id:
         return web.json_response({"ok": False, "error": "missing telegram_user_id"}, status=400)
-    try:
-        key = await issue_access(user_id, plan_code)
-    except Exception as exc:
-        logging.exception("Issue access failed")
-        return web.json_response({"ok": False, "error": str(exc)}, status=500)
-
-    if BOT_TOKEN:
-        bot = Bot(BOT_TOKEN)
-        await bot.send_message(
-            user_id,
-            "گ?گُگ>گّ‘'گّ گُگ?গ?‘'گ?গç‘?گگ?گçগ?গّ. گ'গ?‘' গ?গّ‘? গ?গ?‘?‘'‘?गُ:\n\n"
-            f"گ?গ>‘?‘ط:\n{key.vless_uri}\n\n"
-            f"گ?گ?গ?গُগٌ‘?গَগّ:\n{key.sub_url}\n\n"
-            "گ?গّগग?গٌ‘'গç গ?গّ گَগ>‘?‘ط, ‘ط‘'গ?গ+‘< ‘?গَগ?গُগٌ‘?গ?গ?গّ‘'‘?.",
-        )
-        await bot.session.close()
-
-    return web.json_response({"ok": True})
+    return await _enqueue("tribute", tribute_event_id(data), raw, user_id, plan_code)
 
 
 def _is_allowed_redirect(value: str) -> bool:
@@ -188,18 +262,173 @@ async def handle_redirect(request: web.Request) -> web.Response:
     raise web.HTTPFound(location=target)
 
 
-async def init_app() -> web.Application:
+async def handle_subscription(request: web.Request) -> web.Response:
+    document = await sub_documents.get(request.match_info["sub_id"])
+    if document is None:
+        return web.Response(status=404, text="not found")
+    headers = {**document.headers, "Vary": "Accept-Encoding"}
+    if etag_matches(request.headers.get("If-None-Match", ""), document.etag):
+        del headers["Content-Type"]
+        return web.Response(status=304, headers=headers)
+    body = document.body
+    if "gzip" in request.headers.get("Accept-Encoding", "") and len(document.gzipped) < len(body):
+        headers["Content-Encoding"] = "gzip"
+        body = document.gzipped
+    return web.Response(body=body, headers=headers)
+
+
+def _on_remote_change(kind: str, user_ids: list[int]) -> None:
+    # Clients provisioned by another process are missing from our inbound
+    # snapshots until they are refetched.
+    if kind == "key":
+        panel_registry.invalidate_inbounds()
+
+
+# Telegram redelivers within minutes, so this many recent update ids cover
+# every retry of an update this process already took.
+SEEN_UPDATES = 10000
+
+
+class BotUpdateHandler:
+    """Feed Telegram webhook updates to a dispatcher, ``workers`` at a time.
+
+    An update is acknowledged only after the dispatcher has handled it, so
+    one still in flight when the process dies gets no 200 and Telegram
+    delivers it again. While every slot is busy the request is held open,
+    so Telegram slows down instead of updates piling up in memory. A
+    handler error is logged and acknowledged; a redelivery would fail the
+    same way.
+
+    Recent update ids are remembered: a redelivery of an update that is
+    being or has been handled here (e.g. after a proxy in front timed out)
+    waits for that first delivery and is acknowledged without being handled
+    again.
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, secret: str, workers: int) -> None:
+        self.dp = dp
+        self.bot = bot
+        self.secret = secret
+        self._slots = asyncio.Semaphore(max(1, workers))
+        self._seen: OrderedDict[int, asyncio.Future] = OrderedDict()
+        self.duplicates = 0
+
+    async def handle(self, request: web.Request) -> web.Response:
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, self.secret):
+            return web.json_response({"ok": False, "error": "unauthorized"}, status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception:
+            return web.json_response({"ok": False, "error": "invalid update"}, status=400)
+        update_id = update.update_id
+        first = self._seen.get(update_id)
+        if first is not None:
+            self.duplicates += 1
+            await asyncio.shield(first)
+            return web.json_response({"ok": True})
+        done = asyncio.get_running_loop().create_future()
+        self._seen[update_id] = done
+        while len(self._seen) > SEEN_UPDATES:
+            self._seen.popitem(last=False)
+        try:
+            async with self._slots:
+                try:
+                    await self.dp.feed_update(self.bot, update)
+                except Exception:
+                    logging.exception("Failed to handle update %s", update_id)
+        except asyncio.CancelledError:
+            # Not handled to the end, so a redelivery gets another go.
+            if self._seen.get(update_id) is done:
+                del self._seen[update_id]
+            raise
+        finally:
+            done.set_result(None)
+        return web.json_response({"ok": True})
+
+
+def add_bot_updates(app: web.Application, dp: Dispatcher, bot: Bot, path: str, secret: str, workers: int) -> None:
+    """Serve Telegram updates for ``dp`` from this app at ``path``."""
+    handler = BotUpdateHandler(dp, bot, secret, workers)
+    app.router.add_post(path, handler.handle)
+
+
+async def _on_startup(app: web.Application) -> None:
+    global _bot, _outbox, _workers, _workers_task, _feed_task
+    await init_db()
+    await _ledger.warm()
+    sub_documents.attach()
+    if _run_change_feed:
+        feed = ChangeFeed()
+        feed.subscribe(_on_remote_change)
+        _feed_task = asyncio.create_task(feed.run())
+    if _shared_bot:
+        _bot = _shared_bot
+    elif BOT_TOKEN:
+        # One bot and connection pool for the whole process.
+        _bot = Bot(BOT_TOKEN, session=AiohttpSession(limit=NOTIFY_CONCURRENCY))
+    if _bot:
+        _outbox = Outbox(_bot, NOTIFY_SEND_RATE, NOTIFY_CONCURRENCY, NOTIFY_QUEUE_SIZE)
+        _outbox.start()
+    _workers = PaymentWorkers(process_payment, on_dead=notify_dead_payment)
+    _workers_task = asyncio.create_task(_workers.run())
+
+
+async def _on_cleanup(app: web.Application) -> None:
+    global _bot, _outbox, _workers, _workers_task, _feed_task
+    if _feed_task:
+        _feed_task.cancel()
+        await asyncio.gather(_feed_task, return_exceptions=True)
+        _feed_task = None
+    sub_documents.detach()
+    if _workers_task:
+        # Jobs interrupted here keep their lease and are picked up again
+        # after it runs out.
+        _workers_task.cancel()
+        await asyncio.gather(_workers_task, return_exceptions=True)
+    _workers = None
+    _workers_task = None
+    if _outbox:
+        await _outbox.close()
+        _outbox = None
+    if _bot and _bot is not _shared_bot:
+        await _bot.session.close()
+    _bot = None
+
+
+async def _close_panels(app: web.Application) -> None:
+    await panel_registry.close()
+
+
+async def init_app(bot: Optional[Bot] = None, change_feed: bool = True) -> web.Application:
+    """Build the app; pass ``bot`` to reuse (and not close) an existing bot.
+
+    Pass ``change_feed=False`` when the process already runs a
+    :class:`~src.coordination.ChangeFeed` that keeps its caches current.
+    The panel clients are shared with the rest of the process and left open;
+    whoever runs the process closes them.
+    """
+    global _shared_bot, _run_change_feed
     load_env()
+    _shared_bot = bot
+    _run_change_feed = change_feed
     app = web.Application()
     app.router.add_get("/api/v1/redirect_dl", handle_redirect)
+    app.router.add_get("/sub/{sub_id}", handle_subscription)
     app.router.add_post("/payment/paid", handle_payment)
     app.router.add_post("/payment/tribute", handle_tribute)
+    app.on_startup.append(_on_startup)
+    app.on_cleanup.append(_on_cleanup)
     return app
 
 
 def main() -> None:
     app = asyncio.run(init_app())
-    web.run_app(app, host=WEBHOOK_BIND, port=WEBHOOK_PORT)
+    app.on_cleanup.append(_close_panels)
+    try:
+        web.run_app(app, host=WEBHOOK_BIND, port=WEBHOOK_PORT)
+    finally:
+        async_storage.shutdown()
 
 
 if __name__ == "__main__":
@@ -1,20 +1,55 @@
 from __future__ import annotations
 
+import asyncio
 import json
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Any, Optional
+from functools import cached_property, partial
+import logging
+import random
+import re
+import time
+from typing import Any, Iterable, Optional
 from urllib.parse import urlencode, quote
 
 import aiohttp
 
-from .config import XUI_TIMEOUT_SECONDS
+from .config import (
+    XUI_BACKOFF_BASE_SECONDS,
+    XUI_BACKOFF_MAX_SECONDS,
+    XUI_BREAKER_RESET_SECONDS,
+    XUI_BREAKER_THRESHOLD,
+    XUI_COALESCE_SECONDS,
+    XUI_INBOUND_CACHE_SECONDS,
+    XUI_RETRIES,
+    XUI_TIMEOUT_SECONDS,
+)
+
+
+def _json_field(raw: Any) -> dict[str, Any]:
+    if isinstance(raw, str):
+        try:
+            return json.loads(raw or "{}")
+        except json.JSONDecodeError:
+            return {}
+    return raw or {}
 
 
 @dataclass(frozen=True)
 class XuiInbound:
+    """One inbound as returned by the panel.
+
+    ``settings`` is parsed once and clients are indexed by email and tgId.
+    The parsed client view is patched in place by :class:`XuiApi` after its
+    own client writes, so a cached snapshot stays usable between refreshes.
+    """
+
     raw: dict[str, Any]
 
+    @property
+    def id(self) -> int:
+        return int(self.raw.get("id", 0) or 0)
+
     @property
     def port(self) -> int:
         return int(self.raw.get("port", 0) or 0)
@@ -23,34 +58,204 @@ class XuiInbound:
     def protocol(self) -> str:
         return self.raw.get("protocol", "")
 
-    @property
+    @cached_property
     def stream_settings(self) -> dict[str, Any]:
-        raw = self.raw.get("streamSettings") or {}
-        if isinstance(raw, str):
-            try:
-                return json.loads(raw)
-            except json.JSONDecodeError:
-                return {}
-        return raw
+        return _json_field(self.raw.get("streamSettings"))
 
-    @property
+    @cached_property
     def settings(self) -> dict[str, Any]:
-        raw = self.raw.get("settings") or {}
-        if isinstance(raw, str):
-            try:
-                return json.loads(raw)
-            except json.JSONDecodeError:
-                return {}
-        return raw
+        return _json_field(self.raw.get("settings"))
 
-    @property
+    @cached_property
     def clients(self) -> list[dict[str, Any]]:
-        settings = self.settings
-        clients = settings.get("clients") or []
+        clients = self.settings.get("clients") or []
         if isinstance(clients, list):
             return clients
         return []
 
+    @cached_property
+    def _index(self) -> dict[str, dict[str, Any]]:
+        index: dict[str, dict[str, Any]] = {}
+        for client in self.clients:
+            self._index_client(index, client)
+        return index
+
+    @staticmethod
+    def _index_client(index: dict[str, dict[str, Any]], client: dict[str, Any]) -> None:
+        # First match wins, mirroring a linear scan over the client list.
+        email = client.get("email")
+        if email:
+            index.setdefault(f"email:{email}", client)
+        tg_id = str(client.get("tgId", "") or "")
+        if tg_id:
+            index.setdefault(f"tg:{tg_id}", client)
+
+    def find_client(self, email: str = "", tg_id: str = "") -> Optional[dict[str, Any]]:
+        index = self._index
+        if email and f"email:{email}" in index:
+            return index[f"email:{email}"]
+        if tg_id:
+            return index.get(f"tg:{tg_id}")
+        return None
+
+    def upsert_client(self, client: dict[str, Any]) -> None:
+        client = dict(client)
+        clients = self.clients
+        for position, current in enumerate(clients):
+            if current.get("id") == client.get("id") or (
+                client.get("email") and current.get("email") == client.get("email")
+            ):
+                clients[position] = client
+                break
+        else:
+            clients.append(client)
+        self._reindex()
+
+    def remove_client(self, client_id: str) -> None:
+        self.clients[:] = [c for c in self.clients if c.get("id") != client_id]
+        self._reindex()
+
+    def _reindex(self) -> None:
+        self.__dict__.pop("_index", None)
+
+    @cached_property
+    def _templates(self) -> dict[tuple[str, str, int | None], VlessTemplate]:
+        return {}
+
+    def vless_template(self, host: str, flow: str = "", public_port: int | None = None) -> VlessTemplate:
+        """The inbound's VLESS URI with only the client fields left open.
+
+        Compiled on first use and kept with this snapshot; client patches
+        do not touch the stream settings it depends on.
+        """
+        key = (host, flow, public_port)
+        template = self._templates.get(key)
+        if template is None:
+            template = self._templates[key] = _compile_vless(self, host, flow, public_port)
+        return template
+
+
+@dataclass(frozen=True)
+class VlessTemplate:
+    tail: str
+
+    def render(self, client_id: str, email: str) -> str:
+        return f"vless://{client_id}{self.tail}{email}"
+
+
+class XuiServerError(RuntimeError):
+    """The panel answered with a 5xx status."""
+
+    def __init__(self, status: int, endpoint: str) -> None:
+        super().__init__(f"XUI {endpoint} returned HTTP {status}")
+        self.status = status
+
+
+class XuiBadResponse(RuntimeError):
+    """The panel (or a proxy in front of it) answered with something that is not an API response."""
+
+
+class XuiUnavailable(RuntimeError):
+    """Raised without touching the network while the circuit is open."""
+
+
+# Failures that say nothing about the request itself and may go away.
+_TRANSIENT_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, XuiServerError)
+
+
+class CircuitBreaker:
+    """Open after ``threshold`` consecutive failures, probe again after ``reset_seconds``.
+
+    While open every call fails fast. Once the reset window has passed the
+    breaker is half-open: one probe request is let through and its outcome
+    closes or re-opens the circuit.
+    """
+
+    def __init__(self, threshold: int, reset_seconds: float) -> None:
+        self.threshold = max(1, threshold)
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        # Start of the in-flight half-open probe; a probe that never reports
+        # back (e.g. cancelled) stops blocking others after reset_seconds.
+        self._probe_started: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half-open"
+        return "open"
+
+    def check(self) -> None:
+        state = self.state
+        if state == "closed":
+            return
+        now = time.monotonic()
+        if state == "half-open" and (
+            self._probe_started is None or now - self._probe_started >= self.reset_seconds
+        ):
+            self._probe_started = now
+            return
+        remaining = max(0.0, self.reset_seconds - (now - (self.opened_at or 0.0)))
+        raise XuiUnavailable(f"XUI panel unavailable, retry in {remaining:.0f}s")
+
+    def record_success(self) -> None:
+        if self.opened_at is not None:
+            logging.info("XUI circuit closed")
+        self.failures = 0
+        self.opened_at = None
+        self._probe_started = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        probing = self._probe_started is not None
+        if probing or self.failures >= self.threshold:
+            if self.opened_at is None or probing:
+                logging.warning("XUI circuit opened after %s failure(s)", self.failures)
+            self.opened_at = time.monotonic()
+            self._probe_started = None
+
+
+@dataclass
+class EndpointStats:
+    calls: int = 0
+    errors: int = 0
+    total_ms: float = 0.0
+    max_ms: float = 0.0
+
+    @property
+    def avg_ms(self) -> float:
+        return self.total_ms / self.calls if self.calls else 0.0
+
+    def record(self, elapsed: float, error: bool) -> None:
+        elapsed_ms = elapsed * 1000
+        self.calls += 1
+        self.errors += int(error)
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+
+
+_ID_SEGMENT = re.compile(r"/(?:\d+|[0-9a-fA-F-]{32,36})(?=/|$)")
+_EMAIL_SEGMENT = re.compile(r"(/clientIps|/getClientTraffics)/[^/]+$")
+
+
+async def _read_json(resp: aiohttp.ClientResponse, endpoint: str) -> dict:
+    try:
+        data = await resp.json(content_type=None)
+    except ValueError as exc:
+        raise XuiBadResponse(f"XUI {endpoint} returned HTTP {resp.status} that is not JSON") from exc
+    if not isinstance(data, dict):
+        raise XuiBadResponse(f"XUI {endpoint} returned HTTP {resp.status} without a JSON object")
+    return data
+
+
+def _endpoint_name(method: str, path: str) -> str:
+    # "/inbounds/get/7" and "/inbounds/get/9" share one metrics bucket.
+    path = _EMAIL_SEGMENT.sub(r"\1/{email}", _ID_SEGMENT.sub("/{id}", path))
+    return f"{method} {path}"
+
 
 @dataclass(frozen=True)
 class XuiKey:
@@ -69,6 +274,12 @@ class XuiApi:
         password: str,
         api_path: str = "/panel/api",
         verify_ssl: bool = True,
+        inbound_ttl: float = XUI_INBOUND_CACHE_SECONDS,
+        retries: int = XUI_RETRIES,
+        backoff_base: float = XUI_BACKOFF_BASE_SECONDS,
+        backoff_max: float = XUI_BACKOFF_MAX_SECONDS,
+        breaker: Optional[CircuitBreaker] = None,
+        coalesce_window: float = XUI_COALESCE_SECONDS,
     ) -> None:
         self.base_url = base_url.rstrip("/")
         self.username = username
@@ -80,46 +291,253 @@ class XuiApi:
             timeout=aiohttp.ClientTimeout(total=XUI_TIMEOUT_SECONDS),
         )
         self._logged_in = False
+        # Shared in-flight login and a counter of completed ones, so a 401
+        # for a request sent before the latest login does not log in again.
+        self._login_task: Optional[asyncio.Task] = None
+        self._login_generation = 0
+        self.inbound_ttl = inbound_ttl
+        self._inbounds: dict[int, tuple[float, XuiInbound]] = {}
+        self.retries = max(0, retries)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker(XUI_BREAKER_THRESHOLD, XUI_BREAKER_RESET_SECONDS)
+        self.metrics: dict[str, EndpointStats] = {}
+        self.coalesce_window = coalesce_window
+        self.coalesced = 0
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._recent: dict[str, tuple[float, dict]] = {}
+        self._writes = 0
 
     async def close(self) -> None:
         await self._session.close()
 
-    async def _login(self) -> None:
+    async def _do_login(self) -> None:
         url = f"{self.base_url}/login"
         payload = {"username": self.username, "password": self.password}
         async with self._session.post(url, data=payload) as resp:
-            data = await resp.json(content_type=None)
+            if resp.status >= 500:
+                raise XuiServerError(resp.status, "POST /login")
+            data = await _read_json(resp, "POST /login")
         if not data.get("success"):
             raise RuntimeError(f"XUI login failed: {data}")
         self._logged_in = True
+        self._login_generation += 1
 
-    async def _request(self, method: str, path: str, json_body: Any | None = None) -> dict:
-        if not self._logged_in:
+    def _login_done(self, task: asyncio.Task) -> None:
+        if self._login_task is task:
+            self._login_task = None
+        if not task.cancelled():
+            # Retrieved here so a failure nobody awaited is not reported as lost.
+            task.exception()
+
+    async def _login(self) -> None:
+        """Log in, or join the login another request already started."""
+        task = self._login_task
+        if task is None:
+            task = asyncio.ensure_future(self._do_login())
+            self._login_task = task
+            task.add_done_callback(self._login_done)
+        await asyncio.shield(task)
+
+    async def _send(self, method: str, url: str, endpoint: str, json_body: Any | None) -> dict:
+        if not self._logged_in or self._login_task is not None:
             await self._login()
-        url = f"{self.base_url}{self.api_path}{path}"
+        generation = self._login_generation
         async with self._session.request(method, url, json=json_body) as resp:
             if resp.status == 401:
-                self._logged_in = False
-                await self._login()
+                if generation == self._login_generation:
+                    self._logged_in = False
+                    await self._login()
+                elif self._login_task is not None:
+                    await self._login()
                 async with self._session.request(method, url, json=json_body) as retry:
-                    return await retry.json(content_type=None)
-            return await resp.json(content_type=None)
+                    if retry.status >= 500:
+                        raise XuiServerError(retry.status, endpoint)
+                    return await _read_json(retry, endpoint)
+            if resp.status >= 500:
+                raise XuiServerError(resp.status, endpoint)
+            return await _read_json(resp, endpoint)
+
+    def _backoff(self, attempt: int) -> float:
+        # Full jitter keeps a burst of webhooks from retrying in lockstep.
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    async def _request(
+        self,
+        method: str,
+        path: str,
+        json_body: Any | None = None,
+        idempotent: Optional[bool] = None,
+        write: Optional[bool] = None,
+    ) -> dict:
+        """Call the panel API.
+
+        Transient failures (connection errors, timeouts, 5xx) are retried
+        with backoff when the call is ``idempotent`` (GETs by default).
+        Other calls are only retried if the connection was never established,
+        since the panel cannot have applied them. An answer that is not API
+        JSON counts against the breaker but is not retried. A ``write`` (any
+        method but GET by default) drops the recent GET responses.
+        """
+        if idempotent is None:
+            idempotent = method == "GET"
+        if write is None:
+            write = method != "GET"
+        endpoint = _endpoint_name(method, path)
+        stats = self.metrics.setdefault(endpoint, EndpointStats())
+        url = f"{self.base_url}{self.api_path}{path}"
+        attempt = 0
+        while True:
+            attempt += 1
+            self.breaker.check()
+            started = time.monotonic()
+            try:
+                data = await self._send(method, url, endpoint, json_body)
+            except _TRANSIENT_ERRORS as exc:
+                stats.record(time.monotonic() - started, error=True)
+                self.breaker.record_failure()
+                retryable = idempotent or isinstance(exc, aiohttp.ClientConnectorError)
+                if not retryable or attempt > self.retries:
+                    raise
+                delay = self._backoff(attempt)
+                logging.warning("XUI %s failed (%s), retry %s in %.2fs", endpoint, exc, attempt, delay)
+                await asyncio.sleep(delay)
+                continue
+            except XuiBadResponse:
+                # An HTML error page or garbage: something in the way is
+                # broken, and sending the same request again will not help.
+                stats.record(time.monotonic() - started, error=True)
+                self.breaker.record_failure()
+                raise
+            except Exception:
+                # The panel gave a real API answer (e.g. rejected the login), so it is up.
+                stats.record(time.monotonic() - started, error=True)
+                self.breaker.record_success()
+                raise
+            stats.record(time.monotonic() - started, error=False)
+            self.breaker.record_success()
+            if write:
+                self._writes += 1
+                self._recent.clear()
+            return data
+
+    def _get_done(self, path: str, writes: int, task: asyncio.Task) -> None:
+        if self._inflight.get(path) is task:
+            del self._inflight[path]
+        if task.cancelled() or task.exception() is not None:
+            return
+        # A write that landed meanwhile may not be reflected in the response.
+        if self.coalesce_window > 0 and writes == self._writes:
+            self._recent[path] = (time.monotonic(), task.result())
+
+    async def _get(self, path: str, reuse_recent: bool = True) -> dict:
+        """GET ``path``, sharing the response between identical concurrent calls.
+
+        Callers arriving while a request for ``path`` is in flight await that
+        request; with ``reuse_recent`` a response younger than
+        ``coalesce_window`` is returned as is. Any write clears those
+        recent responses. The returned dict is shared and must not be mutated.
+        """
+        if reuse_recent:
+            recent = self._recent.get(path)
+            if recent and time.monotonic() - recent[0] < self.coalesce_window:
+                self.coalesced += 1
+                return recent[1]
+        task = self._inflight.get(path)
+        if task is None:
+            task = asyncio.ensure_future(self._request("GET", path))
+            self._inflight[path] = task
+            task.add_done_callback(partial(self._get_done, path, self._writes))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
 
-    async def list_inbounds(self) -> list[dict[str, Any]]:
-        data = await self._request("GET", "/inbounds/list")
+    def stats(self) -> dict[str, Any]:
+        return {
+            "circuit": self.breaker.state,
+            "failures": self.breaker.failures,
+            "coalesced": self.coalesced,
+            "logins": self._login_generation,
+            "endpoints": dict(self.metrics),
+        }
+
+    async def list_inbounds(self, fresh: bool = False) -> list[dict[str, Any]]:
+        data = await self._get("/inbounds/list", reuse_recent=not fresh)
         return data.get("obj", []) if isinstance(data, dict) else []
 
-    async def get_inbound(self, inbound_id: int) -> Optional[XuiInbound]:
-        data = await self._request("GET", f"/inbounds/get/{inbound_id}")
-        inbound = data.get("obj") if isinstance(data, dict) else None
-        return XuiInbound(inbound) if inbound else None
+    async def online_emails(self) -> list[str]:
+        """Emails of the clients connected right now."""
+        # A read, even though the panel only serves it over POST.
+        data = await self._request("POST", "/inbounds/onlines", idempotent=True, write=False)
+        emails = data.get("obj") if isinstance(data, dict) else None
+        return [email for email in emails or [] if isinstance(email, str)]
+
+    async def client_ips(self, email: str) -> list[str]:
+        """Source IPs the panel logged for ``email``; empty without IP logging."""
+        data = await self._request("POST", f"/inbounds/clientIps/{quote(email)}", idempotent=True, write=False)
+        ips = data.get("obj") if isinstance(data, dict) else None
+        if isinstance(ips, str):
+            # "No IP Record" or a JSON list, depending on the panel version.
+            try:
+                ips = json.loads(ips)
+            except json.JSONDecodeError:
+                return []
+        return [str(ip) for ip in ips] if isinstance(ips, list) else []
+
+    async def client_traffic(self, email: str) -> Optional[dict[str, Any]]:
+        """Cumulative ``up``/``down`` counters of one client; None if the panel has none."""
+        data = await self._request("GET", f"/inbounds/getClientTraffics/{quote(email)}")
+        traffic = data.get("obj")
+        return traffic if isinstance(traffic, dict) else None
+
+    async def get_inbound(self, inbound_id: int, fresh: bool = False) -> Optional[XuiInbound]:
+        """Return the inbound snapshot, refetching it once it is older than ``inbound_ttl``."""
+        cached = self._inbounds.get(inbound_id)
+        if cached and not fresh and time.monotonic() - cached[0] < self.inbound_ttl:
+            return cached[1]
+        data = await self._get(f"/inbounds/get/{inbound_id}", reuse_recent=not fresh)
+        raw = data.get("obj") if isinstance(data, dict) else None
+        if not raw:
+            self._inbounds.pop(inbound_id, None)
+            return None
+        inbound = XuiInbound(raw)
+        if self.inbound_ttl > 0:
+            self._inbounds[inbound_id] = (time.monotonic(), inbound)
+        return inbound
+
+    def invalidate_inbound(self, inbound_id: Optional[int] = None) -> None:
+        if inbound_id is None:
+            self._inbounds.clear()
+        else:
+            self._inbounds.pop(inbound_id, None)
+
+    def _patch_inbound(self, inbound_id: int, client: Optional[dict[str, Any]] = None, removed: str = "") -> None:
+        cached = self._inbounds.get(inbound_id)
+        if not cached:
+            return
+        if client is not None:
+            cached[1].upsert_client(client)
+        if removed:
+            cached[1].remove_client(removed)
 
     async def add_client(self, inbound_id: int, client_settings: dict[str, Any]) -> dict:
+        return await self.add_clients(inbound_id, [client_settings])
+
+    async def add_clients(self, inbound_id: int, clients: list[dict[str, Any]]) -> dict:
+        """Create ``clients`` on an inbound in a single panel call.
+
+        The panel applies the list as a whole: on failure none of them
+        should be assumed created.
+        """
         payload = {
             "id": inbound_id,
-            "settings": json.dumps({"clients": [client_settings]}),
+            "settings": json.dumps({"clients": clients}),
         }
-        return await self._request("POST", "/inbounds/addClient", payload)
+        result = await self._request("POST", "/inbounds/addClient", payload)
+        if result.get("success"):
+            for client in clients:
+                self._patch_inbound(inbound_id, client)
+        return result
 
     async def update_client(
         self,
@@ -131,17 +549,45 @@ class XuiApi:
             "id": inbound_id,
             "settings": json.dumps({"clients": [client_settings]}),
         }
-        return await self._request("POST", f"/inbounds/updateClient/{client_id}", payload)
+        # Replaying the same client settings leaves the panel unchanged.
+        result = await self._request("POST", f"/inbounds/updateClient/{client_id}", payload, idempotent=True)
+        if result.get("success"):
+            self._patch_inbound(inbound_id, client_settings)
+        return result
+
+    async def update_clients(
+        self,
+        inbound_id: int,
+        clients: list[dict[str, Any]],
+        concurrency: int = 1,
+    ) -> list[dict]:
+        """Update existing clients (matched by their ``id``); one result per client.
 
+        The panel only updates one client per call, so the calls are issued
+        concurrently, at most ``concurrency`` at a time. Errors are returned
+        as ``{"success": False, "msg": ...}`` instead of raised.
+        """
+        semaphore = asyncio.Semaphore(max(1, concurrency))
 
-def build_vless_uri(
-    inbound: XuiInbound,
-    client_id: str,
-    email: str,
-    host: str,
-    flow: str = "",
-    public_port: int | None = None,
-) -> str:
+        async def update(client: dict[str, Any]) -> dict:
+            async with semaphore:
+                try:
+                    return await self.update_client(client["id"], inbound_id, client)
+                except XuiUnavailable:
+                    raise
+                except Exception as exc:
+                    return {"success": False, "msg": f"{type(exc).__name__}: {exc}"}
+
+        return list(await asyncio.gather(*(update(client) for client in clients)))
+
+    async def delete_client(self, inbound_id: int, client_id: str) -> dict:
+        result = await self._request("POST", f"/inbounds/{inbound_id}/delClient/{client_id}")
+        if result.get("success"):
+            self._patch_inbound(inbound_id, removed=client_id)
+        return result
+
+
+def _compile_vless(inbound: XuiInbound, host: str, flow: str, public_port: int | None) -> VlessTemplate:
     stream = inbound.stream_settings
     security = stream.get("security", "none")
     network = stream.get("network", "tcp")
@@ -167,7 +613,35 @@ def build_vless_uri(
         params["security"] = "tls"
     port = public_port or inbound.port
     query = urlencode(params, quote_via=quote, safe="/:")
-    return f"vless://{client_id}@{host}:{port}?{query}#{email}"
+    return VlessTemplate(tail=f"@{host}:{port}?{query}#")
+
+
+def build_vless_uri(
+    inbound: XuiInbound,
+    client_id: str,
+    email: str,
+    host: str,
+    flow: str = "",
+    public_port: int | None = None,
+) -> str:
+    return inbound.vless_template(host, flow, public_port).render(client_id, email)
+
+
+def build_vless_uris(
+    inbound: XuiInbound,
+    clients: Iterable[tuple[str, str, str]],
+    host: str,
+    public_port: int | None = None,
+) -> list[str]:
+    """``build_vless_uri`` for many ``(client_id, email, flow)`` at once."""
+    templates: dict[str, VlessTemplate] = {}
+    uris = []
+    for client_id, email, flow in clients:
+        template = templates.get(flow)
+        if template is None:
+            template = templates[flow] = inbound.vless_template(host, flow, public_port)
+        uris.append(template.render(client_id, email))
+    return uris
 
 
 def build_sub_url(base_url: str, sub_id: str) -> str:
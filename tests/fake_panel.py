@@ -0,0 +1,110 @@
+"""A local stand-in for the parts of the 3x-ui API the bot uses."""
+from __future__ import annotations
+
+import json
+
+from aiohttp import web
+
+
+INBOUND_ID = 1
+
+
+class FakePanel:
+    """Just enough of the 3x-ui API for ``XuiApi`` and ``issue_access``.
+
+    ``faults`` is consumed one entry per API call: ``"500"`` answers with a
+    server error, ``"html"`` with a proxy's error page and ``"reset"`` drops
+    the connection without an answer. ``calls`` records every API call.
+    """
+
+    def __init__(self) -> None:
+        self.clients: list[dict] = []
+        # email -> cumulative (up, down), and the emails connected right now
+        self.traffic: dict[str, tuple[int, int]] = {}
+        self.online: list[str] = []
+        self.faults: list[str] = []
+        self.calls: list[str] = []
+        self.accept_login = True
+        self._runner: web.AppRunner | None = None
+
+    async def login(self, request: web.Request) -> web.Response:
+        return web.json_response({"success": self.accept_login})
+
+    def _stat(self, email: str) -> dict:
+        up, down = self.traffic.get(email, (0, 0))
+        return {"inboundId": INBOUND_ID, "email": email, "up": up, "down": down}
+
+    def _inbound(self) -> dict:
+        return {
+            "id": INBOUND_ID,
+            "port": 443,
+            "protocol": "vless",
+            "streamSettings": json.dumps({"network": "tcp", "security": "none"}),
+            "settings": json.dumps({"clients": self.clients}),
+            "clientStats": [self._stat(client["email"]) for client in self.clients],
+        }
+
+    async def get_inbound(self, request: web.Request) -> web.Response:
+        return web.json_response({"success": True, "obj": self._inbound()})
+
+    async def list_inbounds(self, request: web.Request) -> web.Response:
+        return web.json_response({"success": True, "obj": [self._inbound()]})
+
+    async def onlines(self, request: web.Request) -> web.Response:
+        return web.json_response({"success": True, "obj": self.online})
+
+    async def client_traffic(self, request: web.Request) -> web.Response:
+        email = request.match_info["email"]
+        known = any(client["email"] == email for client in self.clients)
+        return web.json_response({"success": True, "obj": self._stat(email) if known else None})
+
+    async def add_client(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.clients += json.loads(body["settings"])["clients"]
+        return web.json_response({"success": True})
+
+    async def update_client(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        [client] = json.loads(body["settings"])["clients"]
+        self.clients = [client if c["id"] == request.match_info["id"] else c for c in self.clients]
+        return web.json_response({"success": True})
+
+    @web.middleware
+    async def _faults(self, request: web.Request, handler) -> web.StreamResponse:
+        if not request.path.startswith("/panel/api/"):
+            return await handler(request)
+        self.calls.append(f"{request.method} {request.path}")
+        fault = self.faults.pop(0) if self.faults else ""
+        if fault == "500":
+            return web.Response(status=500, text="Internal Server Error")
+        if fault == "html":
+            return web.Response(status=403, text="<html>Access denied</html>", content_type="text/html")
+        if fault == "reset":
+            request.transport.abort()
+            return web.Response()
+        return await handler(request)
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self._faults])
+        app.router.add_post("/login", self.login)
+        app.router.add_get("/panel/api/inbounds/get/{inbound_id}", self.get_inbound)
+        app.router.add_get("/panel/api/inbounds/list", self.list_inbounds)
+        app.router.add_post("/panel/api/inbounds/onlines", self.onlines)
+        app.router.add_get("/panel/api/inbounds/getClientTraffics/{email}", self.client_traffic)
+        app.router.add_post("/panel/api/inbounds/addClient", self.add_client)
+        app.router.add_post("/panel/api/inbounds/updateClient/{id}", self.update_client)
+        return app
+
+    async def start(self) -> str:
+        """Serve on a free local port; returns the base URL."""
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}"
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,49 @@
+"""Telegram redeliveries of an update are handled once per process."""
+from __future__ import annotations
+
+import asyncio
+
+from aiogram import Bot
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from src import webhook
+
+
+SECRET = "secret"
+UPDATE = {"update_id": 7, "message": {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}}}
+
+
+class SlowDispatcher:
+    def __init__(self) -> None:
+        self.handled: list[int] = []
+
+    async def feed_update(self, bot: Bot, update) -> None:
+        await asyncio.sleep(0.1)
+        self.handled.append(update.update_id)
+
+
+def test_redelivered_update_is_handled_once():
+    async def main():
+        dp = SlowDispatcher()
+        bot = Bot("123:ABC")
+        app = web.Application()
+        webhook.add_bot_updates(app, dp, bot, "/update", SECRET, 4)
+        headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+        try:
+            async with TestClient(TestServer(app)) as client:
+                # One redelivery while the first is still running, one after.
+                first, during = await asyncio.gather(
+                    client.post("/update", json=UPDATE, headers=headers),
+                    client.post("/update", json=UPDATE, headers=headers),
+                )
+                after = await client.post("/update", json=UPDATE, headers=headers)
+                other = await client.post("/update", json={**UPDATE, "update_id": 8}, headers=headers)
+                statuses = [first.status, during.status, after.status, other.status]
+        finally:
+            await bot.session.close()
+        return statuses, dp.handled
+
+    statuses, handled = asyncio.run(main())
+    assert statuses == [200] * 4
+    assert handled == [7, 8]
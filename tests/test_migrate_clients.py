@@ -0,0 +1,69 @@
+"""Users a migration failed on can be provisioned again on their own."""
+from __future__ import annotations
+
+import argparse
+import asyncio
+from datetime import datetime, timedelta, timezone
+import json
+
+import pytest
+
+from fake_panel import INBOUND_ID, FakePanel
+from src import storage
+from src.ops import migrate_clients
+from src.panels import Panel, PanelRegistry
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    storage.close_db()
+    monkeypatch.setattr(storage, "DB_PATH", tmp_path / "bot.db")
+    storage.init_db()
+    yield
+    storage.close_db()
+
+
+def _args(checkpoint, **overrides) -> argparse.Namespace:
+    values = {
+        "panel": "",
+        "inbound_ids": str(INBOUND_ID),
+        "batch_size": 500,
+        "concurrency": 2,
+        "checkpoint": checkpoint,
+        "restart": False,
+        "retry_failed": True,
+        "include_expired": False,
+        "rewrite_keys": False,
+        "dry_run": False,
+    }
+    values.update(overrides)
+    return argparse.Namespace(**values)
+
+
+def test_retry_failed_provisions_only_recorded_users(database, monkeypatch, tmp_path):
+    expires = (datetime.now(timezone.utc) + timedelta(days=30)).isoformat()
+    for user_id in (1, 2, 3):
+        storage.upsert_user(user_id, "en")
+        storage.set_user_key(user_id, "vless://x", "", f"client-{user_id}", f"tg_{user_id}", f"sub{user_id}")
+        storage.set_subscription(user_id, expires)
+    checkpoint = tmp_path / "migrate.json"
+    checkpoint.write_text(json.dumps({"inbound_ids": [INBOUND_ID], "last_user_id": 3, "done": 3, "failed": [2]}))
+    fake = FakePanel()
+
+    async def main():
+        registry = PanelRegistry([Panel("test", await fake.start(), "u", "p", (INBOUND_ID,))])
+        monkeypatch.setattr(migrate_clients, "registry", registry)
+        monkeypatch.setattr("src.issue.registry", registry)
+        try:
+            code = await migrate_clients.migrate(_args(checkpoint))
+            return code, dict(registry._clients)
+        finally:
+            await registry.close()
+            await fake.stop()
+
+    code, clients_left = asyncio.run(main())
+    assert code == 0
+    assert [client["email"] for client in fake.clients] == ["tg_2"]
+    assert json.loads(checkpoint.read_text())["failed"] == []
+    # Closed through the registry, so it hands out a new client next time.
+    assert clients_left == {}
@@ -0,0 +1,61 @@
+"""A payment job that runs again must not extend the subscription twice."""
+from __future__ import annotations
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from fake_panel import INBOUND_ID, FakePanel
+from src import async_storage, issue, storage, webhook
+from src.data import PLAN_DAYS
+from src.panels import Panel, PanelRegistry
+
+
+USER_ID = 42
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    storage.close_db()
+    monkeypatch.setattr(storage, "DB_PATH", tmp_path / "bot.db")
+    storage.init_db()
+    yield
+    storage.close_db()
+
+
+async def _rerun_after_lost_stage(monkeypatch, fake: FakePanel) -> tuple[int, int]:
+    registry = PanelRegistry([Panel("test", await fake.start(), "u", "p", (INBOUND_ID,))])
+    monkeypatch.setattr(issue, "registry", registry)
+    try:
+        job_id, _ = storage.enqueue_payment_job("paid:order-1", "paid", USER_ID, "1m", "{}")
+        now = int(datetime.now(timezone.utc).timestamp())
+        [job] = storage.claim_payment_jobs(1, now, 300)
+
+        async def crash(job_id: int, stage: str) -> None:
+            raise RuntimeError("worker died before recording the stage")
+
+        monkeypatch.setattr(webhook, "set_payment_job_stage", crash)
+        with pytest.raises(RuntimeError):
+            await webhook.process_payment(job)
+        monkeypatch.setattr(webhook, "set_payment_job_stage", async_storage.set_payment_job_stage)
+
+        # The lease runs out and another worker picks the job up again.
+        [job] = storage.claim_payment_jobs(1, now + 301, 300)
+        assert job.id == job_id and job.stage == ""
+        await webhook.process_payment(job)
+        return now, int(fake.clients[0]["expiryTime"]) // 1000
+    finally:
+        await registry.close()
+        await fake.stop()
+
+
+def test_rerun_after_lost_stage_extends_once(database, monkeypatch):
+    fake = FakePanel()
+    paid_at, panel_expiry = asyncio.run(_rerun_after_lost_stage(monkeypatch, fake))
+
+    expected = paid_at + PLAN_DAYS["1m"] * 86400
+    stored = datetime.fromisoformat(storage.get_subscription(USER_ID).expires_at)
+    assert len(fake.clients) == 1
+    assert abs(panel_expiry - expected) < 60
+    assert abs(stored - datetime.fromtimestamp(expected, timezone.utc)) < timedelta(seconds=60)
@@ -0,0 +1,61 @@
+"""The reminder schedule follows storage writes without reloading everything."""
+from __future__ import annotations
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from src import reminders, storage
+
+
+USER_ID = 42
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    storage.close_db()
+    monkeypatch.setattr(storage, "DB_PATH", tmp_path / "bot.db")
+    storage.init_db()
+    yield
+    storage.close_db()
+
+
+def test_new_subscription_is_reminded_without_a_resync(database, monkeypatch):
+    loads = []
+    real_list = reminders.list_reminder_states
+
+    async def counting_list():
+        loads.append(1)
+        return await real_list()
+
+    monkeypatch.setattr(reminders, "list_reminder_states", counting_list)
+
+    async def main():
+        sent = asyncio.Event()
+        dispatched = []
+
+        async def dispatch(batch):
+            dispatched.extend(batch)
+            for reminder in batch:
+                storage.mark_reminded(reminder.user_id, reminder.kind)
+            if batch:
+                sent.set()
+
+        scheduler = reminders.ReminderScheduler(dispatch, resync_seconds=0, retry_seconds=3600)
+        task = asyncio.create_task(scheduler.run())
+        try:
+            await asyncio.sleep(0.1)
+            assert len(scheduler) == 0
+            storage.upsert_user(USER_ID, "en")
+            expires = datetime.now(timezone.utc) + timedelta(days=2)
+            storage.set_subscription(USER_ID, expires.isoformat())
+            await asyncio.wait_for(sent.wait(), timeout=5)
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        return dispatched
+
+    dispatched = asyncio.run(main())
+    assert [reminder.user_id for reminder in dispatched] == [USER_ID]
+    assert loads == [1]
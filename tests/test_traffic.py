@@ -0,0 +1,72 @@
+"""Traffic polling reads only the clients that can have moved."""
+from __future__ import annotations
+
+import asyncio
+import time
+
+import pytest
+
+from fake_panel import INBOUND_ID, FakePanel
+from src import storage, traffic
+from src.panels import Panel, PanelRegistry
+
+
+LIST = "GET /panel/api/inbounds/list"
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    storage.close_db()
+    monkeypatch.setattr(storage, "DB_PATH", tmp_path / "bot.db")
+    storage.init_db()
+    yield
+    storage.close_db()
+
+
+def _client(email: str, tg_id: int) -> dict:
+    return {"id": f"id-{email}", "email": email, "tgId": tg_id, "enable": True}
+
+
+def test_poll_reads_online_clients_after_the_first_sweep(database, monkeypatch):
+    fake = FakePanel()
+    fake.clients = [_client("tg_1", 1), _client("custom", 2), _client("tg_3", 3)]
+    fake.traffic = {"tg_1": (10, 10), "custom": (5, 5), "tg_3": (7, 7)}
+
+    async def main():
+        registry = PanelRegistry([Panel("test", await fake.start(), "u", "p", (INBOUND_ID,))])
+        monkeypatch.setattr(traffic, "registry", registry)
+        poller = traffic.TrafficPoller()
+        try:
+            # The first poll sets every client's baseline from one sweep.
+            assert await poller.poll() == 0
+            assert fake.calls.count(LIST) == 1
+
+            fake.calls.clear()
+            fake.online = ["tg_1", "custom"]
+            fake.traffic.update({"tg_1": (110, 10), "custom": (5, 55), "tg_3": (1007, 7)})
+            moved = await poller.poll()
+            second = list(fake.calls)
+
+            # A client that went offline is read once more for its last bytes.
+            fake.calls.clear()
+            fake.online = []
+            fake.traffic["custom"] = (5, 65)
+            moved += await poller.poll()
+            third = list(fake.calls)
+        finally:
+            await registry.close()
+            await fake.stop()
+        return moved, second, third
+
+    moved, second, third = asyncio.run(main())
+    assert moved == 3
+    assert LIST not in second + third
+    assert sorted(call for call in second if "getClientTraffics" in call) == [
+        "GET /panel/api/inbounds/getClientTraffics/custom",
+        "GET /panel/api/inbounds/getClientTraffics/tg_1",
+    ]
+    since = int(time.time()) - 3600
+    assert storage.get_traffic_used(1, since) == (100, 0)
+    assert storage.get_traffic_used(2, since) == (0, 60)
+    # Offline throughout, so not read until it connects again.
+    assert storage.get_traffic_used(3, since) == (0, 0)
@@ -0,0 +1,113 @@
+"""Retries and the circuit breaker of ``XuiApi`` against a local stand-in panel."""
+from __future__ import annotations
+
+import asyncio
+
+import aiohttp
+import pytest
+
+from fake_panel import INBOUND_ID, FakePanel
+from src.xui_api import CircuitBreaker, XuiApi, XuiBadResponse, XuiServerError, XuiUnavailable
+
+
+GET_INBOUND = f"GET /panel/api/inbounds/get/{INBOUND_ID}"
+ADD_CLIENT = "POST /panel/api/inbounds/addClient"
+CLIENT = {"id": "0b8c1f7e-5c1e-4c1b-9f2e-000000000001", "email": "tg_1", "enable": True}
+
+
+def _run(scenario, *faults: str, threshold: int = 5, reset_seconds: float = 30.0, retries: int = 3):
+    async def main():
+        fake = FakePanel()
+        fake.faults = list(faults)
+        xui = XuiApi(
+            await fake.start(),
+            "u",
+            "p",
+            inbound_ttl=0,
+            retries=retries,
+            backoff_base=0.01,
+            backoff_max=0.01,
+            breaker=CircuitBreaker(threshold, reset_seconds),
+            coalesce_window=0,
+        )
+        try:
+            return await scenario(fake, xui)
+        finally:
+            await xui.close()
+            await fake.stop()
+
+    return asyncio.run(main())
+
+
+@pytest.mark.parametrize("fault", ["500", "reset"])
+def test_get_is_retried_after_transient_failure(fault):
+    async def scenario(fake, xui):
+        inbound = await xui.get_inbound(INBOUND_ID)
+        return fake.calls, inbound, xui.breaker
+
+    calls, inbound, breaker = _run(scenario, fault, fault)
+    assert calls == [GET_INBOUND] * 3
+    assert inbound is not None and inbound.id == INBOUND_ID
+    assert breaker.state == "closed" and breaker.failures == 0
+
+
+@pytest.mark.parametrize("fault, error", [("500", XuiServerError), ("reset", aiohttp.ServerDisconnectedError)])
+def test_add_client_is_not_retried(fault, error):
+    async def scenario(fake, xui):
+        with pytest.raises(error):
+            await xui.add_client(INBOUND_ID, CLIENT)
+        return fake.calls, fake.clients
+
+    calls, clients = _run(scenario, fault)
+    assert calls == [ADD_CLIENT]
+    assert clients == []
+
+
+def test_non_json_answer_is_a_failure_and_not_retried():
+    async def scenario(fake, xui):
+        with pytest.raises(XuiBadResponse):
+            await xui.get_inbound(INBOUND_ID)
+        return fake.calls, xui.breaker.failures
+
+    calls, failures = _run(scenario, "html")
+    assert calls == [GET_INBOUND]
+    assert failures == 1
+
+
+def test_rejected_login_does_not_count_against_the_panel():
+    async def scenario(fake, xui):
+        fake.accept_login = False
+        xui.breaker.record_failure()
+        with pytest.raises(RuntimeError, match="login failed"):
+            await xui.get_inbound(INBOUND_ID)
+        return xui.breaker.failures
+
+    assert _run(scenario) == 0
+
+
+def test_breaker_opens_probes_and_closes():
+    async def scenario(fake, xui):
+        for _ in range(2):
+            with pytest.raises(XuiServerError):
+                await xui.get_inbound(INBOUND_ID)
+        assert xui.breaker.state == "open"
+        calls = len(fake.calls)
+        with pytest.raises(XuiUnavailable):
+            await xui.get_inbound(INBOUND_ID)
+        assert len(fake.calls) == calls
+
+        await asyncio.sleep(0.25)
+        assert xui.breaker.state == "half-open"
+        # A failed probe opens the circuit again right away.
+        fake.faults = ["500"]
+        with pytest.raises(XuiServerError):
+            await xui.get_inbound(INBOUND_ID)
+        assert xui.breaker.state == "open"
+
+        await asyncio.sleep(0.25)
+        assert xui.breaker.state == "half-open"
+        assert await xui.get_inbound(INBOUND_ID) is not None
+        return xui.breaker
+
+    breaker = _run(scenario, "500", "500", threshold=2, reset_seconds=0.2, retries=0)
+    assert breaker.state == "closed" and breaker.failures == 0